@@ -0,0 +1,116 @@
+""" End-to-end benchmark of okta-awscli against local Okta, STS and sign-in stand-ins
+
+Usage: python -m benchmarks.bench_e2e [--mode single|alias] [--roles 1,10,100,1000] [--runs 10]
+                                      [--okta-ms 20] [--sts-ms 20] [--signin-ms 50] [--mfa-polls 0] [--warm]
+
+Every run is a fresh `python -m oktaawscli.okta_awscli` process with HOME
+pointing at a scratch directory, so interpreter start-up, imports,
+connection set-up and file writes are all part of the measured latency.
+
+  single  logs in and assumes the role saved in the profile (--force)
+  alias   logs in and assumes every role of the assertion (-l, selected-roles
+          accepted at the prompt), writing one profile per role
+
+Without --warm the session, assertion and alias caches are disabled so each
+run does the full login. Reports p50/p99 latency, requests per run to each
+stand-in service and the peak RSS of the okta-awscli process.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_services import FakeServices, role_arn
+
+PROFILE_OPTIONS = """base-url = {base_url}
+username = bench
+password = bench
+app-link = {base_url}/home/amazon_aws/{roles}/272
+sts-endpoint = {base_url}/sts
+signin-url = {base_url}/saml
+session-cache = {warm}
+assertion-cache = {warm}
+"""
+
+
+def write_config(home, base_url, role_count, mode, warm):
+    options = PROFILE_OPTIONS.format(base_url=base_url, roles=role_count, warm='true' if warm else 'false')
+    if not warm:
+        options += 'alias-cache-ttl = 0\n'
+    with open(os.path.join(home, '.okta-aws'), 'w') as config_file:
+        if mode == 'single':
+            config_file.write('[default]\n' + options + 'role = %s\n' % role_arn(role_count - 1))
+        else:
+            # --alias always uses this okta profile
+            config_file.write('[default]\n' + options + '\n[temporary-cli-aws-profile]\n' + options +
+                              'selected-roles = %s\n' % ','.join(role_arn(i) for i in range(role_count)))
+
+
+def run_once(home, mode):
+    """ Runs okta-awscli once, returns (seconds, peak RSS in KB, exit status) """
+    args = [sys.executable, '-m', 'oktaawscli.okta_awscli']
+    args += ['--profile', 'bench', '--force'] if mode == 'single' else ['-l']
+    env = dict(os.environ, HOME=home)
+    start = time.perf_counter()
+    proc = subprocess.Popen(args, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    proc.stdin.write(b'\n')
+    proc.stdin.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return elapsed, rusage.ru_maxrss, proc.returncode
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('single', 'alias'), default='single')
+    parser.add_argument('--roles', default='1,10,100,1000')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--okta-ms', type=float, default=20)
+    parser.add_argument('--sts-ms', type=float, default=20)
+    parser.add_argument('--signin-ms', type=float, default=50)
+    parser.add_argument('--mfa-polls', type=int, default=0)
+    parser.add_argument('--warm', action='store_true')
+    args = parser.parse_args(argv)
+
+    latency = {'okta': args.okta_ms / 1000, 'sts': args.sts_ms / 1000, 'signin': args.signin_ms / 1000}
+    services = FakeServices(latency, args.mfa_polls).start()
+    print("mode %s, %d runs, latency okta %.0f ms, sts %.0f ms, signin %.0f ms%s" %
+          (args.mode, args.runs, args.okta_ms, args.sts_ms, args.signin_ms, ', warm caches' if args.warm else ''))
+    print("%-7s %9s %9s %10s %10s %10s %9s" % ('roles', 'p50 ms', 'p99 ms', 'okta req', 'sts req', 'signin req',
+                                               'peak MB'))
+    failed = False
+    try:
+        for role_count in [int(n) for n in args.roles.split(',')]:
+            with tempfile.TemporaryDirectory() as home:
+                write_config(home, services.base_url, role_count, args.mode, args.warm)
+                services.take_counts()
+                timings, peaks = [], []
+                for _ in range(args.runs):
+                    elapsed, peak, status = run_once(home, args.mode)
+                    if status != 0:
+                        failed = True
+                        print("run with %d roles exited with status %d" % (role_count, status))
+                    timings.append(elapsed)
+                    peaks.append(peak)
+                counts = services.take_counts()
+                print("%-7d %9.1f %9.1f %10.1f %10.1f %10.1f %9.1f" % (
+                    role_count, statistics.median(timings) * 1000, percentile(timings, 0.99) * 1000,
+                    counts.get('okta', 0) / args.runs, counts.get('sts', 0) / args.runs,
+                    counts.get('signin', 0) / args.runs, max(peaks) / 1024))
+    finally:
+        services.stop()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
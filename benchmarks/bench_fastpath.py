@@ -0,0 +1,92 @@
+""" Start-up-to-exit latency of okta-awscli-env against its budget
+
+Usage: python -m benchmarks.bench_fastpath [--runs 30] [--budget-ms 50]
+
+Runs okta-awscli-env (python -m oktaawscli.fastpath) with a scratch HOME
+holding cached credentials, for a hit, a miss and a --profile read, next to
+a bare interpreter (python -c pass) and the full CLI answering the same hit
+from the cache. The budget applies to the time okta-awscli-env adds to a
+bare interpreter start-up, which site hooks of the environment (e.g. .pth
+files of installed packages) can inflate well past it on their own.
+Exits with status 1 when the median hit overhead is over the budget.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from oktaawscli.credential_cache import CredentialCache
+from oktaawscli.credentials_store import CredentialsStore
+
+ROLE_ARN = 'arn:aws:iam::000000000000:role/Admin'
+CONFIG = """[default]
+base-url = example.okta.com
+username = bench
+role = %s
+""" % ROLE_ARN
+STS_TOKEN = {'AccessKeyId': 'ASIABENCH', 'SecretAccessKey': 'secret', 'SessionToken': 'token'}
+
+
+def prepare(home):
+    """ Writes the config, a cached role credential and a ~/.aws/credentials profile under home """
+    with open(os.path.join(home, '.okta-aws'), 'w') as config_file:
+        config_file.write(CONFIG)
+    expires_at = int(time.time()) + 3600
+    previous_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    try:
+        CredentialCache().put(CredentialCache.key_for('example.okta.com', 'bench', ROLE_ARN, None), STS_TOKEN,
+                              expires_at)
+    finally:
+        os.environ['HOME'] = previous_home
+    CredentialsStore(os.path.join(home, '.aws', 'credentials')).update({'bench': {
+        'aws_access_key_id': 'ASIABENCH', 'aws_secret_access_key': 'secret', 'aws_session_token': 'token',
+        'okta_expiration_time': str(expires_at)}})
+
+
+def measure(args, home, runs, expected_status):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        status = subprocess.call(args, env=dict(os.environ, HOME=home), stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+        if status != expected_status:
+            raise SystemExit("%s exited with %d instead of %d" % (' '.join(args), status, expected_status))
+    ordered = sorted(timings)
+    return statistics.median(timings) * 1000, ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] * 1000
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--budget-ms', type=float, default=50)
+    args = parser.parse_args(argv)
+
+    fastpath = [sys.executable, '-m', 'oktaawscli.fastpath']
+    cases = [
+        ('python -c pass', [sys.executable, '-c', 'pass'], 0),
+        ('okta-awscli-env hit', fastpath, 0),
+        ('okta-awscli-env miss', fastpath + ['--okta-profile', 'other'], 3),
+        ('okta-awscli-env --profile', fastpath + ['--profile', 'bench'], 0),
+        ('okta-awscli hit', [sys.executable, '-m', 'oktaawscli.okta_awscli'], 0),
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory() as home:
+        prepare(home)
+        print("%-28s %9s %9s" % ('command', 'p50 ms', 'p99 ms'))
+        for (name, command, status) in cases:
+            results[name] = measure(command, home, args.runs, status)
+            print("%-28s %9.1f %9.1f" % ((name,) + results[name]))
+
+    overhead = results['okta-awscli-env hit'][0] - results['python -c pass'][0]
+    print("okta-awscli-env hit overhead %.1f ms over bare interpreter start-up, budget %.0f ms" %
+          (overhead, args.budget_ms))
+    return 1 if overhead > args.budget_ms else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+""" Benchmark of the critical path between the SAML assertion and written credentials
+
+Usage: python -m benchmarks.bench_post_auth [alias_latency_ms] [sts_latency_ms]
+
+The account alias lookup and STS are simulated with fixed latencies
+(default 300 ms and 200 ms), the saved selected-roles are accepted at the
+prompt and nothing is written to disk. The sequential figure is the old
+order of work: alias lookup, then STS.
+"""
+import base64
+import io
+import logging
+import statistics
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+from oktaawscli.aws_auth import AwsAuth, StsRequest
+from oktaawscli.okta_auth_config import OktaAuthConfig
+from oktaawscli.okta_awscli import assume_selected_roles
+
+RUNS = 5
+
+
+def assertion_for(role_arns):
+    """ Base64 encoded SAML response granting role_arns """
+    values = ''.join('<saml2:AttributeValue>arn:aws:iam::%s:saml-provider/okta,%s</saml2:AttributeValue>' %
+                     (arn.split(':')[4], arn) for arn in role_arns)
+    xml = ('<saml2p:Response xmlns:saml2p="urn:oasis:names:tc:SAML:2.0:protocol">'
+           '<saml2:Assertion xmlns:saml2="urn:oasis:names:tc:SAML:2.0:assertion">'
+           '<saml2:AttributeStatement><saml2:Attribute Name="https://aws.amazon.com/SAML/Attributes/Role">%s'
+           '</saml2:Attribute></saml2:AttributeStatement></saml2:Assertion></saml2p:Response>' % values)
+    return base64.b64encode(xml.encode('utf-8')).decode('ascii')
+
+
+def sequential(aws_auth, okta_auth_config, assertion, logger):
+    roles = aws_auth.available_roles(assertion)
+    aws_auth.account_aliases([assertion], roles)
+    defaults = okta_auth_config.selected_roles_for('default')
+    aws_auth.get_sts_tokens([StsRequest(r.principal_arn, r.role_arn, None) for r in roles if r.role_arn in defaults],
+                            assertion)
+
+
+def pipelined(aws_auth, okta_auth_config, assertion, logger):
+    assume_selected_roles([(MagicMock(assertion_from_cache=False, app_link=None), assertion)], aws_auth, 'default', logger,
+                          okta_auth_config)
+
+
+def measure(run, role_count, alias_latency, sts_latency):
+    logger = logging.getLogger('okta-awscli-bench')
+    role_arns = ['arn:aws:iam::%012d:role/admin' % i for i in range(role_count)]
+    assertion = assertion_for(role_arns)
+    okta_auth_config = OktaAuthConfig(logger, io.StringIO('[default]\nselected-roles = %s\n' % ','.join(role_arns)))
+    aws_auth = AwsAuth('profile', 'default', False, logger)
+
+    def account_aliases(assertions, roles):
+        time.sleep(alias_latency)
+        return {}
+
+    def get_sts_token(role_arn, principal_arn, assertion, duration=None, logger=None):
+        time.sleep(sts_latency)
+        return {'AccessKeyId': role_arn, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                'Expiration': '2999-01-01T00:00:00Z'}
+
+    timings = []
+    with patch.object(aws_auth, 'account_aliases', side_effect=account_aliases), \
+            patch.object(aws_auth, 'get_sts_token', side_effect=get_sts_token), \
+            patch.object(AwsAuth, '_sts_client_for'), \
+            patch.object(aws_auth, 'write_sts_tokens'), \
+            patch.object(okta_auth_config, 'save_chosen_role_for_profile'), \
+            patch.object(AwsAuth, 'choose_roles', return_value=','.join(str(i + 1) for i in range(role_count))), \
+            patch('builtins.print'):
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            run(aws_auth, okta_auth_config, assertion, logger)
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main(args):
+    alias_latency = float(args[0]) / 1000 if args else 0.3
+    sts_latency = float(args[1]) / 1000 if len(args) > 1 else 0.2
+    print("alias lookup %.0f ms, STS %.0f ms" % (alias_latency * 1000, sts_latency * 1000))
+    print("%-8s %14s %14s" % ('roles', 'sequential ms', 'pipelined ms'))
+    for role_count in (1, 5, 20):
+        print("%-8d %14.1f %14.1f" % (role_count,
+                                      measure(sequential, role_count, alias_latency, sts_latency) * 1000,
+                                      measure(pipelined, role_count, alias_latency, sts_latency) * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,84 @@
+""" Micro-benchmark of role extraction, default matching and selection for large assertions
+
+Usage: python -m benchmarks.bench_role_catalog [role_count ...]
+
+The tree-and-regex columns are the previous implementation: a full
+ElementTree of the assertion, two regexes per role, a linear search for the
+predefined role and list membership for the saved selected-roles. Half of
+the roles are saved as selected-roles.
+"""
+import base64
+import re
+import statistics
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from oktaawscli.role_catalog import RoleCatalog, RoleTuple, extract_roles
+
+RUNS = 5
+
+
+def make_assertion(role_count):
+    values = ''.join('<saml2:AttributeValue>arn:aws:iam::%012d:saml-provider/okta,'
+                     'arn:aws:iam::%012d:role/team-%d/Admin</saml2:AttributeValue>' % (i, i, i)
+                     for i in range(role_count))
+    xml = ('<saml2p:Response xmlns:saml2p="urn:oasis:names:tc:SAML:2.0:protocol">'
+           '<saml2:Assertion xmlns:saml2="urn:oasis:names:tc:SAML:2.0:assertion">'
+           '<saml2:AttributeStatement><saml2:Attribute Name="https://aws.amazon.com/SAML/Attributes/Role">%s'
+           '</saml2:Attribute></saml2:AttributeStatement></saml2:Assertion></saml2p:Response>' % values)
+    return base64.b64encode(xml.encode('utf-8')).decode('ascii')
+
+
+def tree_extract(assertion):
+    roles = []
+    root = ET.fromstring(base64.b64decode(assertion))
+    for attribute in root.iter('{urn:oasis:names:tc:SAML:2.0:assertion}Attribute'):
+        if attribute.get('Name') == 'https://aws.amazon.com/SAML/Attributes/Role':
+            for value in attribute.iter('{urn:oasis:names:tc:SAML:2.0:assertion}AttributeValue'):
+                role_arn = re.findall(r'arn:aws:iam::\d{12}:role/[^,]*', value.text)[0]
+                principal_arn = re.findall(r'arn:aws:iam::\d{12}:saml-provider/[^,]*', value.text)[0]
+                roles.append(RoleTuple(principal_arn, role_arn))
+    roles.sort(key=lambda x: x.role_arn)
+    return roles
+
+
+def linear_choose(roles, role_arn, defaults):
+    found = next(filter(lambda role: role.role_arn == role_arn, roles), None)
+    default_idxs = [i for (i, role) in enumerate(roles) if role.role_arn in defaults]
+    return found, default_idxs
+
+
+def catalog_choose(roles, role_arn, defaults):
+    catalog = RoleCatalog(roles)
+    return catalog.select(role_arn), catalog.positions_of(defaults)
+
+
+def median_ms(func, *args):
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main(argv):
+    counts = [int(n) for n in argv] or [100, 1000, 2000, 10000]
+    print("%-7s %14s %15s %16s %17s %14s" % ('roles', 'tree parse ms', 'stream parse ms', 'linear choose ms',
+                                             'catalog choose ms', 'selector ms'))
+    for role_count in counts:
+        assertion = make_assertion(role_count)
+        roles = extract_roles(assertion)
+        assert roles == tree_extract(assertion)
+        defaults = [role.role_arn for role in roles[::2]]
+        target = roles[-1].role_arn
+        catalog = RoleCatalog(roles)
+        print("%-7d %14.2f %15.2f %16.2f %17.2f %14.3f" % (
+            role_count, median_ms(tree_extract, assertion), median_ms(extract_roles, assertion),
+            median_ms(linear_choose, roles, target, defaults), median_ms(catalog_choose, roles, target, defaults),
+            median_ms(catalog.select, '%012d/Adm*' % (role_count - 1))))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+""" Micro-benchmark of SAMLResponse extraction: streaming parser vs BeautifulSoup
+
+Usage: python -m benchmarks.bench_saml_extractor [page.html ...]
+
+Recorded app link pages can be passed on the command line. Without
+arguments, pages shaped like Okta's AWS app link response are generated
+for assertions carrying 1 to 5000 roles. BeautifulSoup is only measured
+when it is installed.
+"""
+import base64
+import statistics
+import sys
+import time
+import tracemalloc
+
+from oktaawscli.saml_extractor import extract_saml_page
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+CHUNK_SIZE = 16384
+RUNS = 5
+
+
+def okta_app_link_page(role_count):
+    """ Generates an app link page whose assertion grants role_count roles """
+    values = ''.join('<saml2:AttributeValue>arn:aws:iam::%012d:saml-provider/okta,'
+                     'arn:aws:iam::%012d:role/team-%d/Role%d</saml2:AttributeValue>' % (i, i, i, i)
+                     for i in range(role_count))
+    assertion = ('<saml2p:Response xmlns:saml2p="urn:oasis:names:tc:SAML:2.0:protocol">'
+                 '<saml2:Assertion xmlns:saml2="urn:oasis:names:tc:SAML:2.0:assertion">'
+                 '<saml2:AttributeStatement><saml2:Attribute Name="https://aws.amazon.com/SAML/Attributes/Role">'
+                 '%s</saml2:Attribute></saml2:AttributeStatement></saml2:Assertion></saml2p:Response>' % values)
+    encoded = base64.b64encode(assertion.encode('utf-8')).decode('ascii')
+    head = ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Amazon Web Services</title>'
+            + '<link rel="stylesheet" href="/assets/css/okta.css">' * 10
+            + '<script>var okta = {locale: "en", deployEnv: "PROD"};</script>' * 20 + '</head>')
+    body = ('<body id="app" class="enduser-app"><div class="content"><form id="appForm" method="POST" '
+            'action="https://signin.aws.amazon.com/saml"><input name="SAMLResponse" type="hidden" value="%s"/>'
+            '<input name="RelayState" type="hidden" value=""/></form></div>' % encoded
+            + '<script>document.getElementById("appForm").submit();</script></body></html>')
+    return head + body
+
+
+def chunked(html):
+    return (html[i:i + CHUNK_SIZE] for i in range(0, len(html), CHUNK_SIZE))
+
+
+def streaming_extract(html):
+    return extract_saml_page(chunked(html)).saml_response
+
+
+def bs4_extract(html):
+    soup = BeautifulSoup(html, "html.parser")
+    for input_tag in soup.find_all('input'):
+        if input_tag.get('name') == 'SAMLResponse':
+            return input_tag.get('value')
+    return None
+
+
+def measure(extract, html):
+    """ Median seconds and peak traced memory in bytes of extract(html) """
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        extract(html)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    extract(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak
+
+
+def main(paths):
+    if paths:
+        pages = []
+        for path in paths:
+            with open(path) as page:
+                pages.append((path, page.read()))
+    else:
+        pages = [("%d roles" % n, okta_app_link_page(n)) for n in (1, 100, 1000, 5000)]
+
+    print("%-16s %10s %14s %14s %14s %14s" % ("page", "size", "stream ms", "stream peak", "bs4 ms", "bs4 peak"))
+    for (name, html) in pages:
+        stream_time, stream_peak = measure(streaming_extract, html)
+        if BeautifulSoup is not None:
+            assert bs4_extract(html) == streaming_extract(html)
+            bs4_time, bs4_peak = measure(bs4_extract, html)
+            bs4_cols = ("%.2f" % (bs4_time * 1000), "%d KiB" % (bs4_peak // 1024))
+        else:
+            bs4_cols = ("n/a", "n/a")
+        print("%-16s %7d KiB %14.2f %10d KiB %14s %14s" % ((name, len(html) // 1024, stream_time * 1000,
+                                                            stream_peak // 1024) + bs4_cols))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+""" Local stand-ins for Okta, AWS STS and the AWS sign-in page, for offline benchmarks
+
+One HTTP/1.1 keep-alive server answers everything okta-awscli calls:
+
+    POST /api/v1/authn                   primary auth, MFA_REQUIRED with a push factor when mfa_polls > 0
+    POST /api/v1/authn/factors/push/verify
+                                         push verification, WAITING for mfa_polls polls
+    POST /api/v1/sessions                session for a session token
+    GET  /api/v1/users/me/appLinks       one amazon_aws app link
+    GET  /home/amazon_aws/<roles>/272    app link page with a SAMLResponse granting <roles> roles
+    POST /sts                            AssumeRoleWithSAML
+    POST /saml                           sign-in page listing an alias for every account of the assertion
+
+Latencies (seconds) are injected per service: 'okta', 'sts' and 'signin'.
+"""
+import base64
+import json
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+STS_RESPONSE = """<AssumeRoleWithSAMLResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleWithSAMLResult>
+    <Credentials>
+      <AccessKeyId>ASIA%012d</AccessKeyId>
+      <SecretAccessKey>secret</SecretAccessKey>
+      <SessionToken>token</SessionToken>
+      <Expiration>2999-01-01T00:00:00Z</Expiration>
+    </Credentials>
+  </AssumeRoleWithSAMLResult>
+</AssumeRoleWithSAMLResponse>"""
+
+
+def role_arn(index):
+    return 'arn:aws:iam::%012d:role/team-%d/Admin' % (index, index)
+
+
+def saml_response(role_count):
+    """ Base64 encoded SAML response granting role_count roles, one per account """
+    values = ''.join('<saml2:AttributeValue>arn:aws:iam::%012d:saml-provider/okta,%s</saml2:AttributeValue>' %
+                     (i, role_arn(i)) for i in range(role_count))
+    xml = ('<saml2p:Response xmlns:saml2p="urn:oasis:names:tc:SAML:2.0:protocol">'
+           '<saml2:Assertion xmlns:saml2="urn:oasis:names:tc:SAML:2.0:assertion">'
+           '<saml2:Subject><saml2:SubjectConfirmation>'
+           '<saml2:SubjectConfirmationData NotOnOrAfter="2999-01-01T00:00:00.000Z"/>'
+           '</saml2:SubjectConfirmation></saml2:Subject>'
+           '<saml2:AttributeStatement><saml2:Attribute Name="https://aws.amazon.com/SAML/Attributes/Role">%s'
+           '</saml2:Attribute></saml2:AttributeStatement></saml2:Assertion></saml2p:Response>' % values)
+    return base64.b64encode(xml.encode('utf-8')).decode('ascii')
+
+
+def app_link_page(role_count):
+    return ('<!DOCTYPE html><html><head><title>Amazon Web Services</title></head><body>'
+            '<form id="appForm" method="POST" action="https://signin.aws.amazon.com/saml">'
+            '<input name="SAMLResponse" type="hidden" value="%s"/><input name="RelayState" type="hidden" value=""/>'
+            '</form></body></html>' % saml_response(role_count))
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle and delayed ACKs add 40 ms per response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # pylint: disable=C0103
+        if self.path == '/api/v1/users/me/appLinks':
+            self.service('okta')
+            self.reply_json([{'appName': 'amazon_aws', 'label': 'AWS', 'sortOrder': 0,
+                              'linkUrl': self.server.base_url + '/home/amazon_aws/1/272'}])
+        elif self.path.startswith('/home/amazon_aws/'):
+            self.service('okta')
+            self.reply(200, self.server.page(int(self.path.split('/')[3])), 'text/html')
+        elif self.path == '/api/v1/sessions/me':
+            self.service('okta')
+            self.reply_json({'id': 'sid'})
+        else:
+            self.reply(404, '', 'text/plain')
+
+    def do_POST(self):
+        # pylint: disable=C0103
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        if self.path == '/api/v1/authn':
+            self.service('okta')
+            if self.server.mfa_polls:
+                verify = self.server.base_url + '/api/v1/authn/factors/push/verify'
+                self.reply_json({'status': 'MFA_REQUIRED', 'stateToken': 'state', '_embedded': {'factors': [
+                    {'factorType': 'push', 'provider': 'OKTA', '_links': {'verify': {'href': verify}}}]}})
+            else:
+                self.reply_json({'status': 'SUCCESS', 'sessionToken': 'token'})
+        elif self.path == '/api/v1/authn/factors/push/verify':
+            self.service('okta')
+            if self.server.poll() < self.server.mfa_polls:
+                self.reply_json({'status': 'MFA_CHALLENGE', 'factorResult': 'WAITING',
+                                 '_links': {'next': {'href': self.server.base_url + self.path}}})
+            else:
+                self.reply_json({'status': 'SUCCESS', 'sessionToken': 'token'})
+        elif self.path == '/api/v1/sessions':
+            self.service('okta')
+            self.reply_json({'id': 'sid', 'expiresAt': '2999-01-01T00:00:00.000Z'})
+        elif self.path == '/sts':
+            self.service('sts')
+            account = parse_qs(body)['RoleArn'][0].split(':')[4]
+            self.reply(200, STS_RESPONSE % int(account), 'text/xml')
+        elif self.path == '/saml':
+            self.service('signin')
+            assertion = base64.b64decode(parse_qs(body)['SAMLResponse'][0]).decode('utf-8')
+            accounts = sorted(set(re.findall(r'arn:aws:iam::(\d{12}):role/', assertion)))
+            self.reply(200, ''.join('<div>Account: alias-%s (%s)</div>' % (a, a) for a in accounts), 'text/html')
+        else:
+            self.reply(404, '', 'text/plain')
+
+    def service(self, name):
+        self.server.count(name)
+        latency = self.server.latency.get(name)
+        if latency:
+            time.sleep(latency)
+
+    def reply_json(self, document):
+        self.reply(200, json.dumps(document), 'application/json')
+
+    def reply(self, status, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServices(socketserver.ThreadingMixIn, HTTPServer):
+    """ The stand-in server, listening on a free loopback port """
+    daemon_threads = True
+
+    def __init__(self, latency=None, mfa_polls=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeServicesHandler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.latency = latency or {}
+        self.mfa_polls = mfa_polls
+        self.requests = {}
+        self._polls = 0
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, service):
+        with self._lock:
+            self.requests[service] = self.requests.get(service, 0) + 1
+
+    def poll(self):
+        """ Number of push polls answered since the last SUCCESS """
+        with self._lock:
+            polls = self._polls
+            self._polls = 0 if polls >= self.mfa_polls else polls + 1
+            return polls
+
+    def page(self, role_count):
+        with self._lock:
+            if role_count not in self._pages:
+                self._pages[role_count] = app_link_page(role_count)
+            return self._pages[role_count]
+
+    def take_counts(self):
+        """ Requests per service since the previous call """
+        with self._lock:
+            counts, self.requests = self.requests, {}
+            return counts
@@ -0,0 +1,175 @@
+""" Long-running agent that keeps role credentials warm and serves them locally """
+import heapq
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from oktaawscli.aws_auth import AwsAuth
+
+
+def iso8601(epoch):
+    """ Formats epoch seconds the way AWS SDKs expect an Expiration """
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class CredentialAgent:
+    """ Refreshes the credentials of named profiles ahead of their expiration.
+
+    refreshers maps a profile name to a callable returning a fresh
+    Credentials dict, or None on failure. Refreshes run on a bounded pool,
+    at expiration - refresh_skew minus a random jitter, so profiles issued
+    together do not all come due at the same moment. """
+
+    RETRY_DELAY = 30
+    MAX_RETRY_DELAY = 600
+
+    def __init__(self, refreshers, logger, refresh_skew=300, max_workers=4, jitter=60):
+        self.refreshers = refreshers
+        self.logger = logger
+        self.refresh_skew = refresh_skew
+        self.jitter = jitter
+        self._credentials = {}
+        self._retry_delays = {}
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stopped = False
+
+    def start(self):
+        """ Fetches every profile once, then starts the refresh scheduler """
+        names = list(self.refreshers)
+        if names:
+            # The first refresh may prompt for a password or MFA; the others reuse its Okta session
+            self.refresh(names[0])
+            wait([self._executor.submit(self.refresh, name) for name in names[1:]])
+        threading.Thread(target=self._run_scheduler, name='okta-awscli-agent', daemon=True).start()
+
+    def stop(self):
+        """ Stops scheduling refreshes """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._executor.shutdown(wait=False)
+
+    def get(self, name):
+        """ Returns the current Credentials dict of a profile, or None if it has none that are valid """
+        with self._condition:
+            entry = self._credentials.get(name)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def refresh(self, name):
+        """ Refreshes one profile now and schedules its next refresh """
+        try:
+            sts_token = self.refreshers[name]()
+        except Exception as ex:  # pylint: disable=W0703
+            self.logger.error("Refreshing %s failed: %s" % (name, ex))
+            sts_token = None
+
+        with self._condition:
+            if sts_token is None:
+                delay = self._retry_delays.get(name, self.RETRY_DELAY / 2.0) * 2
+                self._retry_delays[name] = min(delay, self.MAX_RETRY_DELAY)
+                when = time.time() + self._retry_delays[name]
+                self.logger.warning("Could not refresh %s, retrying in %d seconds" % (name, self._retry_delays[name]))
+            else:
+                self._retry_delays.pop(name, None)
+                expires_at = AwsAuth.expiration_epoch(sts_token['Expiration'])
+                self._credentials[name] = (sts_token, expires_at)
+                when = max(time.time(), expires_at - self.refresh_skew - random.uniform(0, self.jitter))
+                self.logger.info("Credentials of %s refreshed, next refresh in %d seconds" % (name, when - time.time()))
+            heapq.heappush(self._schedule, (when, name))
+            self._condition.notify()
+
+    def _run_scheduler(self):
+        with self._condition:
+            while not self._stopped:
+                now = time.time()
+                while self._schedule and self._schedule[0][0] <= now:
+                    _, name = heapq.heappop(self._schedule)
+                    self._executor.submit(self.refresh, name)
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._condition.wait(timeout)
+
+
+class AgentHTTPHandler(BaseHTTPRequestHandler):
+    """ Serves GET /<profile> in the format of the AWS container credentials provider """
+
+    def do_GET(self):
+        # pylint: disable=C0103
+        if self.server.auth_token and self.headers.get('Authorization') != self.server.auth_token:
+            self._reply(401, {'Error': 'Unauthorized'})
+            return
+        name = self.path.strip('/')
+        sts_token = self.server.agent.get(name)
+        if sts_token is None:
+            self._reply(404, {'Error': 'No credentials for profile %s' % name})
+            return
+        self._reply(200, {
+            'AccessKeyId': sts_token['AccessKeyId'],
+            'SecretAccessKey': sts_token['SecretAccessKey'],
+            'Token': sts_token['SessionToken'],
+            'Expiration': iso8601(AwsAuth.expiration_epoch(sts_token['Expiration'])),
+        })
+
+    def _reply(self, status, document):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AgentSocketHandler(socketserver.StreamRequestHandler):
+    """ Answers a profile name sent as one line with a credential_process JSON document """
+
+    def handle(self):
+        name = self.rfile.readline().decode('utf-8').strip()
+        sts_token = self.server.agent.get(name)
+        if sts_token is None:
+            document = {'Error': 'No credentials for profile %s' % name}
+        else:
+            document = {
+                'Version': 1,
+                'AccessKeyId': sts_token['AccessKeyId'],
+                'SecretAccessKey': sts_token['SecretAccessKey'],
+                'SessionToken': sts_token['SessionToken'],
+                'Expiration': iso8601(AwsAuth.expiration_epoch(sts_token['Expiration'])),
+            }
+        self.wfile.write(json.dumps(document).encode('utf-8') + b'\n')
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(agent, port, auth_token=None):
+    """ Starts the container credentials endpoint on the loopback interface """
+    server = ThreadingHTTPServer(('127.0.0.1', port), AgentHTTPHandler)
+    server.agent = agent
+    server.auth_token = auth_token
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_unix(agent, path):
+    """ Starts the agent socket, accessible by the owner only """
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, AgentSocketHandler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    server.agent = agent
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,44 @@
+""" On-disk cache of AWS account aliases """
+import os
+import time
+
+from oktaawscli.file_util import cache_path, file_lock, read_json, write_json
+
+
+class AccountAliasCache:
+    """ Maps AWS account ids to their alias, each entry expiring after ttl seconds """
+
+    DEFAULT_TTL = 7 * 24 * 3600
+
+    def __init__(self, ttl=None):
+        self.path = cache_path('account-aliases.json')
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+
+    def lookup(self, account_ids, fetch):
+        """ Returns {account_id: alias} for the account ids that have an alias.
+        fetch() is only called when one of account_ids is missing or stale, and
+        must return the {account_id: alias} map of every account it knows. """
+        now = time.time()
+        entries = read_json(self.path) or {}
+        missing = [a for a in account_ids if a not in entries or now - entries[a]['fetched_at'] > self.ttl]
+        if missing:
+            fetched = fetch()
+            with file_lock(self.path):
+                entries = read_json(self.path) or {}
+                # Accounts without an alias are cached too, so they don't trigger a lookup every run
+                for account_id in missing:
+                    entries[account_id] = {'alias': None, 'fetched_at': now}
+                for (account_id, alias) in fetched.items():
+                    entries[account_id] = {'alias': alias, 'fetched_at': now}
+                write_json(self.path, entries)
+        return {a: entries[a]['alias'] for a in account_ids if a in entries and entries[a]['alias']}
+
+    def known(self, account_ids):
+        """ Returns the cached {account_id: alias} of account_ids, however old, without fetching """
+        entries = read_json(self.path) or {}
+        return {a: entries[a]['alias'] for a in account_ids if a in entries and entries[a]['alias']}
+
+    def invalidate(self):
+        """ Forgets every cached alias """
+        if os.path.exists(self.path):
+            os.remove(self.path)
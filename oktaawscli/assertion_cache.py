@@ -0,0 +1,72 @@
+""" On-disk cache of SAML assertions, reused until shortly before they expire """
+import base64
+import hashlib
+import os
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+from oktaawscli.file_util import cache_path, file_lock, read_json, write_json
+
+SAML2_ASSERTION_NS = '{urn:oasis:names:tc:SAML:2.0:assertion}'
+
+# STS error codes meaning the assertion itself was refused, e.g. because it was reused or expired
+REJECTED_ASSERTION_ERRORS = ('ExpiredTokenException', 'IDPRejectedClaim', 'InvalidIdentityToken')
+
+
+class SamlAssertionCache:
+    """ Caches the SAML assertion of a base url, app link and user """
+
+    # Assertions expiring within this many seconds are not reused
+    EXPIRY_SKEW = 30
+
+    def __init__(self, base_url, app_link, username, max_uses=None):
+        key = hashlib.sha256(("%s\n%s\n%s" % (base_url, app_link, username)).encode('utf-8')).hexdigest()
+        self.path = cache_path('assertions', key + '.json')
+        self.max_uses = max_uses
+
+    def load(self):
+        """ Returns the cached assertion, or None if it expired or is used up """
+        cached = read_json(self.path)
+        if not cached or cached.get('not_on_or_after', 0) - time.time() <= self.EXPIRY_SKEW:
+            return None
+        if self.max_uses and cached.get('uses', 0) >= self.max_uses:
+            return None
+        return cached.get('assertion')
+
+    def save(self, assertion):
+        """ Caches an assertion if it carries a NotOnOrAfter condition """
+        not_on_or_after = self.not_on_or_after(assertion)
+        if not_on_or_after is None:
+            return
+        write_json(self.path, {'assertion': assertion, 'not_on_or_after': not_on_or_after, 'uses': 0})
+
+    def record_use(self, count=1):
+        """ Counts AssumeRoleWithSAML calls made with the cached assertion """
+        with file_lock(self.path):
+            cached = read_json(self.path)
+            if cached:
+                cached['uses'] = cached.get('uses', 0) + count
+                write_json(self.path, cached)
+
+    def evict(self):
+        """ Forgets the cached assertion """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def not_on_or_after(assertion):
+        """ Earliest NotOnOrAfter of the Conditions and SubjectConfirmationData
+        elements of a base64 encoded assertion, in epoch seconds """
+        try:
+            root = ET.fromstring(base64.b64decode(assertion))
+        except (ValueError, ET.ParseError):
+            return None
+        limits = []
+        for tag in ('Conditions', 'SubjectConfirmationData'):
+            for element in root.iter(SAML2_ASSERTION_NS + tag):
+                value = element.get('NotOnOrAfter')
+                if value:
+                    expiration = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+                    limits.append(int(expiration.replace(tzinfo=timezone.utc).timestamp()))
+        return min(limits) if limits else None
@@ -1,65 +1,154 @@
 """ AWS authentication """
 # pylint: disable=C0325
 import os
-import base64
-import xml.etree.ElementTree as ET
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from configparser import RawConfigParser
-import boto3
-from botocore.exceptions import ClientError
 import re
-import requests
 import time
 
+from oktaawscli import timings
+from oktaawscli.alias_cache import AccountAliasCache
+from oktaawscli.config_store import ConfigStore
+from oktaawscli.credentials_store import CredentialsStore
+from oktaawscli.okta_auth_config import OktaAuthConfig
+from oktaawscli.role_catalog import RoleCatalog, account_id_of, extract_roles, needs_aliases, role_name_of
+from oktaawscli.role_duration_cache import DURATION_STEPS, MAX_DURATION, RoleDurationCache, next_duration
+from oktaawscli.sts_client import StsClient, StsError
+from oktaawscli.transport import default_transport
+
+StsRequest = namedtuple("StsRequest", ["principal_arn", "role_arn", "duration"])
+StsResult = namedtuple("StsResult", ["request", "credentials", "error"])
+OptionTuple = namedtuple("OptionTuple", ["option_text", "alias_name", "role_name"])
+
+DURATION_LIMIT = re.compile(r'less than or equal to (\d+)')
+
+
+def is_sts_error(error):
+    """ Whether error is an error response from STS: a StsError of the built-in
+    client or a botocore ClientError, recognised without importing botocore """
+    return isinstance(error, StsError) or any(
+        cls.__module__ == 'botocore.exceptions' and cls.__name__ == 'ClientError' for cls in type(error).__mro__)
+
+
+def is_duration_error(error):
+    """ Whether error is STS refusing the requested DurationSeconds, e.g. for
+    exceeding the MaxSessionDuration of the role """
+    if not is_sts_error(error):
+        return False
+    details = error.response['Error']
+    return details.get('Code') == 'ValidationError' and 'durationseconds' in details.get('Message', '').lower()
+
+
+def duration_limit(error):
+    """ The maximum duration stated by a duration error, or None. Only
+    validation of the STS limits states it; MaxSessionDuration is not. """
+    match = DURATION_LIMIT.search(error.response['Error'].get('Message', '')) if is_sts_error(error) else None
+    return int(match.group(1)) if match else None
+
 
 class AwsAuth:
     """ Methods to support AWS authentication using STS """
 
-    def __init__(self, profile, okta_profile, verbose, logger):
+    # Upper bound on concurrent AssumeRoleWithSAML calls in get_sts_tokens
+    MAX_STS_WORKERS = 10
+
+    # One STS client per backend, partition and endpoint, shared by every thread of this process
+    _sts_clients = {}
+    _sts_clients_lock = threading.Lock()
+
+    # Seconds before expiration at which cached credentials are refreshed
+    DEFAULT_REFRESH_SKEW = 300
+
+    # AWS sign-in endpoint receiving the SAML assertion; its page lists the account aliases
+    DEFAULT_SIGNIN_URL = 'https://signin.aws.amazon.com/saml'
+
+    def __init__(self, profile, okta_profile, verbose, logger, verify_remote=False, refresh_aliases=False,
+                 config_store=None):
         home_dir = os.path.expanduser('~')
         self.creds_dir = os.path.join(home_dir, ".aws")
         self.creds_file = os.path.join(self.creds_dir, "credentials")
+        self.credentials_store = CredentialsStore(self.creds_file)
         self.profile = profile
         self.verbose = verbose
         self.logger = logger
         self.role = ""
+        self.account = None
+        self.verify_remote = verify_remote
+        self.refresh_skew = self.DEFAULT_REFRESH_SKEW
+        self.refresh_aliases = refresh_aliases
 
-        okta_config = os.path.join(home_dir, '.okta-aws')
-        parser = RawConfigParser()
-        parser.read(okta_config)
+        config_store = config_store or ConfigStore.for_path(os.path.join(home_dir, '.okta-aws'))
+        okta_auth_config = OktaAuthConfig(logger, store=config_store, setup=False)
 
-        if parser.has_option(okta_profile, 'role'):
-            self.role = parser.get(okta_profile, 'role')
+        role = okta_auth_config.role_for(okta_profile)
+        if role:
+            self.role = role
             self.logger.debug("Setting AWS role to %s" % self.role)
+        refresh_skew = okta_auth_config.refresh_skew_for(okta_profile)
+        if refresh_skew is not None:
+            self.refresh_skew = refresh_skew
+        self.alias_cache_ttl = okta_auth_config.alias_cache_ttl_for(okta_profile)
+        self.sts_backend = okta_auth_config.sts_backend_for(okta_profile)
+        self.sts_region = okta_auth_config.sts_region_for(okta_profile)
+        self.sts_endpoint = okta_auth_config.sts_endpoint_for(okta_profile)
+        self.signin_url = okta_auth_config.signin_url_for(okta_profile, self.DEFAULT_SIGNIN_URL)
 
-    def choose_aws_role(self, assertion, defaults):
-        """ Choose AWS role from SAML assertion """
-        roles = self.__extract_available_roles_from(assertion)
-        if self.role:
-            predefined_role = self.__find_predefiend_role_from(roles)
-            if predefined_role:
-                self.logger.info("Using predefined role: %s" % self.role)
-                return predefined_role
-            else:
-                self.logger.info("""Predefined role, %s, not found in the list of roles assigned to you.""" % self.role)
+    def choose_aws_role(self, assertion, defaults, roles=None, aliases=None):
+        """ Choose AWS roles from SAML assertion, returns a list of (role, option).
+        roles are the roles of the assertion when already parsed, and aliases a
+        callable returning the account alias map, for callers that look the
+        aliases up themselves. The predefined role, an ARN or a selector, and
+        the account narrow the choice down; a single match is used without
+        prompting. """
+        catalog = RoleCatalog(self.available_roles(assertion) if roles is None else roles)
+        lookup = aliases or (lambda: self.account_aliases([assertion], catalog.roles))
+        alias_map = None
+        selected = None
+        if self.role or self.account:
+            if needs_aliases(self.role, self.account):
+                alias_map = lookup()
+                catalog.set_aliases(alias_map)
+            selected = catalog.select(self.role, self.account)
+            if len(selected) == 1:
+                role = catalog.roles[selected[0]]
+                self.logger.info("Using predefined role: %s" % role.role_arn)
+                if alias_map is None:
+                    alias_map = aliases() if aliases else {}
+                return [(role, self.__create_options_from([role], alias_map)[0])]
+            elif not selected:
+                self.logger.info("""Predefined role, %s, not found in the list of roles assigned to you."""
+                                 % (self.role or self.account))
                 self.logger.info("Please choose a role.")
+                selected = None
 
-        alias_map = self.__get_account_alias(assertion)
-        role_options = self.__create_options_from(roles, alias_map)
-        default_idxs = [r for (r, i) in enumerate(roles) if i[1] in defaults]
+        if alias_map is None:
+            alias_map = lookup()
+        menu = catalog.roles if selected is None else [catalog.roles[position] for position in selected]
+        role_options = self.__create_options_from(menu, alias_map)
+        default_arns = set(defaults)
+        default_idxs = [i for (i, role) in enumerate(menu) if role.role_arn in default_arns]
         idx_display = ','.join(map(lambda x: str(x + 1), default_idxs))
         role_choice = AwsAuth.choose_roles(role_options, idx_display, default_idxs)
 
-        if len(role_choice) == 1:
-            return [(roles[int(role_choice) - 1], role_options[int(role_choice) - 1])]
-        else:
-            choices = [int(r.strip()) - 1 for r in role_choice.split(",")]
-            return [(roles[c], role_options[c]) for c in choices]
+        choices = [int(r.strip()) - 1 for r in role_choice.split(",")]
+        return [(menu[c], role_options[c]) for c in choices]
+
+    def available_roles(self, assertion):
+        """ The (principal_arn, role_arn) tuples granted by a SAML assertion, sorted by role ARN """
+        return extract_roles(assertion)
+
+    def find_role(self, assertion, role_arn):
+        """ Returns the role of the SAML assertion with the given role ARN, or None """
+        roles = self.available_roles(assertion)
+        return next((role for role in roles if role.role_arn == role_arn), None)
 
     @staticmethod
+    @timings.timed('prompt.role', timings.HUMAN)
     def choose_roles(role_options, idx_display, default_idxs):
-        for option in role_options:
-            print(option.option_text)
+        print('\n'.join(option.option_text for option in role_options))
         while True:
             role_choice = input('Please select one more or AWS roles [{}]:  '.format(idx_display))
             if len(role_choice) <= 0 and len(default_idxs) >= 1:
@@ -68,42 +157,122 @@ class AwsAuth:
                 return role_choice
             print("You did not make a selection, please choose an option.")
 
-    @staticmethod
-    def __get_account_alias(assertion):
+    def account_aliases(self, assertions, roles):
+        """ Returns the aliases of the accounts of roles, from the alias cache when possible.
+        The sign-in page of each SAML assertion lists the aliases of the accounts it grants. """
+        alias_cache = AccountAliasCache(self.alias_cache_ttl)
+        if self.refresh_aliases:
+            alias_cache.invalidate()
+            self.refresh_aliases = False
+        account_ids = sorted(set(role.role_arn.split(':')[4] for role in roles))
+        return alias_cache.lookup(account_ids, lambda: self.__get_account_aliases(assertions))
+
+    def __get_account_aliases(self, assertions):
+        if len(assertions) == 1:
+            return self.__get_account_alias(assertions[0])
+        alias_map = {}
+        with ThreadPoolExecutor(max_workers=min(len(assertions), self.MAX_STS_WORKERS)) as executor:
+            for aliases in executor.map(self.__get_account_alias, assertions):
+                alias_map.update(aliases)
+        return alias_map
+
+    @timings.timed('aws.account_aliases')
+    def __get_account_alias(self, assertion):
         """ Find the alias for accounts """
-        response = requests.post('https://signin.aws.amazon.com/saml', data={'SAMLResponse': assertion})
+        session = default_transport().new_session()
+        response = session.post(self.signin_url, data={'SAMLResponse': assertion})
         accounts = re.findall(r'Account: ([^\s]+) \((\d{12})\)', response.text)
         return {tup[1]: tup[0] for tup in accounts}
 
-    @staticmethod
-    def get_sts_token(role_arn, principal_arn, assertion, duration=None, logger=None):
-        """ Gets a token from AWS STS """
+    def _sts_client_for(self, principal_arn):
+        """ Returns the shared STS client for the partition of principal_arn """
+        partition = principal_arn.split(':')[1]
+        key = (self.sts_backend, partition, self.sts_region, self.sts_endpoint)
+        with self._sts_clients_lock:
+            if key not in self._sts_clients:
+                self._sts_clients[key] = self.__new_sts_client(partition)
+            return self._sts_clients[key]
 
-        # Connect to the GovCloud STS endpoint if a GovCloud ARN is found.
-        arn_region = principal_arn.split(':')[1]
-        if arn_region == 'aws-us-gov':
-            sts = boto3.client('sts', region_name='us-gov-west-1')
-        else:
-            sts = boto3.client('sts')
+    def __new_sts_client(self, partition):
+        if self.sts_backend == 'boto3':
+            import boto3
+            # Connect to the GovCloud STS endpoint if a GovCloud ARN is found.
+            region = self.sts_region
+            if partition == 'aws-us-gov' and not (region or '').startswith('us-gov-'):
+                region = 'us-gov-west-1'
+            return boto3.client('sts', region_name=region, endpoint_url=self.sts_endpoint)
 
-        try:
-            response = sts.assume_role_with_saml(RoleArn=role_arn,
-                                                 PrincipalArn=principal_arn,
-                                                 SAMLAssertion=assertion,
-                                                 DurationSeconds=duration or 3600)
-        except ClientError as ex:
-            if logger:
-                logger.error(
-                    "Could not retrieve credentials: %s" %
-                    ex.response['Error']['Message']
-                )
-                exit(-1)
-            else:
-                raise
+        endpoint = self.sts_endpoint or StsClient.endpoint_for(partition, self.sts_region)
+        self.logger.debug("Using STS endpoint %s" % endpoint)
+        return StsClient(endpoint)
+
+    def get_sts_token(self, role_arn, principal_arn, assertion, duration=None, logger=None):
+        """ Gets a token from AWS STS. A duration of MAX_DURATION requests the
+        longest session the role allows: the duration learned for the role,
+        else 12 hours, stepping down each time STS refuses the duration. """
+        sts = self._sts_client_for(principal_arn)
+
+        adaptive = duration == MAX_DURATION
+        if adaptive:
+            duration_cache = RoleDurationCache()
+            learned = duration_cache.get(role_arn)
+            duration = learned or DURATION_STEPS[0]
+
+        while True:
+            try:
+                with timings.span('sts.assume_role', role=role_arn):
+                    response = sts.assume_role_with_saml(RoleArn=role_arn,
+                                                         PrincipalArn=principal_arn,
+                                                         SAMLAssertion=assertion,
+                                                         DurationSeconds=duration or 3600)
+                break
+            except Exception as ex:  # pylint: disable=W0703
+                lower = next_duration(duration, duration_limit(ex)) if adaptive and is_duration_error(ex) else None
+                if lower is not None:
+                    self.logger.info("Role %s does not allow a duration of %d seconds, requesting %d seconds."
+                                     % (role_arn, duration, lower))
+                    duration = lower
+                elif logger and is_sts_error(ex):
+                    logger.error("Could not retrieve credentials: %s" % self.sts_error_message(ex))
+                    exit(-1)
+                else:
+                    raise
 
+        if adaptive and duration != learned:
+            duration_cache.save(role_arn, duration)
         credentials = response['Credentials']
         return credentials
 
+    def get_sts_tokens(self, sts_requests, assertion, max_workers=None):
+        """ Assumes every requested role concurrently with one SAML assertion.
+        Returns one StsResult per request, in request order. Failures are
+        reported in StsResult.error instead of aborting the whole batch. """
+        if not sts_requests:
+            return []
+
+        # Create the per-partition clients up front, client creation is not thread safe
+        for request in sts_requests:
+            self._sts_client_for(request.principal_arn)
+
+        def assume(request):
+            try:
+                credentials = self.get_sts_token(request.role_arn, request.principal_arn,
+                                                 assertion, duration=request.duration)
+                return StsResult(request, credentials, None)
+            except Exception as ex:  # pylint: disable=W0703
+                return StsResult(request, None, ex)
+
+        workers = min(len(sts_requests), max_workers or self.MAX_STS_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(assume, sts_requests))
+
+    @staticmethod
+    def sts_error_message(error):
+        """ Human readable message for an error recorded in a StsResult """
+        if is_sts_error(error):
+            return error.response['Error']['Message']
+        return str(error)
+
     def check_sts_token(self, profile):
         """ Verifies that STS credentials are valid """
         # Don't check for creds if profile is blank
@@ -125,6 +294,44 @@ class AwsAuth:
             self.logger.info("No existing credentials found. Requesting new credentials.")
             return False
 
+        if self.verify_remote:
+            return self.__verify_remote(profile)
+
+        if not parser.has_option(profile, 'okta_expiration_time'):
+            self.logger.info("No expiration recorded for the profile. Verifying credentials with STS.")
+            return self.__verify_remote(profile)
+
+        try:
+            expiration = int(parser.get(profile, 'okta_expiration_time'))
+        except ValueError:
+            self.logger.info("Recorded expiration is not valid. Requesting new credentials.")
+            return False
+
+        if expiration - time.time() <= self.refresh_skew:
+            self.logger.info("Temporary credentials have expired or expire soon. Requesting new credentials.")
+            return False
+
+        self.logger.info("STS credentials are valid. Nothing to do.")
+        return True
+
+    def written_credentials(self, profile):
+        """ The (okta_login_time, aws_access_key_id) of the credentials written to profile,
+        or None. It changes whenever the credentials of profile are written again. """
+        parser = self.credentials_store.read()
+        if not parser.has_section(profile):
+            return None
+        return (parser.get(profile, 'okta_login_time', fallback=None),
+                parser.get(profile, 'aws_access_key_id', fallback=None))
+
+    def __verify_remote(self, profile):
+        """ Verifies credentials by calling sts:GetCallerIdentity with them """
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            self.logger.warning("Remote verification needs boto3 (pip install \"okta-awscli[boto3]\"). "
+                                "Requesting new credentials.")
+            return False
         session = boto3.Session(profile_name=profile)
         sts = session.client('sts')
         try:
@@ -138,51 +345,47 @@ class AwsAuth:
         self.logger.info("STS credentials are valid. Nothing to do.")
         return True
 
+    @staticmethod
+    def expiration_epoch(expiration):
+        """ Converts a Credentials Expiration (datetime or UTC ISO 8601 string) to epoch seconds """
+        if isinstance(expiration, str):
+            expiration = datetime.strptime(expiration[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+        return int(expiration.timestamp())
+
     def write_sts_token(self, profile, access_key_id, secret_access_key, session_token):
         """ Writes STS auth information to credentials file """
-        if not os.path.exists(self.creds_dir):
-            os.makedirs(self.creds_dir)
-        config = RawConfigParser()
-
-        if os.path.isfile(self.creds_file):
-            config.read(self.creds_file)
-
-        if not config.has_section(profile):
-            config.add_section(profile)
+        self.write_sts_tokens({profile: {'AccessKeyId': access_key_id,
+                                         'SecretAccessKey': secret_access_key,
+                                         'SessionToken': session_token}})
 
-        config.set(profile, 'aws_access_key_id', access_key_id)
-        config.set(profile, 'aws_secret_access_key', secret_access_key)
-        config.set(profile, 'aws_session_token', session_token)
-        config.set(profile, 'okta_login_time', str(int(time.time())))
+    @timings.timed('aws.write_credentials')
+    def write_sts_tokens(self, sts_tokens):
+        """ Writes the STS credentials of several profiles with a single update
+        of the credentials file. sts_tokens maps a profile name to the
+        Credentials dict returned by get_sts_token. """
+        login_time = str(int(time.time()))
+        profiles = {}
+        for (profile, sts_token) in sts_tokens.items():
+            profiles[profile] = {
+                'aws_access_key_id': sts_token['AccessKeyId'],
+                'aws_secret_access_key': sts_token['SecretAccessKey'],
+                'aws_session_token': sts_token['SessionToken'],
+                'okta_login_time': login_time,
+            }
+            if 'Expiration' in sts_token:
+                profiles[profile]['okta_expiration_time'] = str(self.expiration_epoch(sts_token['Expiration']))
+        self.credentials_store.update(profiles)
 
-        with open(self.creds_file, 'w+') as configfile:
-            config.write(configfile)
-        self.logger.info("Temporary credentials written to profile: %s" % profile)
-        self.logger.info("Invoke using: aws --profile %s <service> <command>" % profile)
-
-    @staticmethod
-    def __extract_available_roles_from(assertion):
-        aws_attribute_role = 'https://aws.amazon.com/SAML/Attributes/Role'
-        attribute_value_urn = '{urn:oasis:names:tc:SAML:2.0:assertion}AttributeValue'
-        roles = []
-        root = ET.fromstring(base64.b64decode(assertion))
-        role_tuple = namedtuple("RoleTuple", ["principal_arn", "role_arn"])
-        for saml2attribute in root.iter('{urn:oasis:names:tc:SAML:2.0:assertion}Attribute'):
-            if saml2attribute.get('Name') == aws_attribute_role:
-                for attrvalue in saml2attribute.iter(attribute_value_urn):
-                    # Role and Principal arns can be in any order and/or from separate accounts.
-                    role_arn = re.findall(r'arn:aws:iam::\d{12}:role/[^,]*', attrvalue.text)[0]
-                    principal_arn = re.findall(r'arn:aws:iam::\d{12}:saml-provider/[^,]*', attrvalue.text)[0]
-                    roles.append(role_tuple(principal_arn, role_arn))
-        roles.sort(key=lambda x: x.role_arn)
-        return roles
+        for profile in sts_tokens:
+            self.logger.info("Temporary credentials written to profile: %s" % profile)
+            self.logger.info("Invoke using: aws --profile %s <service> <command>" % profile)
 
     @staticmethod
     def __create_options_from(roles, alias_map):
         options = []
-        option_tuple = namedtuple("OptionTuple", ["option_text", "alias_name", "role_name"])
         for index, role in enumerate(roles):
-            (account_number, role_name) = re.findall(r'arn:aws:iam::(\d{12}):role.*/([^/]+)$', role.role_arn)[0]
+            account_number = account_id_of(role.role_arn)
+            role_name = role_name_of(role.role_arn)
             if account_number in alias_map:
                 role_text = "%d: %-15s (%s)" % (index + 1, alias_map[account_number], role.role_arn)
                 alias_name = alias_map[account_number]
@@ -190,9 +393,5 @@ class AwsAuth:
                 role_text = "%d: %s" % (index + 1, role.role_arn)
                 alias_name = account_number
 
-            options.append(option_tuple(role_text, alias_name, role_name))
+            options.append(OptionTuple(role_text, alias_name, role_name))
         return options
-
-    def __find_predefiend_role_from(self, roles):
-        found_roles = filter(lambda role_tuple: role_tuple.role_arn == self.role, roles)
-        return next(iter(found_roles), None)
@@ -0,0 +1,106 @@
+""" Refreshes the credentials of many okta profiles with one Okta login per user """
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from oktaawscli.aws_auth import AwsAuth, StsRequest
+
+LoginTarget = namedtuple("LoginTarget", ["okta_profile", "aws_profile", "role_arn", "aws_auth", "okta"])
+
+
+def login_profiles(okta_profiles, verbose, logger, totp_token, okta_auth_config, force=False):
+    """ Gets credentials for every okta profile and writes them to its aws-profile.
+
+    Profiles are grouped by Okta user (base-url and username). Each group
+    logs in and completes MFA once, then fetches the assertion of every
+    distinct app link concurrently on that session. Finally the roles of all
+    groups are assumed in parallel and written with a single update of the
+    credentials file. Returns the exit code. """
+    from oktaawscli.okta_auth import OktaAuth
+    from oktaawscli.okta_awscli import assume_roles
+
+    targets = []
+    failed = 0
+    for okta_profile in okta_profiles:
+        role_arn = okta_auth_config.role_for(okta_profile)
+        if not role_arn:
+            logger.error("No role for okta profile %s, skipping it." % okta_profile)
+            failed += 1
+            continue
+        aws_profile = okta_auth_config.aws_profile_for(okta_profile)
+        aws_auth = AwsAuth(aws_profile, okta_profile, verbose, logger)
+        if not force and aws_auth.check_sts_token(aws_profile):
+            continue
+        okta = OktaAuth(okta_profile, verbose, logger, totp_token, okta_auth_config)
+        targets.append(LoginTarget(okta_profile, aws_profile, role_arn, aws_auth, okta))
+    if not targets:
+        return 1 if failed else 0
+
+    groups = {}
+    for target in targets:
+        groups.setdefault((target.okta.https_base_url, target.okta.username), []).append(target)
+
+    # One OktaAuth per distinct app link fetches the assertion shared by its profiles
+    assertions = []
+    for (user, group) in groups.items():
+        logger.info("Getting SAML assertions for %d profiles of %s at %s" % (len(group), user[1], user[0]))
+        assertions.extend(fetch_assertions(group, okta_auth_config))
+
+    with ThreadPoolExecutor(max_workers=len(assertions)) as executor:
+        futures = []
+        for (okta, assertion, link_targets) in assertions:
+            sts_requests = []
+            for target in link_targets:
+                role = target.aws_auth.find_role(assertion, target.role_arn)
+                if role is None:
+                    logger.error("Role %s of okta profile %s is not assigned to you." %
+                                 (target.role_arn, target.okta_profile))
+                    continue
+                sts_requests.append((target, StsRequest(role.principal_arn, role.role_arn,
+                                                        okta_auth_config.duration_for(target.okta_profile))))
+            if sts_requests:
+                futures.append((sts_requests, executor.submit(
+                    assume_roles, okta, link_targets[0].aws_auth, [r for (_, r) in sts_requests], assertion, logger)))
+
+    sts_tokens = {}
+    for (sts_requests, future) in futures:
+        for ((target, _), result) in zip(sts_requests, future.result()):
+            if result.error is not None:
+                logger.error("Could not retrieve credentials for okta profile %s: %s" %
+                             (target.okta_profile, AwsAuth.sts_error_message(result.error)))
+                continue
+            sts_tokens[target.aws_profile] = result.credentials
+
+    if sts_tokens:
+        targets[0].aws_auth.write_sts_tokens(sts_tokens)
+    return 0 if not failed and len(sts_tokens) == len(targets) else 1
+
+
+def fetch_assertions(group, okta_auth_config):
+    """ Gets the SAML assertion of every app link used by a group of targets of
+    the same Okta user. Returns a list of (okta, assertion, targets), one per app link. """
+    by_link = {}
+    for target in group:
+        by_link.setdefault(target.okta.app_link, []).append(target)
+    # Profiles without an app link resolve it one at a time, as it may prompt for the app
+    links = {link: targets[0].okta for (link, targets) in by_link.items() if link}
+    unresolved = by_link.get(None, [])
+
+    leader = None
+    if unresolved or not all(okta.has_cached_assertion() for okta in links.values()):
+        leader = group[0].okta
+        leader.open_session()
+    for target in unresolved:
+        target.okta.join_session(leader.session_id)
+        _, app_link = target.okta.get_apps(leader.session_id)
+        okta_auth_config.save_chosen_app_link_for_profile(target.okta_profile, app_link)
+        target.okta.app_link = app_link
+        by_link.setdefault(app_link, []).append(target)
+        links.setdefault(app_link, target.okta)
+    by_link.pop(None, None)
+
+    for okta in links.values():
+        if leader is not None and okta is not leader and not okta.session_id:
+            okta.join_session(leader.session_id)
+    with ThreadPoolExecutor(max_workers=len(links)) as executor:
+        assertions = executor.map(lambda okta: okta.get_assertion()[1], links.values())
+        return [(okta, assertion, by_link[link]) for ((link, okta), assertion) in zip(links.items(), assertions)]
@@ -0,0 +1,77 @@
+""" Shared store of the ~/.okta-aws config file with write-behind of changes """
+import atexit
+import io
+import os
+import threading
+from configparser import RawConfigParser
+
+from oktaawscli import timings
+from oktaawscli.file_util import atomic_write, file_lock
+
+
+class ConfigStore:
+    """ The config file parsed once per process and shared by every component.
+
+    set() changes the parsed config in memory and records the change.
+    commit() writes all recorded changes in one locked read-modify-write
+    cycle on top of the file as it currently is on disk, so concurrent runs
+    keep each other's changes. Stores returned by for_path() commit
+    themselves when the process exits. """
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path=None, file_handle=None):
+        self.path = path
+        self.parser = RawConfigParser()
+        if file_handle is not None:
+            self.parser.read_file(file_handle)
+        elif path and os.path.exists(path):
+            self.parser.read(path)
+        self._changes = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def for_path(cls, path=None):
+        """ The shared store of a config file, ~/.okta-aws by default """
+        path = path or os.path.join(os.path.expanduser('~'), '.okta-aws')
+        with cls._stores_lock:
+            if path not in cls._stores:
+                store = cls._stores[path] = cls(path)
+                atexit.register(store.commit)
+            return cls._stores[path]
+
+    @property
+    def dirty(self):
+        """ Whether there are changes that have not been committed """
+        return bool(self._changes)
+
+    def set(self, section, option, value):
+        """ Sets an option in memory. Setting the current value is not a change. """
+        with self._lock:
+            if self.parser.has_option(section, option) and self.parser.get(section, option) == value:
+                return
+            if not self.parser.has_section(section):
+                self.parser.add_section(section)
+            self.parser.set(section, option, value)
+            self._changes[(section, option)] = value
+
+    def commit(self):
+        """ Writes the recorded changes to the file. Returns whether it was written. """
+        with self._lock:
+            if not self._changes or not self.path:
+                return False
+            with timings.span('config.commit'), file_lock(self.path):
+                parser = RawConfigParser()
+                if os.path.exists(self.path):
+                    parser.read(self.path)
+                for ((section, option), value) in self._changes.items():
+                    if not parser.has_section(section):
+                        parser.add_section(section)
+                    parser.set(section, option, value)
+                buf = io.StringIO()
+                parser.write(buf)
+                atomic_write(self.path, buf.getvalue())
+            self.parser = parser
+            self._changes = {}
+            return True
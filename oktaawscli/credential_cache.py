@@ -0,0 +1,114 @@
+""" On-disk cache of STS credentials, encrypted at rest when a key is available """
+import base64
+import hashlib
+import json
+import os
+import time
+
+from oktaawscli.file_util import cache_path, read_json, write_json
+
+# Secret the cache encryption key is derived from. Without it, a key kept in the OS keyring is used.
+KEY_ENV = 'OKTA_AWSCLI_CACHE_KEY'
+KEYRING_SERVICE = 'okta-awscli'
+KEYRING_USERNAME = 'credential-cache-key'
+
+
+def cache_cipher():
+    """ The Fernet encrypting cached credentials, or None when the optional
+    cryptography package is missing or no key is available. The key is
+    derived from the OKTA_AWSCLI_CACHE_KEY secret, otherwise it is kept in
+    the OS keyring (needs the optional keyring package), created on first use.
+    Both packages are only imported here, so reading plain entries stays cheap. """
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        return None
+
+    secret = os.environ.get(KEY_ENV)
+    if secret:
+        return Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode('utf-8')).digest()))
+    try:
+        import keyring
+        from keyring.errors import KeyringError
+    except ImportError:
+        return None
+    try:
+        key = keyring.get_password(KEYRING_SERVICE, KEYRING_USERNAME)
+        if key is None:
+            key = Fernet.generate_key().decode('ascii')
+            keyring.set_password(KEYRING_SERVICE, KEYRING_USERNAME, key)
+        return Fernet(key.encode('ascii'))
+    except (KeyringError, ValueError):
+        return None
+
+
+class CredentialCache:
+    """ Caches the STS credentials of a role until shortly before they expire.
+
+    Every key has its own small file, named after a hash of the key and
+    spread over 256 directories, so a lookup reads one file however many
+    credentials are cached. The expiration is stored in the clear next to
+    the credentials, which are encrypted when a cipher is given.
+    cipher_factory, e.g. cache_cipher, is only called once a cipher is
+    needed, so reading plain entries never loads cryptography. """
+
+    def __init__(self, refresh_skew=300, cipher=None, cipher_factory=None):
+        self.refresh_skew = refresh_skew
+        self.cipher = cipher
+        self.cipher_factory = cipher_factory
+
+    @staticmethod
+    def key_for(base_url, username, role_arn, duration):
+        """ Key of the credentials of a role assumed by an Okta user for duration seconds """
+        return (base_url, username, role_arn, duration or '')
+
+    @staticmethod
+    def path_for(key):
+        """ Cache file of a key, a tuple of strings identifying the role credentials """
+        digest = hashlib.sha256('\n'.join(str(part) for part in key).encode('utf-8')).hexdigest()
+        return cache_path('credentials', digest[:2], digest + '.json')
+
+    def get(self, key):
+        """ Returns the cached credentials of key, or None if they are missing, expire soon
+        or cannot be decrypted """
+        cached = read_json(self.path_for(key))
+        if not cached or cached.get('expires_at', 0) - time.time() <= self.refresh_skew:
+            return None
+        if 'encrypted' not in cached:
+            return cached.get('credentials')
+        if self._cipher() is None:
+            return None
+        try:
+            return json.loads(self.cipher.decrypt(cached['encrypted'].encode('ascii')).decode('utf-8'))
+        except Exception as ex:  # pylint: disable=W0703
+            # Encrypted with another key: cryptography's InvalidToken, recognised without importing it
+            if isinstance(ex, ValueError) or type(ex).__name__ == 'InvalidToken':
+                return None
+            raise
+
+    def put(self, key, sts_token, expires_at):
+        """ Caches a Credentials dict expiring at the expires_at epoch time """
+        credentials = {
+            'AccessKeyId': sts_token['AccessKeyId'],
+            'SecretAccessKey': sts_token['SecretAccessKey'],
+            'SessionToken': sts_token['SessionToken'],
+            'Expiration': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expires_at)),
+        }
+        if self._cipher() is None:
+            write_json(self.path_for(key), {'credentials': credentials, 'expires_at': expires_at})
+        else:
+            encrypted = self.cipher.encrypt(json.dumps(credentials).encode('utf-8')).decode('ascii')
+            write_json(self.path_for(key), {'encrypted': encrypted, 'expires_at': expires_at})
+        return credentials
+
+    def _cipher(self):
+        if self.cipher is None and self.cipher_factory is not None:
+            self.cipher = self.cipher_factory()
+            self.cipher_factory = None
+        return self.cipher
+
+    def evict(self, key):
+        """ Forgets the cached credentials of key """
+        path = self.path_for(key)
+        if os.path.exists(path):
+            os.remove(path)
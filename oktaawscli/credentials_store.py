@@ -0,0 +1,39 @@
+""" Batched, atomic writer for the AWS shared credentials file """
+import io
+import os
+from configparser import RawConfigParser
+
+from oktaawscli.file_util import atomic_write, file_lock
+
+
+class CredentialsStore:
+    """ Applies a batch of profile updates to ~/.aws/credentials in one
+    locked read-modify-write cycle """
+
+    def __init__(self, creds_file):
+        self.creds_file = creds_file
+
+    def read(self):
+        """ Returns a parser loaded with the current credentials file """
+        config = RawConfigParser()
+        if os.path.isfile(self.creds_file):
+            config.read(self.creds_file)
+        return config
+
+    def update(self, profiles):
+        """ Writes every profile of the {profile: {option: value}} mapping.
+        The file is parsed once and replaced atomically while holding the
+        lock, so concurrent writers never lose each other's profiles. """
+        if not profiles:
+            return
+        with file_lock(self.creds_file):
+            config = self.read()
+            for (profile, options) in profiles.items():
+                if not config.has_section(profile):
+                    config.add_section(profile)
+                for (option, value) in options.items():
+                    config.set(profile, option, value)
+
+            buf = io.StringIO()
+            config.write(buf)
+            atomic_write(self.creds_file, buf.getvalue())
@@ -0,0 +1,106 @@
+""" Fast path for shell prompts, direnv hooks and status lines: prints cached credentials without logging in
+
+Usage: okta-awscli-env [--okta-profile NAME] [--role ARN] [--profile NAME] [--json]
+
+    eval "$(okta-awscli-env --okta-profile my-okta-profile)" || okta-awscli --okta-profile my-okta-profile
+
+Prints the exports (or, with --json, a credential_process document) of the
+credentials okta-awscli cached for the role of the okta profile, or of
+--profile in ~/.aws/credentials. When they are missing or about to expire,
+nothing is printed and the exit status is EXIT_REFRESH_NEEDED. Okta and
+AWS are never contacted, nothing is prompted for, and only small standard
+library modules are imported: no click, requests, boto3 or logging.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from oktaawscli.credential_cache import CredentialCache, cache_cipher
+from oktaawscli.credentials_store import CredentialsStore
+from oktaawscli.okta_auth_config import OktaAuthConfig
+
+# Exit status telling the caller to run okta-awscli
+EXIT_REFRESH_NEEDED = 3
+
+# Seconds before expiration at which cached credentials count as expired, as in AwsAuth
+DEFAULT_REFRESH_SKEW = 300
+
+
+class QuietLogger:
+    """ Stands in for a logging.Logger; importing logging costs more than the whole fast path """
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    debug = info = warning = warn = error = _ignore
+
+
+def cached_role_credentials(okta_profile, role_arn):
+    """ The cached Credentials dict of the role of an okta profile, or None """
+    path = os.path.join(os.path.expanduser('~'), '.okta-aws')
+    if not os.path.exists(path):
+        return None
+    # Given a file handle, OktaAuthConfig never prompts for or writes a missing or empty config
+    with open(path) as config_file:
+        okta_auth_config = OktaAuthConfig(QuietLogger(), config_file)
+    role_arn = role_arn or okta_auth_config.role_for(okta_profile)
+    if not role_arn:
+        return None
+    (base_url, username) = okta_auth_config.identity_for(okta_profile)
+    key = CredentialCache.key_for(base_url, username, role_arn, okta_auth_config.duration_for(okta_profile))
+    refresh_skew = okta_auth_config.refresh_skew_for(okta_profile)
+    credential_cache = CredentialCache(DEFAULT_REFRESH_SKEW if refresh_skew is None else refresh_skew,
+                                       cipher_factory=cache_cipher)
+    return credential_cache.get(key)
+
+
+def profile_credentials(profile):
+    """ The Credentials dict of a profile written by okta-awscli to ~/.aws/credentials, or None """
+    parser = CredentialsStore(os.path.join(os.path.expanduser('~'), '.aws', 'credentials')).read()
+    if not parser.has_option(profile, 'okta_expiration_time'):
+        return None
+    try:
+        expires_at = int(parser.get(profile, 'okta_expiration_time'))
+    except ValueError:
+        return None
+    if expires_at - time.time() <= DEFAULT_REFRESH_SKEW:
+        return None
+    return {
+        'AccessKeyId': parser.get(profile, 'aws_access_key_id'),
+        'SecretAccessKey': parser.get(profile, 'aws_secret_access_key'),
+        'SessionToken': parser.get(profile, 'aws_session_token'),
+        'Expiration': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expires_at)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='okta-awscli-env', description=__doc__.split('\n')[0])
+    parser.add_argument('--okta-profile', default='default', help='okta profile whose cached credentials to print')
+    parser.add_argument('--role', help='ARN of the role, instead of the role saved in the okta profile')
+    parser.add_argument('--profile', help='print the credentials of this profile in ~/.aws/credentials instead')
+    parser.add_argument('--json', action='store_true', help='print a credential_process JSON document')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        credentials = profile_credentials(args.profile)
+    else:
+        credentials = cached_role_credentials(args.okta_profile, args.role)
+    if credentials is None:
+        sys.stderr.write("okta-awscli-env: no valid cached credentials, run okta-awscli to refresh them\n")
+        return EXIT_REFRESH_NEEDED
+
+    if args.json:
+        print(json.dumps(dict(credentials, Version=1)))
+    else:
+        print("\n".join([
+            "export AWS_ACCESS_KEY_ID=%s" % credentials['AccessKeyId'],
+            "export AWS_SECRET_ACCESS_KEY=%s" % credentials['SecretAccessKey'],
+            "export AWS_SESSION_TOKEN=%s" % credentials['SessionToken'],
+        ]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+""" Helpers for safely sharing files between concurrent okta-awscli processes """
+import json
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class LockTimeout(Exception):
+    """ A file lock was not acquired within its timeout """
+
+
+@contextmanager
+def file_lock(path, timeout=None):
+    """ Holds an exclusive advisory lock on path + '.lock' for the duration of the block.
+    A separate lock file is used because the guarded file itself is replaced by rename.
+
+    Without a timeout, waits for the lock as long as it takes; otherwise raises
+    LockTimeout after timeout seconds. The lock is released by the OS when its
+    holder exits, so a crashed process never leaves a stale lock behind. """
+    lock_path = path + '.lock'
+    lock_dir = os.path.dirname(lock_path)
+    if lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if timeout is None:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        else:
+            _lock_within(fd, lock_path, timeout)
+    except BaseException:
+        os.close(fd)
+        raise
+    try:
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        elif msvcrt is not None:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+def _lock_within(fd, lock_path, timeout):
+    """ Polls for the lock of fd until timeout seconds have passed """
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            if time.time() + delay > deadline:
+                raise LockTimeout("%s is still locked after %d seconds" % (lock_path, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+
+def atomic_write(path, data, mode=0o600):
+    """ Replaces path with data so readers only ever see the old or the new content.
+    The permissions of an existing file are kept, new files are created with mode. """
+    # Imported here, readers such as okta-awscli-env never write
+    import tempfile
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o777
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def cache_path(*parts, create=True):
+    """ Path of a file in the private okta-awscli cache directory (~/.okta-aws-cache).
+    Missing directories are created readable by the owner only, unless create is false. """
+    directory = os.path.join(os.path.expanduser('~'), '.okta-aws-cache')
+    if not create:
+        return os.path.join(directory, *parts)
+    for part in parts[:-1]:
+        if not os.path.isdir(directory):
+            os.mkdir(directory, 0o700)
+        directory = os.path.join(directory, part)
+    if not os.path.isdir(directory):
+        os.mkdir(directory, 0o700)
+    return os.path.join(directory, *parts[-1:])
+
+
+def read_json(path):
+    """ Loads a JSON cache file, returns None if it is missing or unreadable """
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    """ Atomically writes data as JSON, readable by the owner only """
+    atomic_write(path, json.dumps(data, sort_keys=True))
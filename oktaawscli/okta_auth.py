@@ -1,15 +1,18 @@
 """ Handles auth to Okta and returns SAML assertion """
 # pylint: disable=C0325,R0912,C1801
 # Incorporates flow auth code taken from https://github.com/Nike-Inc/gimme-aws-creds
+import copy
 import sys
-import time
-import requests
-import re
 from codecs import decode
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
-from bs4 import BeautifulSoup as bs
+from oktaawscli import timings
+from oktaawscli.assertion_cache import SamlAssertionCache
+from oktaawscli.okta_session_cache import OktaSessionCache
+from oktaawscli.poller import Poller, PollTimeout
+from oktaawscli.transport import default_transport
+from oktaawscli.saml_extractor import EXTRA_VERIFICATION_RE, extract_from_response
 
 try:
     from u2flib_host import u2f, exc
@@ -37,26 +40,38 @@ class OktaAuth:
         self._verify_ssl_certs = True
         self._preferred_mfa_type = None
         self._mfa_code = None
-        self.https_base_url = "https://%s" % okta_auth_config.base_url_for(okta_profile)
+        base_url = okta_auth_config.base_url_for(okta_profile)
+        # A base-url with a scheme is used as is, e.g. http://127.0.0.1:8080 for a local stand-in
+        self.https_base_url = base_url if '://' in base_url else "https://%s" % base_url
         self.username = okta_auth_config.username_for(okta_profile)
-        self.password = okta_auth_config.password_for(okta_profile)
         self.factor = okta_auth_config.factor_for(okta_profile)
         self.app_link = okta_auth_config.app_link_for(okta_profile)
         self.okta_auth_config = okta_auth_config
         self.session = None
         self.session_token = ""
         self.session_id = ""
+        self.session_cache = None
+        if okta_auth_config.session_cache_for(okta_profile):
+            self.session_cache = OktaSessionCache(self.https_base_url, self.username)
+        self.refresh_session = okta_auth_config.refresh_session_for(okta_profile)
+        self.mfa_timeout = okta_auth_config.mfa_timeout_for(okta_profile)
+        self.use_assertion_cache = okta_auth_config.assertion_cache_for(okta_profile)
+        self.assertion_max_uses = okta_auth_config.assertion_max_uses_for(okta_profile)
+        self.assertion_cache = None
+        self.assertion_from_cache = False
 
     def primary_auth(self):
         """ Performs primary auth against Okta """
 
+        # Asked for only now, runs reusing a cached session or assertion never prompt for it
         auth_data = {
             "username": self.username,
-            "password": self.password
+            "password": self.okta_auth_config.password_for(self.okta_profile, self.username)
         }
-        self.session = requests.Session()
-        resp = self.session.post(self.https_base_url + '/api/v1/authn', json=auth_data)
-        resp_json = resp.json()
+        self.session = default_transport().new_session()
+        with timings.span('okta.primary_auth'):
+            resp = self.session.post(self.https_base_url + '/api/v1/authn', json=auth_data)
+            resp_json = resp.json()
         self.cookies = resp.cookies
         if 'status' in resp_json:
             if resp_json['status'] == 'MFA_REQUIRED':
@@ -78,6 +93,7 @@ Please enroll an MFA factor in the Okta Web UI first!""")
 
         return session_token
 
+    @timings.timed('okta.mfa', timings.HUMAN)
     def verify_mfa(self, factors_list, state_token):
         """ Performs MFA auth against Okta """
 
@@ -153,27 +169,26 @@ Please enroll an MFA factor in the Okta Web UI first!""")
                 req_data['answer'] = input('Enter MFA token: ')
 
         post_url = factor['_links']['verify']['href']
-        resp = requests.post(post_url, json=req_data)
+        resp = self.session.post(post_url, json=req_data)
         resp_json = resp.json()
         if 'status' in resp_json:
             if resp_json['status'] == "SUCCESS":
                 return resp_json['sessionToken']
             elif resp_json['status'] == "MFA_CHALLENGE" and factor['factorType'] != 'u2f':
                 print("Waiting for push verification...")
-                while True:
-                    resp = requests.post(
-                        resp_json['_links']['next']['href'], json=req_data)
-                    resp_json = resp.json()
-                    if resp_json['status'] == 'SUCCESS':
-                        return resp_json['sessionToken']
-                    elif resp_json['factorResult'] == 'TIMEOUT':
-                        print("Verification timed out")
-                        exit(1)
-                    elif resp_json['factorResult'] == 'REJECTED':
-                        print("Verification was rejected")
-                        exit(1)
-                    else:
-                        time.sleep(0.5)
+                next_url = resp_json['_links']['next']['href']
+                resp = self.poll_mfa("Push verification",
+                                     lambda: self.session.post(next_url, json=req_data),
+                                     self._challenge_answered, wait_first=True)
+                resp_json = resp.json()
+                if resp_json['status'] == 'SUCCESS':
+                    return resp_json['sessionToken']
+                elif resp_json.get('factorResult') == 'REJECTED':
+                    print("Verification was rejected")
+                    exit(1)
+                else:
+                    print("Verification timed out")
+                    exit(1)
 
             if factor['factorType'] == 'u2f':
                 devices = u2f.list_devices()
@@ -181,34 +196,37 @@ Please enroll an MFA factor in the Okta Web UI first!""")
                     self.logger.warning("No U2F device found")
                     exit(1)
 
+                app_id = resp_json['_embedded']['factor']['profile']['appId']
                 challenge = dict()
-                challenge['appId'] = resp_json['_embedded']['factor']['profile']['appId']
+                challenge['appId'] = app_id
                 challenge['version'] = resp_json['_embedded']['factor']['profile']['version']
                 challenge['keyHandle'] = resp_json['_embedded']['factor']['profile']['credentialId']
                 challenge['challenge'] = resp_json['_embedded']['factor']['_embedded']['challenge']['nonce']
 
-                print("Please touch your U2F device...")
-                auth_response = None
-                while not auth_response:
-                    for device in devices:
+                def touch():
+                    for device in list(devices):
                         with device as dev:
                             try:
-                                auth_response = u2f.authenticate(dev, challenge, resp_json['_embedded']['factor']['profile']['appId'])
-                                req_data.update(auth_response)
-                                resp = requests.post(resp_json['_links']['next']['href'], json=req_data)
-                                resp_json = resp.json()
-                                if resp_json['status'] == 'SUCCESS':
-                                    return resp_json['sessionToken']
-                                elif resp_json['factorResult'] == 'TIMEOUT':
-                                    self.logger.warning("Verification timed out")
-                                    exit(1)
-                                elif resp_json['factorResult'] == 'REJECTED':
-                                    self.logger.warning("Verification was rejected")
-                                    exit(1)
+                                return u2f.authenticate(dev, challenge, app_id)
                             except exc.APDUError as e:
                                 if e.code == APDU_WRONG_DATA:
                                     devices.remove(device)
-                                time.sleep(0.1)
+                    return None
+
+                print("Please touch your U2F device...")
+                auth_response = self.poll_mfa("U2F verification", touch, lambda r: r is not None,
+                                              initial_delay=0.1, max_delay=0.1)
+                req_data.update(auth_response)
+                resp = self.session.post(resp_json['_links']['next']['href'], json=req_data)
+                resp_json = resp.json()
+                if resp_json['status'] == 'SUCCESS':
+                    return resp_json['sessionToken']
+                elif resp_json['factorResult'] == 'TIMEOUT':
+                    self.logger.warning("Verification timed out")
+                    exit(1)
+                elif resp_json['factorResult'] == 'REJECTED':
+                    self.logger.warning("Verification was rejected")
+                    exit(1)
 
         elif resp.status_code != 200:
             self.logger.error(resp_json['errorSummary'])
@@ -218,15 +236,98 @@ Please enroll an MFA factor in the Okta Web UI first!""")
             exit(1)
         return None
 
+    def poll_mfa(self, name, check, is_done, wait_first=False, **poller_args):
+        """ Polls an MFA challenge with a Poller bounded by the mfa-timeout deadline """
+        poller = Poller(self.mfa_timeout, **poller_args)
+        try:
+            return poller.poll(check, is_done, wait_first)
+        except PollTimeout:
+            print("Verification timed out")
+            exit(1)
+        finally:
+            self.logger.info("%s: %s" % (name, poller.summary()))
+
+    @staticmethod
+    def _challenge_answered(resp):
+        """ Whether a poll of a push challenge returned something other than WAITING """
+        if resp.status_code == 429:
+            return False
+        resp_json = resp.json()
+        return resp_json.get('status') != 'MFA_CHALLENGE' or resp_json.get('factorResult') != 'WAITING'
+
+    @timings.timed('okta.get_session')
     def get_session(self, session_token):
         """ Gets a session cookie from a session token """
         data = {"sessionToken": session_token}
         resp = self.session.post(
             self.https_base_url + '/api/v1/sessions', json=data).json()
+        if self.session_cache is not None and 'expiresAt' in resp:
+            self.session_cache.save(resp['id'], resp['expiresAt'])
         return resp['id']
 
-    def get_apps(self, session_id):
-        """ Gets apps for the user """
+    def login(self):
+        """ Performs primary auth and MFA, then opens a new Okta session """
+        self.session_token = self.primary_auth()
+        self.session_id = self.get_session(self.session_token)
+
+    @timings.timed('okta.resume_session')
+    def resume_session(self):
+        """ Restores the Okta session cached by a previous run, if it has not expired """
+        if self.session_cache is None:
+            return False
+        session_id = self.session_cache.load()
+        if not session_id:
+            return False
+
+        self.logger.info("Reusing cached Okta session")
+        self.session = default_transport().new_session()
+        self.session.cookies['sid'] = session_id
+        self.session_id = session_id
+        if self.refresh_session:
+            resp = self.session.post(
+                self.https_base_url + '/api/v1/sessions/me/lifecycle/refresh',
+                headers=self._get_headers())
+            if resp.status_code != 200:
+                self.logger.info("Cached Okta session could not be refreshed")
+                self.session_cache.clear()
+                return False
+            self.session_cache.save(session_id, resp.json()['expiresAt'])
+        return True
+
+    def open_session(self):
+        """ Resumes the cached Okta session if it is still active, logs in otherwise """
+        if self.resume_session() and self.session_alive():
+            return
+        if self.session_cache is not None:
+            self.session_cache.clear()
+        self.login()
+
+    def join_session(self, session_id):
+        """ Uses an Okta session opened by another OktaAuth of the same user """
+        self.session = default_transport().new_session()
+        self.session.cookies['sid'] = session_id
+        self.session_id = session_id
+
+    def for_app(self, app_link):
+        """ An OktaAuth for another app link of this user, on the same Okta session """
+        okta = copy.copy(self)
+        okta.app_link = app_link
+        okta.assertion_cache = None
+        okta.assertion_from_cache = False
+        okta.join_session(self.session_id)
+        return okta
+
+    @timings.timed('okta.session_alive')
+    def session_alive(self):
+        """ Checks that the current Okta session is still active """
+        resp = self.session.get(
+            self.https_base_url + '/api/v1/sessions/me',
+            headers=self._get_headers())
+        return resp.status_code == 200
+
+    @timings.timed('okta.get_apps')
+    def get_aws_apps(self, session_id):
+        """ Gets the AWS app links of the user, in Okta dashboard order """
         sid = "sid=%s" % session_id
         headers = {'Cookie': sid}
         resp = self.session.get(
@@ -240,8 +341,11 @@ Please enroll an MFA factor in the Okta Web UI first!""")
             self.logger.error("No AWS apps are available for your user. \
                 Exiting.")
             sys.exit(1)
+        return sorted(aws_apps, key=lambda a: a['sortOrder'])
 
-        aws_apps = sorted(aws_apps, key=lambda a: a['sortOrder'])
+    def get_apps(self, session_id):
+        """ Gets apps for the user """
+        aws_apps = self.get_aws_apps(session_id)
         app_choice = 0 if len(aws_apps) == 1 else None
         if app_choice is None:
             print("Available apps:")
@@ -249,23 +353,20 @@ Please enroll an MFA factor in the Okta Web UI first!""")
                 app_name = app['label']
                 print("%d: %s" % (index + 1, app_name))
 
-            app_choice = int(input('Please select AWS app: ')) - 1
+            with timings.span('prompt.app', timings.HUMAN):
+                app_choice = int(input('Please select AWS app: ')) - 1
         self.logger.debug("Selected app: %s" % aws_apps[app_choice]['label'])
         return aws_apps[app_choice]['label'], aws_apps[app_choice]['linkUrl']
 
-    @staticmethod
-    def get_simple_assertion(html):
-        soup = bs(html.text, "html.parser")
-        for input_tag in soup.find_all('input'):
-            if input_tag.get('name') == 'SAMLResponse':
-                return input_tag.get('value')
-
-        return None
+    @timings.timed('okta.app_link_page')
+    def get_app_link_page(self, app_link):
+        """ Fetches an app link and scans the page for the SAML assertion """
+        resp = self.session.get(app_link, stream=True)
+        return extract_from_response(resp)
 
-    def get_mfa_assertion(self, html):
-        soup = bs(html.text, "html.parser")
-        if hasattr(soup.title, 'string') and re.match(".* - Extra Verification$", soup.title.string):
-            state_token = decode(re.search(r"var stateToken = '(.*)';", html.text).group(1), "unicode-escape")
+    def get_mfa_assertion(self, page):
+        if page.title and EXTRA_VERIFICATION_RE.match(page.title) and page.state_token:
+            state_token = decode(page.state_token, "unicode-escape")
         else:
             self.logger.error("No Extra Verification")
             return None
@@ -276,19 +377,20 @@ Please enroll an MFA factor in the Okta Web UI first!""")
         self.session.cookies['Okta_Verify_Autopush_-610254449'] = 'true'
 
         api_response = self.stepup_auth(self.https_base_url + '/api/v1/authn', state_token)
-        resp = self.session.get(self.app_link)
+        page = self.get_app_link_page(self.app_link)
 
-        return self.get_saml_assertion(resp)
+        return self.get_saml_assertion(page)
 
-    def get_saml_assertion(self, html):
-        """ Returns the SAML assertion from HTML """
-        assertion = self.get_simple_assertion(html) or self.get_mfa_assertion(html)
+    def get_saml_assertion(self, page):
+        """ Returns the SAML assertion of an app link page """
+        assertion = page.saml_response or self.get_mfa_assertion(page)
 
         if not assertion:
-            self.logger.error("SAML assertion not valid: " + assertion)
+            self.logger.error("SAML assertion not valid: %s" % assertion)
             exit(-1)
         return assertion
 
+    @timings.timed('okta.stepup_mfa', timings.HUMAN)
     def stepup_auth(self, embed_link, state_token=None):
         """ Login to Okta using the Step-up authentication flow"""
         flow_state = self._get_initial_flow_state(embed_link, state_token)
@@ -349,21 +451,75 @@ Please enroll an MFA factor in the Okta Web UI first!""")
             'Content-Type': 'application/json'
         }
 
-    def get_assertion(self):
+    def get_assertion(self, use_cache=True):
         """ Main method to get SAML assertion from Okta """
-        self.session_token = self.primary_auth()
-        self.session_id = self.get_session(self.session_token)
+        self.assertion_from_cache = False
+        if use_cache and self.app_link and self.use_assertion_cache:
+            assertion = self._assertion_cache_for(self.app_link).load()
+            if assertion:
+                self.logger.info("Reusing cached SAML assertion")
+                self.assertion_from_cache = True
+                return None, assertion
+
+        resumed = bool(self.session_id) or self.resume_session()
+        # Without an app link the app list is requested with the session, so make sure it is live
+        if resumed and not self.app_link and not self.session_alive():
+            if self.session_cache is not None:
+                self.session_cache.clear()
+            resumed = False
+        if not resumed:
+            self.login()
+
         if not self.app_link:
             app_name, app_link = self.get_apps(self.session_id)
             self.okta_auth_config.save_chosen_app_link_for_profile(self.okta_profile, app_link)
+            self.app_link = app_link
         else:
             app_name = None
             app_link = self.app_link
         self.session.cookies['sid'] = self.session_id
-        resp = self.session.get(app_link)
-        assertion = self.get_saml_assertion(resp)
+        page = self.get_app_link_page(app_link)
+
+        if resumed and not self.has_assertion(page):
+            self.logger.info("Cached Okta session is no longer valid, logging in again")
+            if self.session_cache is not None:
+                self.session_cache.clear()
+            self.login()
+            self.session.cookies['sid'] = self.session_id
+            page = self.get_app_link_page(app_link)
+
+        assertion = self.get_saml_assertion(page)
+        if self.use_assertion_cache:
+            self._assertion_cache_for(app_link).save(assertion)
         return app_name, assertion
 
+    def has_cached_assertion(self):
+        """ Whether get_assertion can answer from the assertion cache, without Okta """
+        return bool(self.app_link and self.use_assertion_cache and self._assertion_cache_for(self.app_link).load())
+
+    def refresh_assertion(self):
+        """ Evicts the cached SAML assertion and fetches a new one from Okta """
+        if self.assertion_cache is not None:
+            self.assertion_cache.evict()
+        return self.get_assertion(use_cache=False)
+
+    def record_assertion_use(self, count):
+        """ Counts STS calls made with the cached assertion towards its reuse limit """
+        if self.assertion_cache is not None:
+            self.assertion_cache.record_use(count)
+
+    def _assertion_cache_for(self, app_link):
+        if self.assertion_cache is None:
+            self.assertion_cache = SamlAssertionCache(self.https_base_url, app_link,
+                                                      self.username, self.assertion_max_uses)
+        return self.assertion_cache
+
+    @staticmethod
+    def has_assertion(page):
+        """ Whether an app link page carries a SAML assertion or a per-app MFA prompt.
+        Any other page (e.g. the sign-in form) means the session has expired. """
+        return bool(page.saml_response) or bool(page.title and EXTRA_VERIFICATION_RE.match(page.title))
+
     def _login_send_sms(self, state_token, factor):
         """ Send SMS message for second factor authentication"""
         response = self.session.post(
@@ -439,7 +595,7 @@ Please enroll an MFA factor in the Okta Web UI first!""")
             pass_code = input("Enter verification code: ")
 
         if is_hardware:
-            pass_code = "{},{}".format(self.okta_auth_config.password_for(self.okta_profile), pass_code)
+            pass_code = "{},{}".format(self.okta_auth_config.password_for(self.okta_profile, self.username), pass_code)
 
         response = self.session.post(
             next_url,
@@ -458,14 +614,13 @@ Please enroll an MFA factor in the Okta Web UI first!""")
             return {'stateToken': None, 'sessionToken': None, 'apiResponse': response_data}
 
     def _check_push_result(self, state_token, login_data):
-        """ Check Okta API to see if the push request has been responded to"""
-        time.sleep(1)
-        response = self.session.post(
+        """ Poll Okta API until the push request has been responded to"""
+        response = self.poll_mfa("Push verification", lambda: self.session.post(
             login_data['_links']['next']['href'],
             json={'stateToken': state_token},
             headers=self._get_headers(),
             verify=self._verify_ssl_certs
-        )
+        ), self._challenge_answered, wait_first=True)
 
         response_data = response.json()
         if 'stateToken' in response_data:
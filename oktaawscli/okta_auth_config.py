@@ -2,9 +2,12 @@
 
 import os
 
-from configparser import RawConfigParser, ConfigParser
 from getpass import getpass
 
+from oktaawscli import timings
+from oktaawscli.config_store import ConfigStore
+from oktaawscli.role_duration_cache import MAX_DURATION
+
 try:
     input = raw_input
 except NameError:
@@ -14,27 +17,28 @@ except NameError:
 class OktaAuthConfig:
     """ Config helper class """
 
-    def __init__(self, logger, file_handle=None):
+    def __init__(self, logger, file_handle=None, store=None, setup=True):
+        """ setup asks for the login url when the config file is missing or empty,
+        turn it off to only read the config """
         self.logger = logger
         self.file_handle = file_handle
-        self.password = None
+        # Entered at the prompts: usernames by base url, passwords by (base url, username)
+        self._usernames = {}
+        self._passwords = {}
         if file_handle is not None:
-            self._value = RawConfigParser()
-            self._value.read_file(self.file_handle)
+            self.store = ConfigStore(file_handle=file_handle)
         else:
-            self.config_path = os.path.join(os.path.expanduser('~'), '.okta-aws')
-            if os.path.exists(self.config_path) and os.path.getsize(self.config_path) > 0:
-                self._value = RawConfigParser()
-                self._value.read(self.config_path)
-            else:
+            self.store = store or ConfigStore.for_path()
+            self.config_path = self.store.path
+            if setup and (not os.path.exists(self.config_path) or os.path.getsize(self.config_path) == 0):
                 print("Config path: {} does not exist".format(self.config_path))
-                new_cfg = ConfigParser()
                 base_url = input("What is your organization's login url? ")
+                self.store.set('default', 'base-url', base_url)
+                self.store.commit()
 
-                new_cfg["default"] = {'base-url': base_url}
-                with open(self.config_path, 'w') as cp:
-                    new_cfg.write(cp)
-                self._value = new_cfg
+    @property
+    def _value(self):
+        return self.store.parser
 
     def base_url_for(self, okta_profile):
         """ Gets base URL from config """
@@ -48,6 +52,29 @@ class OktaAuthConfig:
             )
         return base_url
 
+    def identity_for(self, okta_profile):
+        """ Gets the (base url, username) of the Okta user of a profile without prompting.
+        Without a configured username, the okta profile name stands in for it. """
+        base_url = self._base_url_of(okta_profile)
+        if self._value.has_option(okta_profile, 'username'):
+            return base_url, self._value.get(okta_profile, 'username')
+        return base_url, okta_profile
+
+    def _base_url_of(self, okta_profile):
+        """ The base-url of the profile, else of the default profile, without logging """
+        section = okta_profile if self._value.has_option(okta_profile, 'base-url') else 'default'
+        return self._value.get(section, 'base-url') if self._value.has_option(section, 'base-url') else ''
+
+    def profiles(self):
+        """ Names of every okta profile in the config """
+        return self._value.sections()
+
+    def aws_profile_for(self, okta_profile):
+        """ Gets the AWS profile that bulk logins write the credentials of okta_profile to """
+        if self._value.has_option(okta_profile, 'aws-profile'):
+            return self._value.get(okta_profile, 'aws-profile')
+        return okta_profile
+
     def app_link_for(self, okta_profile):
         """ Gets app_link from config """
         app_link = None
@@ -59,23 +86,28 @@ class OktaAuthConfig:
         return app_link
 
     def username_for(self, okta_profile):
-        """ Gets username from config """
+        """ Gets username from config. A username entered at the prompt is
+        reused for the other profiles of the same Okta base url. """
         if self._value.has_option(okta_profile, 'username'):
             username = self._value.get(okta_profile, 'username')
             self.logger.info("Authenticating as: %s" % username)
-        else:
-            username = input('Enter username: ')
-        return username
+            return username
+        base_url = self._base_url_of(okta_profile)
+        if base_url not in self._usernames:
+            with timings.span('prompt.username', timings.HUMAN):
+                self._usernames[base_url] = input('Enter username: ')
+        return self._usernames[base_url]
 
-    def password_for(self, okta_profile):
-        """ Gets password from config """
-        if self.password is not None:
-            return self.password
+    def password_for(self, okta_profile, username=None):
+        """ Gets password from config. A password entered at the prompt is only
+        reused for profiles of the same Okta base url and username. """
         if self._value.has_option(okta_profile, 'password'):
-            self.password = self._value.get(okta_profile, 'password')
-        else:
-            self.password = getpass('Enter password: ')
-        return self.password
+            return self._value.get(okta_profile, 'password')
+        key = (self._base_url_of(okta_profile), username or self.username_for(okta_profile))
+        if key not in self._passwords:
+            with timings.span('prompt.password', timings.HUMAN):
+                self._passwords[key] = getpass('Enter password for %s: ' % key[1])
+        return self._passwords[key]
 
     def factor_for(self, okta_profile):
         """ Gets factor from config """
@@ -85,10 +117,68 @@ class OktaAuthConfig:
             return factor
         return None
 
+    def mfa_timeout_for(self, okta_profile):
+        """ Gets the seconds to wait for an MFA challenge to be answered """
+        return self._int_for(okta_profile, 'mfa-timeout', None)
+
+    def refresh_skew_for(self, okta_profile):
+        """ Gets the seconds before expiration at which credentials are refreshed """
+        return self._int_for(okta_profile, 'refresh-skew', None)
+
+    def refresh_lock_timeout_for(self, okta_profile):
+        """ Gets the seconds to wait for another process refreshing the same credentials """
+        return self._int_for(okta_profile, 'refresh-lock-timeout', None)
+
+    def connect_timeout_for(self, okta_profile):
+        """ Gets the seconds to wait for a connection to Okta or AWS """
+        return self._int_for(okta_profile, 'connect-timeout', None)
+
+    def read_timeout_for(self, okta_profile):
+        """ Gets the seconds to wait for a response from Okta or AWS """
+        return self._int_for(okta_profile, 'read-timeout', None)
+
+    def http_retries_for(self, okta_profile):
+        """ Gets the number of retries of an idempotent request that failed """
+        return self._int_for(okta_profile, 'http-retries', None)
+
+    def alias_cache_ttl_for(self, okta_profile):
+        """ Gets the seconds looked up AWS account aliases are kept """
+        return self._int_for(okta_profile, 'alias-cache-ttl', None)
+
+    def sts_backend_for(self, okta_profile):
+        """ Gets the STS client to use: builtin, or boto3 """
+        backend = self._option_for(okta_profile, 'sts-backend', 'builtin')
+        if backend not in ('builtin', 'boto3'):
+            self.logger.warning("Unknown sts-backend %s, using builtin." % backend)
+            return 'builtin'
+        return backend
+
+    def sts_region_for(self, okta_profile):
+        """ Gets the region of the regional STS endpoint to use """
+        return self._option_for(okta_profile, 'sts-region', None)
+
+    def sts_endpoint_for(self, okta_profile):
+        """ Gets the STS endpoint URL to use instead of the one of the partition """
+        return self._option_for(okta_profile, 'sts-endpoint', None)
+
+    def signin_url_for(self, okta_profile, default):
+        """ Gets the AWS sign-in URL the SAML assertion is posted to for account aliases """
+        return self._option_for(okta_profile, 'signin-url', default)
+
+    def role_for(self, okta_profile):
+        """ Gets the chosen role ARN from config """
+        if self._value.has_option(okta_profile, 'role'):
+            return self._value.get(okta_profile, 'role')
+        return None
+
     def duration_for(self, okta_profile):
-        """ Gets requested duration from config, ignore it on failure """
+        """ Gets requested duration from config, ignore it on failure.
+        MAX_DURATION requests the longest duration each role allows. """
         if self._value.has_option(okta_profile, 'duration'):
             duration = self._value.get(okta_profile, 'duration')
+            if duration.strip().lower() == MAX_DURATION:
+                self.logger.debug("Requesting the longest duration allowed")
+                return MAX_DURATION
             self.logger.debug("Requesting a duration of %s seconds" % duration)
             try:
                 return int(duration)
@@ -96,40 +186,73 @@ class OktaAuthConfig:
                 self.logger.warn("Duration could not be converted to a number, ignoring.")
         return None
 
-    def save_chosen_role_for_profile(self, okta_profile, role_arn):
-        """ Gets role from config """
-        if not self._value.has_section(okta_profile):
-            self._value.add_section(okta_profile)
+    def duration_for_role(self, role_arn):
+        """ Gets the duration of the profile a role was last saved under """
+        for section in self._value.sections():
+            if self._value.has_option(section, 'role') and self._value.get(section, 'role') == role_arn:
+                return self.duration_for(section)
+        return None
 
-        base_url = self.base_url_for(okta_profile)
-        self._value.set(okta_profile, 'base-url', base_url)
-        self._value.set(okta_profile, 'role', role_arn)
+    def _flag_for(self, okta_profile, option, default):
+        """ Gets a boolean option from the profile, then the default profile """
+        for section in (okta_profile, 'default'):
+            if self._value.has_option(section, option):
+                try:
+                    return self._value.getboolean(section, option)
+                except ValueError:
+                    self.logger.warning("%s could not be converted to a boolean, ignoring." % option)
+        return default
 
-        with open(self.config_path, 'w+') as configfile:
-            self._value.write(configfile)
+    def _option_for(self, okta_profile, option, default):
+        """ Gets an option from the profile, then the default profile """
+        for section in (okta_profile, 'default'):
+            if self._value.has_option(section, option):
+                return self._value.get(section, option)
+        return default
 
-    def save_chosen_app_link_for_profile(self, okta_profile, app_link):
-        """ Gets role from config """
-        if not self._value.has_section(okta_profile):
-            self._value.add_section(okta_profile)
+    def _int_for(self, okta_profile, option, default):
+        """ Gets an integer option from the profile, then the default profile """
+        for section in (okta_profile, 'default'):
+            if self._value.has_option(section, option):
+                try:
+                    return int(self._value.get(section, option))
+                except ValueError:
+                    self.logger.warning("%s could not be converted to a number, ignoring." % option)
+        return default
 
-        base_url = self.base_url_for(okta_profile)
-        self._value.set(okta_profile, 'base-url', base_url)
-        self._value.set(okta_profile, 'app-link', app_link)
+    def session_cache_for(self, okta_profile):
+        """ Whether the Okta session is cached between runs, on by default """
+        return self._flag_for(okta_profile, 'session-cache', True)
 
-        with open(self.config_path, 'w+') as configfile:
-            self._value.write(configfile)
+    def refresh_session_for(self, okta_profile):
+        """ Whether a cached Okta session is extended before it is reused """
+        return self._flag_for(okta_profile, 'refresh-session', False)
+
+    def assertion_cache_for(self, okta_profile):
+        """ Whether SAML assertions are reused until they expire, on by default """
+        return self._flag_for(okta_profile, 'assertion-cache', True)
+
+    def assertion_max_uses_for(self, okta_profile):
+        """ Gets the number of STS calls a cached assertion may be used for, unlimited by default """
+        return self._int_for(okta_profile, 'assertion-max-uses', None)
+
+    def save_chosen_role_for_profile(self, okta_profile, role_arn):
+        """ Saves the chosen role, written to the config when the store is committed """
+        self._save_base_url(okta_profile)
+        self.store.set(okta_profile, 'role', role_arn)
+
+    def save_chosen_app_link_for_profile(self, okta_profile, app_link):
+        """ Saves the chosen app link, written to the config when the store is committed """
+        self._save_base_url(okta_profile)
+        self.store.set(okta_profile, 'app-link', app_link)
 
     def save_selected_roles(self, okta_profile, profiles):
-        if not self._value.has_section(okta_profile):
-            self._value.add_section(okta_profile)
-        self._value.set(okta_profile, 'selected-roles', ','.join(profiles))
+        self.store.set(okta_profile, 'selected-roles', ','.join(profiles))
 
-        if self.file_handle is not None:
-            self._value.write(self.file_handle)
-        else:
-            with open(self.config_path, 'w+') as cfg:
-                self._value.write(cfg)
+    def _save_base_url(self, okta_profile):
+        """ Copies the default base-url into a new profile, so it keeps working on its own """
+        if not self._value.has_option(okta_profile, 'base-url') and self._value.has_option('default', 'base-url'):
+            self.store.set(okta_profile, 'base-url', self._value.get('default', 'base-url'))
 
     def selected_roles_for(self, okta_profile):
         if self._value.has_option(okta_profile, 'selected-roles'):
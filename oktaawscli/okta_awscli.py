@@ -1,84 +1,475 @@
 """ Wrapper script for awscli which handles Okta auth """
 # pylint: disable=C0325,R0913,R0914
+import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 from subprocess import call
 import logging
 import click
 from oktaawscli.version import __version__
-from oktaawscli.okta_auth import OktaAuth
+from oktaawscli.assertion_cache import REJECTED_ASSERTION_ERRORS
+from oktaawscli.config_store import ConfigStore
+from oktaawscli.credential_cache import CredentialCache, cache_cipher
 from oktaawscli.okta_auth_config import OktaAuthConfig
-from oktaawscli.aws_auth import AwsAuth
+from oktaawscli.aws_auth import AwsAuth, StsRequest, is_sts_error
+from oktaawscli.transport import configure_default_transport, default_transport
+
+
+# Seconds to wait for another process refreshing the same credentials: an Okta login with MFA
+REFRESH_LOCK_TIMEOUT = 360
 
 
 def get_credentials(aws_auth, okta_profile, profile, verbose, logger, totp_token, cache, alias, okta_auth_config=None):
     """ Gets credentials from Okta """
+    # Imported here so runs with valid cached credentials never load requests
+    from oktaawscli.okta_auth import OktaAuth
 
     okta = OktaAuth(okta_profile, verbose, logger, totp_token, okta_auth_config)
 
-    _, assertion = okta.get_assertion()
     if not alias:
-        role = aws_auth.choose_aws_role(assertion, [])
-        principal_arn, role_arn = role
-        return [setup_credentials(okta_auth_config, okta_profile, role_arn, aws_auth, principal_arn, assertion, logger, profile, verbose, cache, alias, None)]
-    else:
-        default_roles = okta_auth_config.selected_roles_for(okta_profile)
-        choices = aws_auth.choose_aws_role(assertion, default_roles)
-        profiles = []
+        # The role is chosen from the roles of the previous login when possible, before logging in
+        offline_role = choose_cached_role(aws_auth, okta, okta_profile, logger)
+        _, assertion = okta.get_assertion()
+        roles = aws_auth.available_roles(assertion)
+        remember_roles(okta, okta_profile, roles)
+        if offline_role is not None and offline_role not in roles:
+            logger.info("Role %s is no longer assigned to you." % offline_role.role_arn)
+            offline_role = None
+        if offline_role is None:
+            # A single role is assumed; of several chosen at the prompt, the first
+            offline_role = aws_auth.choose_aws_role(assertion, [], roles=roles)[0][0]
+        principal_arn, role_arn = offline_role
         if okta_auth_config is not None:
-            profile_names = [c[0][1] for c in choices]
-            logger.info("Saving profiles as default: %s" % profile_names)
-            okta_auth_config.save_selected_roles(okta_profile, profile_names)
-        for c in choices:
-            (role, option) = c
+            okta_auth_config.save_chosen_role_for_profile(okta_profile, role_arn)
+        duration = okta_auth_config.duration_for(okta_profile)
+
+        [result] = assume_roles(okta, aws_auth, [StsRequest(principal_arn, role_arn, duration)], assertion, logger)
+        if result.error is not None:
+            logger.error("Could not retrieve credentials: %s" % AwsAuth.sts_error_message(result.error))
+            exit(-1)
+        if not profile:
+            # Console runs read the credential cache first, see print_cached_exports
+            cache_console_credentials(aws_auth, okta_auth_config, okta_profile, role_arn, result.credentials, cache,
+                                      logger)
+        return [setup_credentials(result.credentials, aws_auth, logger, profile, verbose)]
+    else:
+        _, assertion = okta.get_assertion()
+        return assume_selected_roles([(okta, assertion)], aws_auth, okta_profile, logger, okta_auth_config)
+
+
+def choose_cached_role(aws_auth, okta, okta_profile, logger):
+    """ Lets the user choose a role from the roles cached by the previous login of the
+    app link, so Okta is only contacted once the role is known. Returns the role, or
+    None when no roles are cached or the assertion is cached anyway. """
+    from oktaawscli.role_catalog_cache import RoleCatalogCache
+
+    if not okta.app_link or okta.has_cached_assertion():
+        return None
+    cached = RoleCatalogCache(okta_profile).load(okta.app_link)
+    if cached is None:
+        return None
+    logger.info("Choosing from the %d roles cached %d minutes ago" %
+                (len(cached.catalog), (time.time() - cached.saved_at) // 60))
+    catalog = cached.catalog
+    return aws_auth.choose_aws_role(None, [], roles=catalog.roles, aliases=lambda: catalog.aliases)[0][0]
+
+
+def remember_roles(okta, okta_profile, roles, aliases=None):
+    """ Caches the roles of a new SAML assertion for --list-roles and choosing a role
+    before logging in. Without aliases, the aliases already cached are saved. """
+    from oktaawscli.alias_cache import AccountAliasCache
+    from oktaawscli.role_catalog import account_id_of
+    from oktaawscli.role_catalog_cache import RoleCatalogCache
+
+    if okta.assertion_from_cache or not okta.app_link:
+        return
+    if aliases is None:
+        aliases = AccountAliasCache().known(set(account_id_of(role.role_arn) for role in roles))
+    RoleCatalogCache(okta_profile).save(okta.app_link, roles, aliases)
+
+
+def print_roles(okta_profile, selector, account, logger):
+    """ Prints the roles cached by the previous logins of okta_profile, or those
+    matching a selector and account, without contacting Okta """
+    from oktaawscli.role_catalog_cache import RoleCatalogCache
+
+    all_cached = RoleCatalogCache(okta_profile).load_all()
+    if not all_cached:
+        logger.error("No roles are cached for okta profile %s, they are cached by the next login." % okta_profile)
+        return 1
+    for cached in all_cached:
+        logger.info("Roles of %s, cached %d minutes ago" % (cached.app_link, (time.time() - cached.saved_at) // 60))
+        catalog = cached.catalog
+        for position in catalog.select(selector, account):
+            print("%-40s %s" % (catalog.selector_of(position), catalog.roles[position].role_arn))
+    return 0
+
+
+def complete_roles(ctx, _, incomplete):
+    """ Shell completion of role selectors and ARNs from the roles cached for the okta profile """
+    from oktaawscli.role_catalog_cache import RoleCatalogCache
+
+    candidates = set()
+    for cached in RoleCatalogCache(ctx.params.get('okta_profile') or 'default').load_all():
+        for position in range(len(cached.catalog)):
+            candidates.add(cached.catalog.selector_of(position))
+            candidates.add(cached.catalog.roles[position].role_arn)
+    return sorted(c for c in candidates if c.startswith(incomplete))
+
+
+def complete_accounts(ctx, _, incomplete):
+    """ Shell completion of account ids and aliases from the roles cached for the okta profile """
+    from oktaawscli.role_catalog_cache import RoleCatalogCache
+
+    candidates = set()
+    for cached in RoleCatalogCache(ctx.params.get('okta_profile') or 'default').load_all():
+        for position in range(len(cached.catalog)):
+            candidates.add(cached.catalog.account_of(position))
+        candidates.update(cached.catalog.aliases.values())
+    return sorted(c for c in candidates if c.startswith(incomplete))
+
+
+def get_all_apps_credentials(aws_auth, okta_profile, verbose, logger, totp_token, okta_auth_config, app_filter=None):
+    """ Gets the SAML assertions of every AWS app of the user, or of the apps
+    whose label matches one of the comma separated app_filter patterns, with
+    a single Okta session, and assumes roles selected across all of them """
+    from fnmatch import fnmatch
+    from oktaawscli.okta_auth import OktaAuth
+
+    okta = OktaAuth(okta_profile, verbose, logger, totp_token, okta_auth_config)
+    okta.open_session()
+    apps = okta.get_aws_apps(okta.session_id)
+    if app_filter:
+        patterns = app_filter.split(',')
+        apps = [app for app in apps if any(fnmatch(app['label'], pattern) for pattern in patterns)]
+    if not apps:
+        logger.error("No AWS apps match %s." % app_filter)
+        exit(1)
+
+    logger.info("Getting SAML assertions of %d AWS apps" % len(apps))
+    app_oktas = [okta.for_app(app['linkUrl']) for app in apps]
+    with ThreadPoolExecutor(max_workers=min(len(app_oktas), AwsAuth.MAX_STS_WORKERS)) as executor:
+        assertions = list(executor.map(lambda app_okta: app_okta.get_assertion()[1], app_oktas))
+
+    # Roles are selected from the merged menu, a single predefined role does not apply
+    aws_auth.role = ""
+    return assume_selected_roles(list(zip(app_oktas, assertions)), aws_auth, okta_profile, logger, okta_auth_config)
+
+
+def assume_selected_roles(sources, aws_auth, okta_profile, logger, okta_auth_config):
+    """ Lets the user select roles, assumes them and writes one profile per role.
+
+    sources is a list of (okta, assertion), one per AWS app; their roles are
+    merged into one menu and each role is assumed with the assertion that
+    granted it. The network steps start as soon as their inputs are known:
+    the account alias lookup, needed for the role menu and the profile names,
+    runs alongside the STS calls for the saved selected-roles, which are
+    usually accepted unchanged. Only roles added to the selection wait for
+    the prompt. """
+    roles = []
+    source_of = {}
+    source_roles = []
+    for source in sources:
+        source_roles.append(aws_auth.available_roles(source[1]))
+        for role in source_roles[-1]:
+            if role.role_arn not in source_of:
+                source_of[role.role_arn] = source
+                roles.append(role)
+    roles.sort(key=lambda role: role.role_arn)
+    default_roles = set(okta_auth_config.selected_roles_for(okta_profile))
+    prefetch = [StsRequest(role.principal_arn, role.role_arn, okta_auth_config.duration_for_role(role.role_arn))
+                for role in roles if role.role_arn in default_roles]
+
+    with ThreadPoolExecutor(max_workers=1 + len(sources)) as executor:
+        aliases = executor.submit(aws_auth.account_aliases, [assertion for (_, assertion) in sources], roles)
+        prefetched = [(source, executor.submit(aws_auth.get_sts_tokens, requests, source[1]))
+                      for (source, requests) in by_source(prefetch, source_of)]
+        choices = aws_auth.choose_aws_role(sources[0][1], default_roles, roles=roles, aliases=aliases.result)
+
+        for ((okta, _), okta_roles) in zip(sources, source_roles):
+            remember_roles(okta, okta_profile, okta_roles, aliases.result())
+
+        profile_names = [c[0][1] for c in choices]
+        logger.info("Saving profiles as default: %s" % profile_names)
+        okta_auth_config.save_selected_roles(okta_profile, profile_names)
+
+        sts_requests = []
+        for (role, option) in choices:
             principal_arn, role_arn = role
-            okta_profile = profile = "%s-%s" % (option.alias_name, option.role_name)
-            profiles.append(setup_credentials(okta_auth_config,
-                                              okta_profile,
-                                              role_arn,
-                                              aws_auth,
-                                              principal_arn,
-                                              assertion,
-                                              logger,
-                                              profile,
-                                              verbose,
-                                              cache,
-                                              alias,
-                                              option))
-        return profiles
-
-
-def setup_credentials(okta_auth_config, okta_profile, role_arn, aws_auth, principal_arn, assertion, logger, profile, verbose, cache, alias, option):
-    if okta_auth_config is not None:
-        okta_auth_config.save_chosen_role_for_profile(okta_profile, role_arn)
-    duration = okta_auth_config.duration_for(okta_profile)
+            role_profile = "%s-%s" % (option.alias_name, option.role_name)
+            okta_auth_config.save_chosen_role_for_profile(role_profile, role_arn)
+            duration = okta_auth_config.duration_for(role_profile)
+            sts_requests.append(StsRequest(principal_arn, role_arn, duration))
+
+        results = {}
+        for ((okta, _), future) in prefetched:
+            source_results = future.result()
+            if okta.assertion_from_cache:
+                okta.record_assertion_use(len(source_results))
+            results.update((result.request, result) for result in source_results if result.error is None)
+
+    logger.debug("Reusing %d of %d prefetched role credentials" %
+                 (len([r for r in sts_requests if r in results]), len(prefetch)))
+
+    # Roles added at the prompt, with another duration, or whose prefetch failed
+    remaining = [request for request in sts_requests if request not in results]
+    for ((okta, assertion), requests) in by_source(remaining, source_of):
+        results.update(zip(requests, assume_roles(okta, aws_auth, requests, assertion, logger)))
+    return persist_credentials(aws_auth, choices, [results[request] for request in sts_requests], logger)
+
+
+def by_source(sts_requests, source_of):
+    """ Groups StsRequests by the (okta, assertion) source granting their role.
+    source_of maps a role ARN to its source. """
+    groups = {}
+    for request in sts_requests:
+        source = source_of[request.role_arn]
+        groups.setdefault(id(source), (source, []))[1].append(request)
+    return list(groups.values())
+
+
+def assume_roles(okta, aws_auth, sts_requests, assertion, logger):
+    """ Assumes the requested roles. When STS refuses a cached SAML assertion,
+    it is evicted and the refused roles are retried with a fresh one. """
+    results = aws_auth.get_sts_tokens(sts_requests, assertion)
+    if not sts_requests or not okta.assertion_from_cache:
+        return results
 
-    sts_token = aws_auth.get_sts_token(
-        role_arn,
-        principal_arn,
-        assertion,
-        duration=duration,
-        logger=logger
-    )
+    okta.record_assertion_use(len(sts_requests))
+    rejected = [i for (i, result) in enumerate(results) if is_rejected_assertion(result.error)]
+    if rejected:
+        logger.info("Cached SAML assertion was rejected by STS, requesting a new one")
+        _, assertion = okta.refresh_assertion()
+        retried = aws_auth.get_sts_tokens([sts_requests[i] for i in rejected], assertion)
+        for (i, result) in zip(rejected, retried):
+            results[i] = result
+    return results
+
+
+def is_rejected_assertion(error):
+    """ Whether an STS error means the SAML assertion itself was refused """
+    return is_sts_error(error) and error.response['Error']['Code'] in REJECTED_ASSERTION_ERRORS
+
+
+def persist_credentials(aws_auth, choices, results, logger):
+    """ Writes the credentials of every successfully assumed role, in choice order """
+    profiles = []
+    sts_tokens = {}
+    for ((_, option), result) in zip(choices, results):
+        if result.error is not None:
+            logger.error("Could not retrieve credentials for %s: %s" %
+                         (result.request.role_arn, AwsAuth.sts_error_message(result.error)))
+            continue
+        sts_token = result.credentials
+        profile = "%s-%s" % (option.alias_name, option.role_name)
+        logger.info("Session token for %s expires on: %s" % (profile, sts_token['Expiration']))
+        sts_tokens[option.alias_name] = sts_token
+        sts_tokens[profile] = sts_token
+        profiles.append(profile)
+
+    if not profiles:
+        logger.error("Could not retrieve credentials for any of the selected roles.")
+        exit(-1)
+    aws_auth.write_sts_tokens(sts_tokens)
+    return profiles
+
+
+def setup_credentials(sts_token, aws_auth, logger, profile, verbose):
+    """ Outputs the credentials of a single role to the console or writes them to profile """
     access_key_id = sts_token['AccessKeyId']
     secret_access_key = sts_token['SecretAccessKey']
     session_token = sts_token['SessionToken']
     session_token_expiry = sts_token['Expiration']
     logger.info("Session token expires on: %s" % session_token_expiry)
     if not profile:
-        exports = console_output(access_key_id, secret_access_key, session_token, verbose)
-        if cache:
-            cache = open(os.path.join(os.path.expanduser('~'), ".okta-credentials.cache"), 'w')
-            cache.write(exports)
-            cache.close()
+        console_output(access_key_id, secret_access_key, session_token, verbose)
         exit(0)
     else:
-        if alias:
-            aws_auth.write_sts_token(option.alias_name, access_key_id, secret_access_key, session_token)
-        aws_auth.write_sts_token(profile, access_key_id, secret_access_key, session_token)
+        aws_auth.write_sts_tokens({profile: sts_token})
 
     return profile
 
 
+def refresh_role_credentials(aws_auth, okta_profile, role_arn, logger, totp_token, okta_auth_config):
+    """ Authenticates to Okta and assumes a single role without prompting for it.
+    Returns the Credentials dict, or None if the role could not be assumed. """
+    from oktaawscli.okta_auth import OktaAuth
+
+    okta = OktaAuth(okta_profile, False, logger, totp_token, okta_auth_config)
+    _, assertion = okta.get_assertion()
+    role = aws_auth.find_role(assertion, role_arn)
+    if role is None:
+        logger.error("Role %s is not assigned to you." % role_arn)
+        return None
+
+    duration = okta_auth_config.duration_for(okta_profile)
+    [result] = assume_roles(okta, aws_auth, [StsRequest(role.principal_arn, role.role_arn, duration)], assertion, logger)
+    if result.error is not None:
+        logger.error("Could not retrieve credentials: %s" % AwsAuth.sts_error_message(result.error))
+        return None
+    return result.credentials
+
+
+def credential_key(okta_auth_config, okta_profile, role_arn):
+    """ Credential cache key of the credentials of role_arn for an okta profile """
+    (base_url, username) = okta_auth_config.identity_for(okta_profile)
+    return CredentialCache.key_for(base_url, username, role_arn, okta_auth_config.duration_for(okta_profile))
+
+
+def cache_console_credentials(aws_auth, okta_auth_config, okta_profile, role_arn, sts_token, cache, logger):
+    """ Caches the credentials output to the console: encrypted when a key is
+    available, in plain text only when --cache asks for it """
+    cipher = cache_cipher()
+    if cipher is None:
+        if not cache:
+            logger.debug("Not caching the credentials: they cannot be encrypted and --cache was not given.")
+            return
+        logger.warning("Caching the credentials unencrypted in ~/.okta-aws-cache. "
+                       "Install okta-awscli[encryption] to encrypt them.")
+    CredentialCache(aws_auth.refresh_skew, cipher).put(credential_key(okta_auth_config, okta_profile, role_arn),
+                                                       sts_token, AwsAuth.expiration_epoch(sts_token['Expiration']))
+
+
+def print_cached_exports(aws_auth, okta_profile, verbose, okta_auth_config):
+    """ Prints the exports of the cached credentials of the role of the okta profile,
+    unless they are about to expire. Returns whether they were printed. """
+    if not aws_auth.role.startswith('arn:') or aws_auth.account:
+        return False
+    credential_cache = CredentialCache(aws_auth.refresh_skew, cipher_factory=cache_cipher)
+    credentials = credential_cache.get(credential_key(okta_auth_config, okta_profile, aws_auth.role))
+    if credentials is None:
+        return False
+    console_output(credentials['AccessKeyId'], credentials['SecretAccessKey'], credentials['SessionToken'], verbose)
+    return True
+
+
+def print_credential_process(aws_auth, okta_profile, role_arn, logger, totp_token, okta_auth_config):
+    """ Prints the credentials of a role as an AWS SDK credential_process JSON
+    document, from the credential cache unless they are about to expire """
+    role_arn = role_arn or okta_auth_config.role_for(okta_profile)
+    if not role_arn:
+        logger.error("No role given. Use --role or set role in the okta profile.")
+        return 1
+
+    credential_cache = CredentialCache(aws_auth.refresh_skew, cipher_factory=cache_cipher)
+    key = credential_key(okta_auth_config, okta_profile, role_arn)
+    credentials = credential_cache.get(key)
+    if credentials is None:
+        # Prompts and progress messages must not end up in the JSON read by the SDK
+        with redirect_stdout(sys.stderr):
+            sts_token = refresh_role_credentials(aws_auth, okta_profile, role_arn, logger, totp_token, okta_auth_config)
+        if sts_token is None:
+            return 1
+        credentials = credential_cache.put(key, sts_token, AwsAuth.expiration_epoch(sts_token['Expiration']))
+
+    document = dict(credentials, Version=1)
+    print(json.dumps(document))
+    return 0
+
+
+def run_agent(okta_profiles, role_arn, verbose, logger, totp_token, okta_auth_config, socket_path, port):
+    """ Keeps the credentials of okta_profiles warm and serves them until interrupted """
+    import secrets
+    from oktaawscli.agent import CredentialAgent, serve_http, serve_unix
+    from oktaawscli.file_util import cache_path
+
+    refreshers = {}
+    refresh_skew = AwsAuth.DEFAULT_REFRESH_SKEW
+    for okta_profile in okta_profiles:
+        profile_role_arn = role_arn or okta_auth_config.role_for(okta_profile)
+        if not profile_role_arn:
+            logger.error("No role for okta profile %s. Use --role or set role in the okta profile." % okta_profile)
+            return 1
+        aws_auth = AwsAuth(None, okta_profile, verbose, logger)
+        refresh_skew = aws_auth.refresh_skew
+        refreshers[okta_profile] = agent_refresher(aws_auth, okta_profile, profile_role_arn, logger,
+                                                   totp_token, okta_auth_config)
+
+    agent = CredentialAgent(refreshers, logger, refresh_skew=refresh_skew)
+    agent.start()
+
+    socket_path = socket_path or cache_path('agent.sock')
+    servers = [serve_unix(agent, socket_path)]
+    print("export OKTA_AWSCLI_AGENT_SOCK=%s" % socket_path)
+    if port is not None:
+        auth_token = secrets.token_urlsafe(32)
+        server = serve_http(agent, port, auth_token)
+        servers.append(server)
+        print("export AWS_CONTAINER_CREDENTIALS_FULL_URI=http://127.0.0.1:%d/%s" %
+              (server.server_address[1], okta_profiles[0]))
+        print("export AWS_CONTAINER_AUTHORIZATION_TOKEN=%s" % auth_token)
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
+
+
+def agent_refresher(aws_auth, okta_profile, role_arn, logger, totp_token, okta_auth_config):
+    """ Refresh callable of one agent profile; fresh credentials also go to the
+    credential cache, so --credential-process runs are served from it """
+    credential_cache = CredentialCache(aws_auth.refresh_skew, cipher_factory=cache_cipher)
+    key = credential_key(okta_auth_config, okta_profile, role_arn)
+
+    def refresh():
+        sts_token = refresh_role_credentials(aws_auth, okta_profile, role_arn, logger, totp_token, okta_auth_config)
+        if sts_token is not None:
+            credential_cache.put(key, sts_token, AwsAuth.expiration_epoch(sts_token['Expiration']))
+        return sts_token
+    return refresh
+
+
+def refresh_once(aws_auth, okta_profile, profile, force, logger, timeout, refresh):
+    """ Refreshes the credentials of profile with refresh(), unless another
+    okta-awscli process refreshes them meanwhile. Runs for the same okta
+    profile and profile take turns on a lock file, so when many start at once
+    only the first logs in to Okta; the others wait for it and use the
+    credentials it wrote. A run still waiting after timeout seconds (default
+    REFRESH_LOCK_TIMEOUT) refreshes on its own. """
+    import hashlib
+    from oktaawscli.file_util import LockTimeout, cache_path, file_lock
+
+    key = hashlib.sha256(("%s\n%s" % (okta_profile, profile)).encode('utf-8')).hexdigest()
+    # Read before waiting: only credentials written while this run waited were refreshed by another process
+    written = aws_auth.written_credentials(profile)
+    try:
+        with file_lock(cache_path('locks', key), REFRESH_LOCK_TIMEOUT if timeout is None else timeout):
+            if aws_auth.written_credentials(profile) != written or (not force and aws_auth.check_sts_token(profile)):
+                logger.info("Credentials of %s were refreshed by another okta-awscli process." % profile)
+                return
+            refresh()
+    except LockTimeout as ex:
+        logger.warning("%s, refreshing the credentials anyway." % ex)
+        refresh()
+
+
+def report_timings(summary, trace_file):
+    """ Starts recording timing spans, reported when the process exits """
+    import atexit
+    from oktaawscli.timings import recorder
+    recorder.enable()
+
+    def report():
+        if summary:
+            sys.stderr.write('\n'.join(recorder.summary()) + '\n')
+        if trace_file:
+            recorder.write_trace(trace_file)
+    atexit.register(report)
+
+
 def console_output(access_key_id, secret_access_key, session_token, verbose):
     """ Outputs STS credentials to console """
     if verbose:
@@ -99,14 +490,37 @@ def console_output(access_key_id, secret_access_key, session_token, verbose):
 @click.option('-V', '--version', is_flag=True, help='Outputs version number and exits')
 @click.option('-d', '--debug', is_flag=True, help='Enables debug mode')
 @click.option('-f', '--force', is_flag=True, help='Forces new STS credentials. Skips STS credentials validation.')
-@click.option('-c', '--cache', is_flag=True, help='Cache the default profile credentials to ~/.okta-credentials.cache\n')
+@click.option('-c', '--cache', is_flag=True, help='Cache the console credentials in ~/.okta-aws-cache even when they '
+              'cannot be encrypted\n')
 @click.option('-l', '--alias', is_flag=True, help='Use profile from chosen role/alias: <alias>-<role-name>')
 @click.option('--okta-profile', help="Name of the profile to use in .okta-aws. If none is provided, then the default profile will be used.\n")
 @click.option('-p', '--profile', help="Name of the profile to store temporary credentials in ~/.aws/credentials. If profile doesn't exist, it will be created. "
                                       "If omitted, credentials will output to console.\n")
 @click.option('-t', '--token', help='TOTP token from your authenticator app')
+@click.option('--verify-remote', is_flag=True, help='Validate cached credentials with sts:GetCallerIdentity instead of their recorded expiration')
+@click.option('--refresh-aliases', is_flag=True, help='Discard cached AWS account aliases and look them up again')
+@click.option('--credential-process', is_flag=True, help='Print credentials as JSON for the credential_process setting of ~/.aws/config')
+@click.option('--role', shell_complete=complete_roles, help='ARN of the role to get credentials for, instead of the role saved in the okta profile. '
+                             'Without --credential-process and --agent, also a selector <account>/<role name> with glob '
+                             'patterns, where <account> is an account ID or alias, e.g. "prod-*/Admin*"')
+@click.option('--account', shell_complete=complete_accounts, help='Only offer the roles of this account ID or alias')
+@click.option('--list-roles', is_flag=True, help='List the roles cached by the previous logins of the okta profile, without logging in')
+@click.option('--search-roles', shell_complete=complete_roles,
+              help='List the cached roles matching a selector <account>/<role name> with glob patterns, without logging in')
+@click.option('--agent', is_flag=True, help='Run in the foreground, keeping credentials fresh and serving them locally')
+@click.option('--agent-profiles', help='Comma separated okta profiles kept warm by --agent. Defaults to --okta-profile')
+@click.option('--agent-socket', help='Unix socket path of --agent. Defaults to ~/.okta-aws-cache/agent.sock')
+@click.option('--agent-port', type=int, help='Also serve credentials over HTTP on this loopback port, for AWS_CONTAINER_CREDENTIALS_FULL_URI')
+@click.option('--timings', is_flag=True, help='Print how long each phase and HTTP request took')
+@click.option('--trace-file', help='Write the timing spans to this file in the Chrome trace event format')
+@click.option('--all-apps', is_flag=True, help='Choose roles from every AWS app in Okta, not only the app-link of the okta profile')
+@click.option('--apps', help='Comma separated patterns of AWS app labels to choose roles from. Implies --all-apps')
+@click.option('--all-profiles', is_flag=True, help='Get credentials for every okta profile with a role, logging in once per Okta user')
+@click.option('--profiles', help='Comma separated okta profiles to get credentials for, logging in once per Okta user')
 @click.argument('awscli_args', nargs=-1, type=click.UNPROCESSED)
-def main(okta_profile, profile, verbose, version, debug, force, cache, awscli_args, token, alias):
+def main(okta_profile, profile, verbose, version, debug, force, cache, awscli_args, token, alias, verify_remote, refresh_aliases,
+         credential_process, role, account, list_roles, search_roles, agent, agent_profiles, agent_socket, agent_port, all_apps, apps,
+         all_profiles, profiles, timings, trace_file):
     """ Authenticate to awscli using Okta """
     if version:
         print(__version__)
@@ -124,6 +538,9 @@ def main(okta_profile, profile, verbose, version, debug, force, cache, awscli_ar
         handler.setLevel(logging.DEBUG)
     logger.addHandler(handler)
 
+    if timings or trace_file:
+        report_timings(timings, trace_file)
+
     if not okta_profile:
         okta_profile = "default"
 
@@ -132,14 +549,52 @@ def main(okta_profile, profile, verbose, version, debug, force, cache, awscli_ar
         profile = None
         force = True
 
-    aws_auth = AwsAuth(profile, okta_profile, verbose, logger)
-    okta_auth_config = OktaAuthConfig(logger)
+    if list_roles or search_roles:
+        exit(print_roles(okta_profile, search_roles, account, logger))
+
+    config_store = ConfigStore.for_path()
+    aws_auth = AwsAuth(profile, okta_profile, verbose, logger, verify_remote, refresh_aliases, config_store)
+    okta_auth_config = OktaAuthConfig(logger, store=config_store)
+    configure_default_transport(okta_auth_config.connect_timeout_for(okta_profile),
+                                okta_auth_config.read_timeout_for(okta_profile),
+                                okta_auth_config.http_retries_for(okta_profile))
+    if role:
+        aws_auth.role = role
+    aws_auth.account = account
+    if credential_process:
+        exit(print_credential_process(aws_auth, okta_profile, role, logger, token, okta_auth_config))
+    if agent:
+        okta_profiles = agent_profiles.split(',') if agent_profiles else [okta_profile]
+        exit(run_agent(okta_profiles, role, verbose, logger, token, okta_auth_config, agent_socket, agent_port))
+    if all_apps or apps:
+        get_all_apps_credentials(aws_auth, okta_profile, verbose, logger, token, okta_auth_config, apps)
+        exit(0)
+    if all_profiles or profiles:
+        from oktaawscli.bulk_login import login_profiles
+        if all_profiles:
+            okta_profiles = [p for p in okta_auth_config.profiles() if okta_auth_config.role_for(p)]
+        else:
+            okta_profiles = profiles.split(',')
+        exit(login_profiles(okta_profiles, verbose, logger, token, okta_auth_config, force))
+    if not profile and not alias and not force and print_cached_exports(aws_auth, okta_profile, verbose,
+                                                                        okta_auth_config):
+        exit(0)
     if not aws_auth.check_sts_token(profile) or force:
         if force and profile:
             logger.info("Force option selected, getting new credentials anyway.")
         elif force:
             logger.info("Force option selected, but no profile provided. Option has no effect.")
-        profile = get_credentials(aws_auth, okta_profile, profile, verbose, logger, token, cache, alias, okta_auth_config)
+        if profile:
+            refresh_once(aws_auth, okta_profile, profile, force, logger,
+                         okta_auth_config.refresh_lock_timeout_for(okta_profile),
+                         lambda: get_credentials(aws_auth, okta_profile, profile, verbose, logger, token, cache,
+                                                 alias, okta_auth_config))
+        else:
+            profile = get_credentials(aws_auth, okta_profile, profile, verbose, logger, token, cache, alias,
+                                      okta_auth_config)
+        config_store.commit()
+        for line in default_transport().stats.summary():
+            logger.debug("HTTP %s" % line)
 
     if awscli_args:
         cmdline = ['aws', '--profile', profile] + list(awscli_args)
@@ -0,0 +1,43 @@
+""" On-disk cache of the Okta session (sid) between invocations """
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+
+from oktaawscli.file_util import cache_path, read_json, write_json
+
+
+class OktaSessionCache:
+    """ Persists the Okta session id of a base url and username """
+
+    # Cached sessions expiring within this many seconds are not reused
+    EXPIRY_SKEW = 60
+
+    def __init__(self, base_url, username):
+        key = hashlib.sha256(("%s\n%s" % (base_url, username)).encode('utf-8')).hexdigest()
+        self.name = key + '.json'
+        # The directory is only created by save, so runs that never log in leave no trace
+        self.path = cache_path('sessions', self.name, create=False)
+
+    def load(self):
+        """ Returns the cached session id, or None if there is no live session """
+        cached = read_json(self.path)
+        if not cached or cached.get('expires_at', 0) - time.time() <= self.EXPIRY_SKEW:
+            return None
+        return cached.get('session_id')
+
+    def save(self, session_id, expires_at):
+        """ Caches a session id with its Okta expiresAt timestamp """
+        write_json(cache_path('sessions', self.name), {'session_id': session_id,
+                                                       'expires_at': self.expires_at_epoch(expires_at)})
+
+    def clear(self):
+        """ Forgets the cached session """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def expires_at_epoch(expires_at):
+        """ Converts an Okta expiresAt timestamp (e.g. 2020-04-20T10:20:30.000Z) to epoch seconds """
+        expiration = datetime.strptime(expires_at[:19], '%Y-%m-%dT%H:%M:%S')
+        return int(expiration.replace(tzinfo=timezone.utc).timestamp())
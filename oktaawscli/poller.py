@@ -0,0 +1,85 @@
+""" Shared polling engine for MFA challenges (push, U2F, step-up) """
+import random
+import time
+
+
+class PollTimeout(Exception):
+    """ The overall deadline of a Poller passed before the challenge completed """
+
+
+class Poller:
+    """ Repeats a check until it reports completion.
+
+    The first fast_polls waits are initial_delay long, so a quick approval
+    is noticed quickly; after that the delay grows by backoff up to
+    max_delay. Every delay is spread by +/- jitter (a fraction) so waiting
+    clients don't poll in lockstep. HTTP responses announcing a rate limit
+    (status 429, Retry-After, or X-Rate-Limit-Remaining: 0 with
+    X-Rate-Limit-Reset) push the next poll back until the limit resets. """
+
+    DEFAULT_DEADLINE = 300
+
+    def __init__(self, deadline=None, initial_delay=0.5, fast_polls=4, max_delay=5.0, backoff=1.5, jitter=0.2,
+                 sleep=None, clock=None):
+        self.deadline = self.DEFAULT_DEADLINE if deadline is None else deadline
+        self.initial_delay = initial_delay
+        self.fast_polls = fast_polls
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self._sleep = sleep or time.sleep
+        self._clock = clock or time.time
+        self.polls = 0
+        self.waited = 0.0
+        self.elapsed = 0.0
+
+    def poll(self, check, is_done, wait_first=False):
+        """ Calls check() until is_done(result) is true and returns that result.
+        With wait_first, the first call is made after one delay, for challenges
+        that were just issued. Raises PollTimeout once the next wait would pass
+        the deadline. """
+        start = self._clock()
+        try:
+            if wait_first:
+                delay = self.next_delay()
+                self._sleep(delay)
+                self.waited += delay
+            while True:
+                result = check()
+                self.polls += 1
+                if is_done(result):
+                    return result
+                delay = self.next_delay(result)
+                if self._clock() + delay - start > self.deadline:
+                    raise PollTimeout("No answer after %d polls in %.0f seconds" % (self.polls, self._clock() - start))
+                self._sleep(delay)
+                self.waited += delay
+        finally:
+            self.elapsed = self._clock() - start
+
+    def next_delay(self, result=None):
+        """ Seconds to wait after the latest poll, which returned result """
+        if self.polls <= self.fast_polls:
+            delay = self.initial_delay
+        else:
+            delay = min(self.max_delay, self.initial_delay * self.backoff ** (self.polls - self.fast_polls))
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, self.rate_limit_delay(result))
+
+    def rate_limit_delay(self, result):
+        """ Seconds until the rate limit announced by an HTTP response resets, 0 if there is none """
+        headers = getattr(result, 'headers', None)
+        if not headers:
+            return 0
+        retry_after = headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        reset = headers.get('X-Rate-Limit-Reset')
+        if reset and reset.isdigit() and (getattr(result, 'status_code', None) == 429 or
+                                          headers.get('X-Rate-Limit-Remaining') == '0'):
+            return max(0.0, float(reset) - self._clock())
+        return 0
+
+    def summary(self):
+        """ One line report of the polling effort """
+        return "%d polls, %.1f seconds waited, %.1f seconds elapsed" % (self.polls, self.waited, self.elapsed)
@@ -0,0 +1,197 @@
+""" Index of the AWS roles granted by SAML assertions """
+import base64
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+RoleTuple = namedtuple("RoleTuple", ["principal_arn", "role_arn"])
+
+AWS_ROLE_ATTRIBUTE = 'https://aws.amazon.com/SAML/Attributes/Role'
+SAML_ATTRIBUTE = '{urn:oasis:names:tc:SAML:2.0:assertion}Attribute'
+SAML_ATTRIBUTE_VALUE = '{urn:oasis:names:tc:SAML:2.0:assertion}AttributeValue'
+
+# Base64 characters decoded and parsed at a time, a multiple of 4
+CHUNK_SIZE = 65536
+
+GLOB_CHARS = frozenset('*?[')
+
+
+def extract_roles(assertion):
+    """ The (principal_arn, role_arn) RoleTuples granted by a base64 encoded SAML
+    assertion, sorted by role ARN. The assertion is decoded and parsed in one
+    pass; elements are discarded once seen, so no document tree is kept. """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    roles = []
+    in_role_attribute = False
+    for offset in range(0, len(assertion), CHUNK_SIZE):
+        parser.feed(base64.b64decode(assertion[offset:offset + CHUNK_SIZE]))
+        for (event, element) in parser.read_events():
+            if element.tag == SAML_ATTRIBUTE:
+                in_role_attribute = event == 'start' and element.get('Name') == AWS_ROLE_ATTRIBUTE
+            elif event == 'end' and in_role_attribute and element.tag == SAML_ATTRIBUTE_VALUE:
+                role = parse_role_value(element.text or '')
+                if role is not None:
+                    roles.append(role)
+            if event == 'end':
+                element.clear()
+    parser.close()
+    roles.sort(key=lambda role: role.role_arn)
+    return roles
+
+
+def parse_role_value(text):
+    """ The RoleTuple of a role AttributeValue, or None if it lacks either ARN.
+    The role and principal ARNs can be in any order and from separate accounts. """
+    principal_arn = role_arn = None
+    for part in text.split(','):
+        part = part.strip()
+        if ':saml-provider/' in part:
+            principal_arn = part
+        elif ':role/' in part:
+            role_arn = part
+    if principal_arn is None or role_arn is None:
+        return None
+    return RoleTuple(principal_arn, role_arn)
+
+
+def account_id_of(role_arn):
+    return role_arn.split(':')[4]
+
+
+def role_name_of(role_arn):
+    """ The role name, without its path """
+    return role_arn.rsplit('/', 1)[-1]
+
+
+def needs_aliases(selector, account):
+    """ Whether matching selector and account may need the account aliases,
+    i.e. they name an account by something other than its ID """
+    patterns = [account] if account else []
+    if selector and not selector.startswith('arn:') and '/' in selector:
+        patterns.append(selector.split('/', 1)[0])
+    return any(pattern.strip('*?') and not pattern.strip('*?').isdigit() for pattern in patterns)
+
+
+class RoleCatalog:
+    """ Roles sorted by role ARN and indexed by role ARN, account ID, account
+    alias and role name.
+
+    Selecting roles looks the exact parts of a selector up in the indexes and
+    only tests glob patterns against the keys of the indexes or the few roles
+    already selected, so selection cost does not grow with the number of
+    roles of the assertion. """
+
+    # Fields a selector part is matched against
+    ARN = ('arn',)
+    ACCOUNT = ('account', 'alias')
+    NAME = ('name',)
+
+    def __init__(self, roles, aliases=None):
+        self.roles = []
+        self._accounts = []
+        self._names = []
+        self._aliases = {}
+        self._index = {'arn': {}, 'account': {}, 'name': {}, 'alias': {}}
+        for role in sorted(roles, key=lambda r: r.role_arn):
+            if role.role_arn in self._index['arn']:
+                continue
+            position = len(self.roles)
+            self.roles.append(role)
+            self._accounts.append(account_id_of(role.role_arn))
+            self._names.append(role_name_of(role.role_arn))
+            self._index['arn'][role.role_arn] = [position]
+            self._index['account'].setdefault(self._accounts[-1], []).append(position)
+            self._index['name'].setdefault(self._names[-1], []).append(position)
+        if aliases:
+            self.set_aliases(aliases)
+
+    def __len__(self):
+        return len(self.roles)
+
+    @property
+    def aliases(self):
+        """ The account alias map the roles are indexed by """
+        return dict(self._aliases)
+
+    def set_aliases(self, aliases):
+        """ Indexes the roles by account alias. aliases maps an account ID to its alias. """
+        self._aliases = dict(aliases)
+        self._index['alias'] = {}
+        for (account, alias) in self._aliases.items():
+            if account in self._index['account']:
+                self._index['alias'].setdefault(alias, []).extend(self._index['account'][account])
+
+    def find(self, role_arn):
+        """ The role with the given ARN, or None """
+        positions = self._index['arn'].get(role_arn)
+        return self.roles[positions[0]] if positions else None
+
+    def positions_of(self, role_arns):
+        """ Sorted positions of the roles with the given ARNs """
+        index = self._index['arn']
+        return sorted(index[arn][0] for arn in set(role_arns) if arn in index)
+
+    def account_of(self, position):
+        return self._accounts[position]
+
+    def name_of(self, position):
+        return self._names[position]
+
+    def selector_of(self, position):
+        """ The <account alias or ID>/<role name> selector of a role """
+        return '%s/%s' % (self._aliases.get(self._accounts[position], self._accounts[position]), self._names[position])
+
+    def select(self, selector=None, account=None):
+        """ Sorted positions of the roles matching selector and account.
+
+        selector is a role ARN or <account>/<role name>, or just a role name;
+        account an account ID or alias. An account part matches the account
+        ID or the alias. Every part may be a glob pattern, e.g. prod-*/Admin*. """
+        criteria = []
+        if account:
+            criteria.append((self.ACCOUNT, account))
+        if selector:
+            if selector.startswith('arn:'):
+                criteria.append((self.ARN, selector))
+            elif '/' in selector:
+                (account_part, name_part) = selector.split('/', 1)
+                criteria += [(self.ACCOUNT, account_part), (self.NAME, name_part)]
+            else:
+                criteria.append((self.NAME, selector))
+
+        selected = None
+        globs = []
+        for (fields, pattern) in criteria:
+            if pattern in ('', '*'):
+                continue
+            if GLOB_CHARS.isdisjoint(pattern):
+                found = set()
+                for field in fields:
+                    found.update(self._index[field].get(pattern, ()))
+                selected = found if selected is None else selected & found
+            else:
+                globs.append((fields, pattern))
+
+        for (fields, pattern) in globs:
+            if selected is None:
+                selected = set()
+                for field in fields:
+                    for (key, positions) in self._index[field].items():
+                        if fnmatchcase(key, pattern):
+                            selected.update(positions)
+            else:
+                selected = set(position for position in selected
+                               if any(fnmatchcase(self._key(field, position), pattern) for field in fields))
+
+        if selected is None:
+            return list(range(len(self.roles)))
+        return sorted(selected)
+
+    def _key(self, field, position):
+        if field == 'arn':
+            return self.roles[position].role_arn
+        if field == 'account':
+            return self._accounts[position]
+        if field == 'name':
+            return self._names[position]
+        return self._aliases.get(self._accounts[position], '')
@@ -0,0 +1,56 @@
+""" On-disk cache of the roles granted to an okta profile, for listing and choosing roles without Okta """
+import hashlib
+import time
+from collections import namedtuple
+
+from oktaawscli.file_util import cache_path, file_lock, read_json, write_json
+from oktaawscli.role_catalog import RoleCatalog, RoleTuple, account_id_of
+
+CachedRoles = namedtuple("CachedRoles", ["app_link", "catalog", "saved_at"])
+
+
+class RoleCatalogCache:
+    """ The roles of the last SAML assertion of each app link of an okta profile,
+    with the aliases of their accounts.
+
+    Each app link is stored compactly: the distinct principal ARNs once, and
+    every role as its ARN and the position of its principal. """
+
+    def __init__(self, okta_profile):
+        key = hashlib.sha256(okta_profile.encode('utf-8')).hexdigest()
+        self.path = cache_path('roles', key + '.json')
+
+    def save(self, app_link, roles, aliases):
+        """ Replaces the cached roles of app_link. aliases maps account ids to their alias. """
+        principals = {}
+        entry_roles = []
+        for role in roles:
+            principal = principals.setdefault(role.principal_arn, len(principals))
+            entry_roles.append([role.role_arn, principal])
+        accounts = set(account_id_of(role.role_arn) for role in roles)
+        entry = {
+            'saved_at': time.time(),
+            'principals': sorted(principals, key=principals.get),
+            'roles': entry_roles,
+            'aliases': {account: alias for (account, alias) in aliases.items() if account in accounts},
+        }
+        with file_lock(self.path):
+            entries = read_json(self.path) or {}
+            entries[app_link] = entry
+            write_json(self.path, entries)
+
+    def load(self, app_link):
+        """ Returns the CachedRoles of app_link, or None if none were saved """
+        entry = (read_json(self.path) or {}).get(app_link)
+        return self.__cached_roles(app_link, entry) if entry else None
+
+    def load_all(self):
+        """ Returns the CachedRoles of every app link of the okta profile, ordered by app link """
+        entries = read_json(self.path) or {}
+        return [self.__cached_roles(app_link, entries[app_link]) for app_link in sorted(entries)]
+
+    @staticmethod
+    def __cached_roles(app_link, entry):
+        principals = entry['principals']
+        roles = [RoleTuple(principals[principal], role_arn) for (role_arn, principal) in entry['roles']]
+        return CachedRoles(app_link, RoleCatalog(roles, entry['aliases']), entry['saved_at'])
@@ -0,0 +1,43 @@
+""" On-disk cache of the longest session duration each role was assumed for """
+import time
+
+from oktaawscli.file_util import cache_path, file_lock, read_json, write_json
+
+# duration option value requesting the longest session a role allows
+MAX_DURATION = 'max'
+
+# Durations tried by MAX_DURATION, longest first: 12 hours, the STS maximum, down to the default of one hour
+DURATION_STEPS = (43200, 36000, 28800, 21600, 14400, 7200, 3600)
+
+
+def next_duration(duration, limit=None):
+    """ The duration to try after STS refused duration: limit when STS
+    stated a lower one, otherwise the next lower step, or None when there is none """
+    if limit is not None and limit < duration:
+        return limit
+    return next((step for step in DURATION_STEPS if step < duration), None)
+
+
+class RoleDurationCache:
+    """ Maps role ARNs to the longest duration STS granted them, each entry
+    expiring after ttl seconds so a raised MaxSessionDuration is picked up """
+
+    DEFAULT_TTL = 7 * 24 * 3600
+
+    def __init__(self, ttl=None):
+        self.path = cache_path('role-durations.json')
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+
+    def get(self, role_arn):
+        """ Returns the learned duration of role_arn, or None if unknown or stale """
+        entry = (read_json(self.path) or {}).get(role_arn)
+        if not entry or time.time() - entry['learned_at'] > self.ttl:
+            return None
+        return entry['duration']
+
+    def save(self, role_arn, duration):
+        """ Records that role_arn was granted duration seconds """
+        with file_lock(self.path):
+            entries = read_json(self.path) or {}
+            entries[role_arn] = {'duration': duration, 'learned_at': time.time()}
+            write_json(self.path, entries)
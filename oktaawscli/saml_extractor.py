@@ -0,0 +1,128 @@
+""" Streaming extraction of the SAML assertion from an Okta app link page """
+import codecs
+import re
+from collections import namedtuple
+from html import unescape
+
+SamlPage = namedtuple("SamlPage", ["saml_response", "title", "state_token"])
+
+STATE_TOKEN_RE = re.compile(r"var stateToken = '(.*)';")
+EXTRA_VERIFICATION_RE = re.compile(r".* - Extra Verification$")
+TAG_RE = re.compile(r'<(input|title|script)\b', re.IGNORECASE)
+ATTRIBUTE_RE = re.compile(r'''([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+
+# Text that ends each element of interest, searched for in lower case
+TERMINATORS = {'input': '>', 'title': '</title', 'script': '</script'}
+
+
+class SamlPageScanner:
+    """ Incremental scanner for the few parts of an app link page we need:
+    the SAMLResponse input, the page title and the per-app MFA stateToken.
+
+    Only <input>, <title> and <script> elements are looked at, and each
+    chunk is scanned once, so the cost stays linear in the page size even
+    when a multi-megabyte SAMLResponse is split over many chunks. No
+    document tree is built; done is set as soon as the answer is known. """
+
+    def __init__(self):
+        self.saml_response = None
+        self.title = None
+        self.state_token = None
+        self.done = False
+        self._text = ''
+        self._tag = None
+        self._pieces = []
+        self._tail = ''
+
+    def feed(self, data):
+        """ Scans the next chunk of the page """
+        while data and not self.done:
+            if self._tag is None:
+                data = self._find_tag(data)
+            else:
+                data = self._find_end(data)
+
+    def _find_tag(self, data):
+        text = self._text + data
+        match = TAG_RE.search(text)
+        if match is None:
+            # Keep enough to recognise a tag split across chunks
+            self._text = text[-len('<script'):]
+            return ''
+        self._text = ''
+        self._tag = match.group(1).lower()
+        self._pieces = []
+        self._tail = ''
+        return text[match.start():]
+
+    def _find_end(self, data):
+        terminator = TERMINATORS[self._tag]
+        window = self._tail + data
+        if self._tag != 'input':
+            window = window.lower()
+        index = window.find(terminator)
+        if index < 0:
+            self._pieces.append(data)
+            self._tail = window[-(len(terminator) - 1):] if len(terminator) > 1 else ''
+            return ''
+
+        split = index - len(self._tail) + len(terminator)
+        self._pieces.append(data[:split])
+        self._handle_element(self._tag, ''.join(self._pieces))
+        self._tag = None
+        self._pieces = []
+        return data[split:]
+
+    def _handle_element(self, tag, element):
+        if tag == 'input':
+            attributes = {}
+            for match in ATTRIBUTE_RE.finditer(element, len('<input'), len(element) - 1):
+                value = match.group(2) if match.group(2) is not None else match.group(3) or match.group(4) or ''
+                attributes[match.group(1).lower()] = value
+            if attributes.get('name') == 'SAMLResponse':
+                self.saml_response = unescape(attributes.get('value', ''))
+                self.done = True
+        elif tag == 'title' and self.title is None:
+            content = element[element.find('>') + 1:-len('</title')]
+            self.title = unescape(content).strip()
+        elif tag == 'script' and self.state_token is None:
+            match = STATE_TOKEN_RE.search(element)
+            if match:
+                self.state_token = match.group(1)
+                self.done = self.is_extra_verification()
+
+    def is_extra_verification(self):
+        """ Whether the page is Okta's per-app MFA prompt """
+        return self.title is not None and EXTRA_VERIFICATION_RE.match(self.title) is not None
+
+    def page(self):
+        """ What was found so far """
+        return SamlPage(self.saml_response, self.title, self.state_token)
+
+
+def extract_saml_page(chunks):
+    """ Feeds text chunks to a SamlPageScanner until it has found what it looks for """
+    scanner = SamlPageScanner()
+    for chunk in chunks:
+        scanner.feed(chunk)
+        if scanner.done:
+            break
+    return scanner.page()
+
+
+def iter_response_text(resp, chunk_size=16384):
+    """ Decodes a streamed requests response body chunk by chunk """
+    decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+    for chunk in resp.iter_content(chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+def extract_from_response(resp):
+    """ Extracts the SamlPage of a response fetched with stream=True. The rest
+    of the body is read without being parsed, so the connection can be reused. """
+    chunks = iter_response_text(resp)
+    page = extract_saml_page(chunks)
+    for _ in chunks:
+        pass
+    return page
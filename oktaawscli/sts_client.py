@@ -0,0 +1,93 @@
+""" Minimal AWS STS client for the unsigned AssumeRoleWithSAML call """
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+from oktaawscli.transport import default_transport
+
+STS_NS = '{https://sts.amazonaws.com/doc/2011-06-15/}'
+
+
+class StsError(Exception):
+    """ Error returned by STS. The response attribute has the same shape as
+    botocore's ClientError.response, so callers can handle both alike. """
+
+    def __init__(self, code, message, status_code=None):
+        Exception.__init__(self, "%s: %s" % (code, message))
+        self.response = {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status_code},
+        }
+
+
+class StsClient:
+    """ Speaks the STS Query API directly over the pooled HTTP transport.
+    Only AssumeRoleWithSAML is supported, which needs no request signing. """
+
+    API_VERSION = '2011-06-15'
+
+    def __init__(self, endpoint_url, session=None, timeout=30):
+        self.endpoint_url = endpoint_url
+        self.timeout = timeout
+        self.session = session or default_transport().new_session()
+
+    @staticmethod
+    def endpoint_for(partition, region=None):
+        """ STS endpoint of a partition, regional when a region is given """
+        if partition == 'aws-us-gov':
+            if not region or not region.startswith('us-gov-'):
+                region = 'us-gov-west-1'
+            return 'https://sts.%s.amazonaws.com' % region
+        if partition == 'aws-cn':
+            if not region or not region.startswith('cn-'):
+                region = 'cn-north-1'
+            return 'https://sts.%s.amazonaws.com.cn' % region
+        if region:
+            return 'https://sts.%s.amazonaws.com' % region
+        return 'https://sts.amazonaws.com'
+
+    def assume_role_with_saml(self, RoleArn, PrincipalArn, SAMLAssertion, DurationSeconds=3600):
+        """ Same arguments and result layout as the boto3 STS client method """
+        # pylint: disable=C0103
+        data = {
+            'Action': 'AssumeRoleWithSAML',
+            'Version': self.API_VERSION,
+            'RoleArn': RoleArn,
+            'PrincipalArn': PrincipalArn,
+            'SAMLAssertion': SAMLAssertion,
+            'DurationSeconds': str(DurationSeconds),
+        }
+        resp = self.session.post(self.endpoint_url, data=data, timeout=self.timeout)
+        try:
+            root = ET.fromstring(resp.content)
+        except ET.ParseError:
+            raise StsError('InvalidResponse', 'STS returned HTTP %d with an unreadable body' % resp.status_code,
+                           resp.status_code)
+
+        if resp.status_code != 200:
+            error = root.find('%sError' % STS_NS)
+            if error is None:
+                error = root.find('Error')
+            if error is None:
+                raise StsError('InvalidResponse', 'STS returned HTTP %d' % resp.status_code, resp.status_code)
+            raise StsError(self.__text(error, 'Code') or 'Unknown', self.__text(error, 'Message') or '',
+                           resp.status_code)
+
+        credentials = root.find('%sAssumeRoleWithSAMLResult/%sCredentials' % (STS_NS, STS_NS))
+        if credentials is None:
+            raise StsError('InvalidResponse', 'STS response has no Credentials', resp.status_code)
+        expiration = datetime.strptime(self.__text(credentials, 'Expiration')[:19], '%Y-%m-%dT%H:%M:%S')
+        return {
+            'Credentials': {
+                'AccessKeyId': self.__text(credentials, 'AccessKeyId'),
+                'SecretAccessKey': self.__text(credentials, 'SecretAccessKey'),
+                'SessionToken': self.__text(credentials, 'SessionToken'),
+                'Expiration': expiration.replace(tzinfo=timezone.utc),
+            }
+        }
+
+    @staticmethod
+    def __text(element, name):
+        child = element.find(STS_NS + name)
+        if child is None:
+            child = element.find(name)
+        return child.text if child is not None else None
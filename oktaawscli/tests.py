@@ -1,11 +1,52 @@
+import base64
 import io
+import json
 import logging
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import importlib.util
+import urllib.error
+import urllib.request
 from collections import namedtuple
-from unittest.mock import patch
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs
 
+from benchmarks import bench_e2e
+from benchmarks.fake_services import FakeServices
 from oktaawscli.okta_auth_config import OktaAuthConfig
-from oktaawscli.aws_auth import AwsAuth
+from oktaawscli.agent import CredentialAgent, ThreadingHTTPServer, serve_http, serve_unix
+from oktaawscli.alias_cache import AccountAliasCache
+from oktaawscli.assertion_cache import SamlAssertionCache
+from oktaawscli.bulk_login import login_profiles
+from oktaawscli.aws_auth import AwsAuth, StsRequest, StsResult
+from oktaawscli.config_store import ConfigStore
+from oktaawscli.credential_cache import KEY_ENV, CredentialCache, cache_cipher
+from oktaawscli.credentials_store import CredentialsStore
+from oktaawscli.file_util import LockTimeout, atomic_write, file_lock
+from oktaawscli.okta_auth import OktaAuth
+from oktaawscli.okta_awscli import (assume_roles, assume_selected_roles, cache_console_credentials, choose_cached_role,
+                                    credential_key, get_all_apps_credentials, print_cached_exports,
+                                    print_credential_process, print_roles)
+from oktaawscli.okta_session_cache import OktaSessionCache
+from oktaawscli.poller import Poller, PollTimeout
+from oktaawscli.role_catalog import RoleCatalog, RoleTuple, extract_roles
+from oktaawscli.role_catalog_cache import RoleCatalogCache
+from oktaawscli.role_duration_cache import MAX_DURATION, RoleDurationCache
+from oktaawscli.saml_extractor import SamlPage, extract_from_response, extract_saml_page
+from oktaawscli.sts_client import StsClient, StsError
+from oktaawscli import fastpath, timings
+from oktaawscli import transport as transport_module
+from oktaawscli.timings import Recorder
+from oktaawscli.transport import Transport
 
 
 class OktaRoleTests(unittest.TestCase):
@@ -48,5 +89,1182 @@ class OktaRoleTests(unittest.TestCase):
         self.assertEqual(roles, "1,2,3")
 
 
+class TempHomeTestCase(unittest.TestCase):
+    """ Runs each test with HOME pointing to a fresh temporary directory """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.home = patch.dict(os.environ, {'HOME': self.tmp_dir.name})
+        self.home.start()
+
+    def tearDown(self):
+        self.home.stop()
+        self.tmp_dir.cleanup()
+
+
+class StsFanOutTests(TempHomeTestCase):
+
+    @staticmethod
+    def fake_sts_token(role_arn, principal_arn, assertion, duration=None, logger=None):
+        time.sleep(0.2)
+        if role_arn.endswith('denied'):
+            raise RuntimeError('Access denied')
+        return {'AccessKeyId': role_arn, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                'Expiration': '2999-01-01T00:00:00Z'}
+
+    @patch.object(AwsAuth, '_sts_client_for')
+    def test_roles_assumed_concurrently(self, _):
+        sts_requests = [StsRequest('arn:aws:iam::000000000000:saml-provider/okta',
+                                   'arn:aws:iam::000000000000:role/role%d' % i, None) for i in range(10)]
+        sts_requests.append(StsRequest('arn:aws:iam::000000000000:saml-provider/okta',
+                                       'arn:aws:iam::000000000000:role/denied', None))
+        aws_auth = AwsAuth('profile', 'profile', False, logging.getLogger('okta-awscli'))
+        with patch.object(aws_auth, 'get_sts_token', side_effect=self.fake_sts_token):
+            start = time.time()
+            results = aws_auth.get_sts_tokens(sts_requests, 'assertion')
+            elapsed = time.time() - start
+
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual([r.request for r in results], sts_requests)
+        self.assertEqual([r.credentials['AccessKeyId'] for r in results[:-1]], [r.role_arn for r in sts_requests[:-1]])
+        self.assertIsNone(results[-1].credentials)
+        self.assertEqual(AwsAuth.sts_error_message(results[-1].error), 'Access denied')
+
+    @patch.object(AwsAuth, '_sts_client_for')
+    def test_selected_roles_prefetched_during_alias_lookup(self, _):
+        role_arns = ['arn:aws:iam::000000000000:role/admin', 'arn:aws:iam::000000000001:role/admin']
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'),
+                                          io.StringIO('[default]\nselected-roles = %s\n' % role_arns[0]))
+        aws_auth = AwsAuth('profile', 'profile', False, logging.getLogger('okta-awscli'))
+        sts_called = threading.Event()
+
+        def fake_sts_token(role_arn, principal_arn, assertion, duration=None, logger=None):
+            sts_called.set()
+            return {'AccessKeyId': role_arn, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                    'Expiration': '2999-01-01T00:00:00Z'}
+
+        def account_aliases(assertion, roles):
+            # Only returns once the prefetched STS call has been made
+            self.assertTrue(sts_called.wait(5))
+            return {'000000000000': 'prod'}
+
+        with patch.object(aws_auth, 'get_sts_token', side_effect=fake_sts_token) as get_sts_token, \
+                patch.object(aws_auth, 'account_aliases', side_effect=account_aliases), \
+                patch.object(aws_auth, 'write_sts_tokens') as write_sts_tokens, \
+                patch.object(okta_auth_config, 'save_chosen_role_for_profile'), \
+                patch.object(AwsAuth, 'choose_roles', return_value='1,2'), patch('builtins.print'):
+            profiles = assume_selected_roles([(MagicMock(assertion_from_cache=False, app_link=None),
+                                               make_assertion(role_arns))],
+                                             aws_auth, 'default', logging.getLogger('okta-awscli'), okta_auth_config)
+
+        self.assertEqual(profiles, ['prod-admin', '000000000001-admin'])
+        self.assertEqual(sorted(c[0][0] for c in get_sts_token.call_args_list), role_arns)
+        self.assertEqual(write_sts_tokens.call_args[0][0]['prod-admin']['AccessKeyId'], role_arns[0])
+
+    @patch.object(AwsAuth, '_sts_client_for')
+    def test_roles_merged_across_apps(self, _):
+        role_arns = ['arn:aws:iam::000000000000:role/admin', 'arn:aws:iam::000000000001:role/admin']
+        assertions = {'https://example.okta.com/app/a': make_assertion(role_arns[:1]),
+                      'https://example.okta.com/app/b': make_assertion(role_arns[1:])}
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'), io.StringIO(OKTA_CONFIG))
+        aws_auth = AwsAuth('profile', 'default', False, logging.getLogger('okta-awscli'))
+        apps = [{'label': label, 'linkUrl': link} for (label, link) in zip(['Payer A', 'Payer B'], assertions)]
+
+        with patch.object(OktaAuth, 'open_session'), \
+                patch.object(OktaAuth, 'get_aws_apps', return_value=apps), \
+                patch.object(OktaAuth, 'get_assertion', autospec=True,
+                             side_effect=lambda okta: (None, assertions[okta.app_link])), \
+                patch.object(aws_auth, 'get_sts_token', side_effect=self.fake_sts_token) as get_sts_token, \
+                patch.object(aws_auth, 'account_aliases', return_value={}), \
+                patch.object(aws_auth, 'write_sts_tokens'), \
+                patch.object(okta_auth_config, 'save_chosen_role_for_profile'), \
+                patch.object(okta_auth_config, 'save_selected_roles'), \
+                patch.object(AwsAuth, 'choose_roles', return_value='1,2'), patch('builtins.print'), \
+                patch('oktaawscli.okta_awscli.remember_roles') as remember_roles:
+            profiles = get_all_apps_credentials(aws_auth, 'default', False, logging.getLogger('okta-awscli'), None,
+                                                okta_auth_config)
+
+        self.assertEqual(profiles, ['000000000000-admin', '000000000001-admin'])
+        self.assertEqual([(c[0][0].app_link, [r.role_arn for r in c[0][2]]) for c in remember_roles.call_args_list],
+                         [('https://example.okta.com/app/a', role_arns[:1]), ('https://example.okta.com/app/b', role_arns[1:])])
+        used = {c[0][0]: c[0][2] for c in get_sts_token.call_args_list}
+        self.assertEqual(used, {role_arns[0]: assertions['https://example.okta.com/app/a'],
+                                role_arns[1]: assertions['https://example.okta.com/app/b']})
+
+
+class LimitedSts:
+    """ Stand-in for an STS client of a role with a MaxSessionDuration of max_duration """
+
+    def __init__(self, max_duration, message="The requested DurationSeconds exceeds the MaxSessionDuration set for "
+                                             "this role."):
+        self.max_duration = max_duration
+        self.message = message
+        self.durations = []
+
+    def assume_role_with_saml(self, RoleArn, PrincipalArn, SAMLAssertion, DurationSeconds=3600):
+        # pylint: disable=C0103
+        self.durations.append(DurationSeconds)
+        if DurationSeconds > self.max_duration:
+            raise StsError('ValidationError', self.message, 400)
+        return {'Credentials': {'AccessKeyId': RoleArn, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                                'Expiration': '2999-01-01T00:00:00Z'}}
+
+
+class AdaptiveDurationTests(TempHomeTestCase):
+
+    ROLE_ARN = 'arn:aws:iam::000000000000:role/admin'
+    PRINCIPAL_ARN = 'arn:aws:iam::000000000000:saml-provider/okta'
+
+    def setUp(self):
+        super().setUp()
+        self.aws_auth = AwsAuth(None, 'default', False, logging.getLogger('okta-awscli'))
+
+    def assume(self, sts, duration=MAX_DURATION):
+        with patch.object(AwsAuth, '_sts_client_for', return_value=sts):
+            return self.aws_auth.get_sts_token(self.ROLE_ARN, self.PRINCIPAL_ARN, 'assertion', duration=duration)
+
+    def test_steps_down_and_remembers_duration(self):
+        sts = LimitedSts(14400)
+        self.assertEqual(self.assume(sts)['AccessKeyId'], self.ROLE_ARN)
+        self.assertEqual(sts.durations, [43200, 36000, 28800, 21600, 14400])
+        self.assertEqual(RoleDurationCache().get(self.ROLE_ARN), 14400)
+
+        sts = LimitedSts(14400)
+        self.assume(sts)
+        self.assertEqual(sts.durations, [14400])
+
+    def test_uses_stated_limit(self):
+        sts = LimitedSts(3600, "1 validation error detected: Value '43200' at 'durationSeconds' failed to satisfy "
+                               "constraint: Member must have value less than or equal to 3600")
+        self.assume(sts)
+        self.assertEqual(sts.durations, [43200, 3600])
+
+    def test_fixed_duration_not_adapted(self):
+        sts = LimitedSts(3600)
+        with self.assertRaises(StsError):
+            self.assume(sts, duration=7200)
+        self.assertEqual(sts.durations, [7200])
+        self.assertIsNone(RoleDurationCache().get(self.ROLE_ARN))
+
+    def test_duration_option(self):
+        config = '[default]\nduration = max\n[short]\nduration = 900\n'
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'), io.StringIO(config))
+        self.assertEqual(okta_auth_config.duration_for('default'), MAX_DURATION)
+        self.assertEqual(okta_auth_config.duration_for('short'), 900)
+
+
+class CredentialsStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.creds_file = os.path.join(self.tmp_dir.name, '.aws', 'credentials')
+        self.store = CredentialsStore(self.creds_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_batch_update_keeps_other_profiles(self):
+        self.store.update({'existing': {'aws_access_key_id': 'old'}})
+        self.store.update({'one': {'aws_access_key_id': '1'}, 'two': {'aws_access_key_id': '2'}})
+        config = self.store.read()
+        self.assertEqual(config.sections(), ['existing', 'one', 'two'])
+        self.assertEqual(config.get('two', 'aws_access_key_id'), '2')
+        self.assertEqual(stat.S_IMODE(os.stat(self.creds_file).st_mode), 0o600)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.creds_file))), ['credentials', 'credentials.lock'])
+
+    def test_concurrent_writers_do_not_lose_profiles(self):
+        writers = [threading.Thread(target=self.store.update, args=({'profile%d' % i: {'aws_access_key_id': str(i)}},))
+                   for i in range(20)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(len(self.store.read().sections()), 20)
+
+    def test_lock_wait_times_out(self):
+        with file_lock(self.creds_file):
+            with self.assertRaises(LockTimeout):
+                with file_lock(self.creds_file, timeout=0.2):
+                    pass
+
+    def test_lock_of_killed_holder_released(self):
+        holder = subprocess.Popen([sys.executable, '-c', 'import sys, time\n'
+                                   'from oktaawscli.file_util import file_lock\n'
+                                   'with file_lock(sys.argv[1]):\n'
+                                   '    print("locked", flush=True)\n'
+                                   '    time.sleep(60)\n', self.creds_file], stdout=subprocess.PIPE)
+        self.assertEqual(holder.stdout.readline(), b'locked\n')
+        with self.assertRaises(LockTimeout):
+            with file_lock(self.creds_file, timeout=0.2):
+                pass
+        holder.kill()
+        holder.wait()
+        holder.stdout.close()
+        with file_lock(self.creds_file, timeout=5):
+            pass
+
+
+class ConfigStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, '.okta-aws')
+        with open(self.path, 'w') as config_file:
+            config_file.write(OKTA_CONFIG)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_changes_written_once_on_commit(self):
+        store = ConfigStore(self.path)
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'), store=store)
+        with patch('oktaawscli.config_store.atomic_write', wraps=atomic_write) as write:
+            for i in range(10):
+                okta_auth_config.save_chosen_role_for_profile('role%d' % i, 'arn:aws:iam::000000000000:role/r%d' % i)
+            okta_auth_config.save_selected_roles('default', ['arn:aws:iam::000000000000:role/r0'])
+            self.assertEqual(write.call_count, 0)
+            self.assertTrue(store.commit())
+            self.assertFalse(store.commit())
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(ConfigStore(self.path).parser.get('role9', 'base-url'), 'example.okta.com')
+
+    def test_unchanged_value_is_not_a_change(self):
+        store = ConfigStore(self.path)
+        store.set('default', 'username', 'user')
+        self.assertFalse(store.dirty)
+
+    def test_commit_keeps_changes_of_other_runs(self):
+        first, second = ConfigStore(self.path), ConfigStore(self.path)
+        first.set('one', 'role', 'arn:aws:iam::000000000000:role/one')
+        second.set('two', 'role', 'arn:aws:iam::000000000000:role/two')
+        first.commit()
+        second.commit()
+        parser = ConfigStore(self.path).parser
+        self.assertEqual(parser.sections(), ['default', 'one', 'two'])
+        self.assertEqual(second.parser.get('one', 'role'), 'arn:aws:iam::000000000000:role/one')
+
+    def test_number_options_fall_back_to_default_profile(self):
+        config = OKTA_CONFIG + 'refresh-skew = 600\nmfa-timeout = soon\n[dev]\nrefresh-lock-timeout = 30\n'
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'), io.StringIO(config))
+        self.assertEqual(okta_auth_config.refresh_skew_for('dev'), 600)
+        self.assertEqual(okta_auth_config.refresh_lock_timeout_for('dev'), 30)
+        self.assertIsNone(okta_auth_config.refresh_lock_timeout_for('default'))
+        with self.assertLogs('okta-awscli', logging.WARNING):
+            self.assertIsNone(okta_auth_config.mfa_timeout_for('dev'))
+
+
+class LocalExpiryTests(TempHomeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.aws_auth = AwsAuth('profile', 'profile', False, logging.getLogger('okta-awscli'))
+
+    def write_token(self, expires_in):
+        expiration = datetime.fromtimestamp(time.time() + expires_in, timezone.utc)
+        self.aws_auth.write_sts_tokens({'profile': {'AccessKeyId': 'id', 'SecretAccessKey': 'secret',
+                                                    'SessionToken': 'token', 'Expiration': expiration}})
+
+    @patch('boto3.Session')
+    def test_fresh_credentials_checked_locally(self, session):
+        self.write_token(3600)
+        self.assertTrue(self.aws_auth.check_sts_token('profile'))
+        session.assert_not_called()
+
+    @patch('boto3.Session')
+    def test_credentials_within_skew_are_refreshed(self, session):
+        self.write_token(AwsAuth.DEFAULT_REFRESH_SKEW - 10)
+        self.assertFalse(self.aws_auth.check_sts_token('profile'))
+        session.assert_not_called()
+
+    def test_expiration_string_parsed(self):
+        self.assertEqual(AwsAuth.expiration_epoch('1970-01-02T00:00:00Z'), 86400)
+
+
+OKTA_CONFIG = """[default]
+base-url = example.okta.com
+username = user
+password = secret
+app-link = https://example.okta.com/home/amazon_aws/0oa/272
+"""
+
+SAML_PAGE = '<html><body><form><input name="SAMLResponse" type="hidden" value="assertion"/></form></body></html>'
+
+
+def fake_response(text, status_code=200):
+    """ A streamed requests response with the given body """
+    body = text.encode('utf-8')
+    resp = MagicMock(text=text, status_code=status_code, encoding='utf-8')
+    resp.iter_content.side_effect = lambda size: (body[i:i + size] for i in range(0, len(body), size))
+    return resp
+
+
+class OktaSessionCacheTests(TempHomeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = logging.getLogger('okta-awscli')
+        self.okta_auth_config = OktaAuthConfig(self.logger, io.StringIO(OKTA_CONFIG))
+        self.cache = OktaSessionCache('https://example.okta.com', 'user')
+
+    def test_session_round_trip(self):
+        self.cache.save('sid123', '2999-01-01T00:00:00.000Z')
+        self.assertEqual(self.cache.load(), 'sid123')
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache.path).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(self.cache.path)).st_mode), 0o700)
+
+    def test_expired_session_not_loaded(self):
+        self.cache.save('sid123', '2000-01-01T00:00:00.000Z')
+        self.assertIsNone(self.cache.load())
+
+    @patch('oktaawscli.okta_auth.default_transport')
+    def test_cached_session_skips_primary_auth(self, transport):
+        session_class = transport.return_value.new_session
+        self.cache.save('sid123', '2999-01-01T00:00:00.000Z')
+        session_class.return_value.get.return_value = fake_response(SAML_PAGE)
+        okta = OktaAuth('default', False, self.logger, None, self.okta_auth_config)
+        with patch.object(okta, 'primary_auth') as primary_auth:
+            _, assertion = okta.get_assertion()
+        primary_auth.assert_not_called()
+        self.assertEqual(assertion, 'assertion')
+        session_class.return_value.get.assert_called_once_with(
+            'https://example.okta.com/home/amazon_aws/0oa/272', stream=True)
+
+    @patch('oktaawscli.okta_auth.default_transport')
+    def test_cached_session_never_prompts_for_password(self, transport):
+        transport.return_value.new_session.return_value.get.return_value = fake_response(SAML_PAGE)
+        self.cache.save('sid123', '2999-01-01T00:00:00.000Z')
+        okta_auth_config = OktaAuthConfig(self.logger, io.StringIO(OKTA_CONFIG.replace('password = secret\n', '')))
+        with patch('oktaawscli.okta_auth_config.getpass', side_effect=AssertionError('prompted')):
+            okta = OktaAuth('default', False, self.logger, None, okta_auth_config)
+            self.assertEqual(okta.get_assertion()[1], 'assertion')
+
+    @patch('oktaawscli.okta_auth.default_transport')
+    def test_expired_okta_session_falls_back_to_login(self, transport):
+        session_class = transport.return_value.new_session
+        self.cache.save('sid123', '2999-01-01T00:00:00.000Z')
+        session_class.return_value.get.side_effect = [fake_response('<html><title>Sign In</title></html>'),
+                                                      fake_response(SAML_PAGE)]
+        okta = OktaAuth('default', False, self.logger, None, self.okta_auth_config)
+        with patch.object(okta, 'primary_auth', return_value='token') as primary_auth, \
+                patch.object(okta, 'get_session', return_value='sid456'):
+            _, assertion = okta.get_assertion()
+        primary_auth.assert_called_once_with()
+        self.assertEqual(assertion, 'assertion')
+        self.assertIsNone(self.cache.load())
+
+
+    @patch('oktaawscli.okta_auth.default_transport')
+    def test_expired_joined_session_without_session_cache(self, transport):
+        transport.return_value.new_session.return_value.get.side_effect = [
+            fake_response('<html><title>Sign In</title></html>'), fake_response(SAML_PAGE)]
+        okta_auth_config = OktaAuthConfig(self.logger, io.StringIO(OKTA_CONFIG + 'session-cache = false\n'))
+        okta = OktaAuth('default', False, self.logger, None, okta_auth_config)
+        okta.session_id = 'sid123'
+        okta = okta.for_app(okta.app_link)
+        with patch.object(okta, 'primary_auth', return_value='token') as primary_auth, \
+                patch.object(okta, 'get_session', return_value='sid456'):
+            self.assertEqual(okta.get_assertion(use_cache=False)[1], 'assertion')
+        primary_auth.assert_called_once_with()
+
+def make_assertion(role_arns, not_on_or_after='2999-01-01T00:00:00.000Z'):
+    """ Builds a base64 encoded SAML response granting role_arns """
+    values = ''.join('<saml2:AttributeValue>arn:aws:iam::%s:saml-provider/okta,%s</saml2:AttributeValue>' %
+                     (arn.split(':')[4], arn) for arn in role_arns)
+    xml = ('<saml2p:Response xmlns:saml2p="urn:oasis:names:tc:SAML:2.0:protocol">'
+           '<saml2:Assertion xmlns:saml2="urn:oasis:names:tc:SAML:2.0:assertion">'
+           '<saml2:Subject><saml2:SubjectConfirmation>'
+           '<saml2:SubjectConfirmationData NotOnOrAfter="%s"/></saml2:SubjectConfirmation></saml2:Subject>'
+           '<saml2:Conditions NotOnOrAfter="%s"/>'
+           '<saml2:AttributeStatement><saml2:Attribute Name="https://aws.amazon.com/SAML/Attributes/Role">%s'
+           '</saml2:Attribute></saml2:AttributeStatement></saml2:Assertion></saml2p:Response>'
+           % (not_on_or_after, not_on_or_after, values))
+    return base64.b64encode(xml.encode('utf-8')).decode('ascii')
+
+
+class SamlAssertionCacheTests(TempHomeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = SamlAssertionCache('https://example.okta.com', 'https://example.okta.com/app', 'user', 2)
+        self.assertion = make_assertion(['arn:aws:iam::000000000000:role/admin'])
+
+    def test_not_on_or_after_parsed(self):
+        assertion = make_assertion([], '1970-01-02T00:00:00.000Z')
+        self.assertEqual(SamlAssertionCache.not_on_or_after(assertion), 86400)
+
+    def test_assertion_reused_until_limit(self):
+        self.cache.save(self.assertion)
+        self.assertEqual(self.cache.load(), self.assertion)
+        self.cache.record_use(2)
+        self.assertIsNone(self.cache.load())
+
+    def test_expired_assertion_not_reused(self):
+        self.cache.save(make_assertion([], '2000-01-01T00:00:00.000Z'))
+        self.assertIsNone(self.cache.load())
+
+    def test_rejected_cached_assertion_is_refetched(self):
+        okta = MagicMock(assertion_from_cache=True)
+        okta.refresh_assertion.return_value = (None, 'fresh')
+        rejected = StsError('InvalidIdentityToken', 'reused', 400)
+        sts_request = StsRequest('arn:aws:iam::000000000000:saml-provider/okta', 'arn:aws:iam::000000000000:role/admin', None)
+        aws_auth = MagicMock()
+        aws_auth.get_sts_tokens.side_effect = [[StsResult(sts_request, None, rejected)],
+                                               [StsResult(sts_request, {'AccessKeyId': 'id'}, None)]]
+        [result] = assume_roles(okta, aws_auth, [sts_request], 'cached', logging.getLogger('okta-awscli'))
+        self.assertEqual(result.credentials, {'AccessKeyId': 'id'})
+        aws_auth.get_sts_tokens.assert_called_with([sts_request], 'fresh')
+
+
+class AccountAliasCacheTests(TempHomeTestCase):
+
+    def test_fetches_only_for_unknown_accounts(self):
+        cache = AccountAliasCache()
+        fetch = MagicMock(return_value={'000000000000': 'prod'})
+        self.assertEqual(cache.lookup(['000000000000', '000000000001'], fetch), {'000000000000': 'prod'})
+        self.assertEqual(cache.lookup(['000000000000', '000000000001'], fetch), {'000000000000': 'prod'})
+        self.assertEqual(fetch.call_count, 1)
+        cache.lookup(['000000000002'], fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_stale_and_invalidated_entries_refetched(self):
+        fetch = MagicMock(return_value={'000000000000': 'prod'})
+        AccountAliasCache(ttl=-1).lookup(['000000000000'], fetch)
+        AccountAliasCache(ttl=-1).lookup(['000000000000'], fetch)
+        self.assertEqual(fetch.call_count, 2)
+        cache = AccountAliasCache()
+        cache.invalidate()
+        cache.lookup(['000000000000'], fetch)
+        self.assertEqual(fetch.call_count, 3)
+
+
+class SamlExtractorTests(unittest.TestCase):
+
+    def test_stops_at_saml_response(self):
+        chunks = iter(['<html><head><title>Amazon</title></head><body><input name="SAMLRe',
+                       'sponse" value="PHNhbWw+&#x3D;"/>', '<p>never parsed</p>'])
+        page = extract_saml_page(chunks)
+        self.assertEqual(page, SamlPage('PHNhbWw+=', 'Amazon', None))
+        self.assertEqual(next(chunks), '<p>never parsed</p>')
+
+    def test_extra_verification_state_token(self):
+        html = ("<html><head><title>Example - Extra Verification</title></head><body>"
+                "<script>var x = 1;\nvar stateToken = '00abc\\x2Ddef';\n</script></body></html>")
+        page = extract_saml_page(html[i:i + 7] for i in range(0, len(html), 7))
+        self.assertIsNone(page.saml_response)
+        self.assertEqual(page.title, 'Example - Extra Verification')
+        self.assertEqual(page.state_token, '00abc\\x2Ddef')
+
+    def test_response_streamed(self):
+        page = extract_from_response(fake_response(SAML_PAGE * 100))
+        self.assertEqual(page.saml_response, 'assertion')
+        page = extract_saml_page(SAML_PAGE[i:i + 3] for i in range(0, len(SAML_PAGE), 3))
+        self.assertEqual(page.saml_response, 'assertion')
+
+
+class RoleCatalogTests(unittest.TestCase):
+
+    ROLE_ARNS = ['arn:aws:iam::000000000000:role/Admin', 'arn:aws:iam::000000000000:role/team/ReadOnly',
+                 'arn:aws:iam::000000000001:role/Admin', 'arn:aws:iam::000000000002:role/AdminBreakGlass']
+
+    def setUp(self):
+        self.catalog = RoleCatalog(extract_roles(make_assertion(reversed(self.ROLE_ARNS))),
+                                   {'000000000000': 'prod-eu', '000000000001': 'prod-us', '000000000002': 'dev'})
+
+    def selected(self, selector=None, account=None):
+        return [self.catalog.roles[p].role_arn for p in self.catalog.select(selector, account)]
+
+    def test_roles_extracted_in_order(self):
+        self.assertEqual(extract_roles(make_assertion(reversed(self.ROLE_ARNS))),
+                         [RoleTuple('arn:aws:iam::%s:saml-provider/okta' % arn.split(':')[4], arn)
+                          for arn in self.ROLE_ARNS])
+
+    def test_selectors(self):
+        self.assertEqual(self.selected(self.ROLE_ARNS[2]), self.ROLE_ARNS[2:3])
+        self.assertEqual(self.selected('prod-*/Admin*'), [self.ROLE_ARNS[0], self.ROLE_ARNS[2]])
+        self.assertEqual(self.selected('*/Admin*', '000000000002'), self.ROLE_ARNS[3:])
+        self.assertEqual(self.selected('ReadOnly'), self.ROLE_ARNS[1:2])
+        self.assertEqual(self.selected(account='prod-eu'), self.ROLE_ARNS[:2])
+        self.assertEqual(self.selected('staging/*'), [])
+        self.assertEqual(self.selected(), self.ROLE_ARNS)
+        self.assertEqual(self.catalog.positions_of(self.ROLE_ARNS[3:] + ['arn:aws:iam::9:role/x']), [3])
+
+    def test_single_match_chosen_without_prompt(self):
+        aws_auth = AwsAuth('profile', 'profile', False, logging.getLogger('okta-awscli'))
+        aws_auth.role = 'prod-us/Adm*'
+        with patch.object(aws_auth, 'account_aliases', return_value={'000000000001': 'prod-us'}), \
+                patch.object(AwsAuth, 'choose_roles') as choose_roles:
+            [(role, option)] = aws_auth.choose_aws_role(make_assertion(self.ROLE_ARNS), [])
+        self.assertEqual(role.role_arn, self.ROLE_ARNS[2])
+        self.assertEqual((option.alias_name, option.role_name), ('prod-us', 'Admin'))
+        choose_roles.assert_not_called()
+
+    def test_menu_narrowed_to_matches(self):
+        aws_auth = AwsAuth('profile', 'profile', False, logging.getLogger('okta-awscli'))
+        aws_auth.account = '000000000000'
+        with patch.object(aws_auth, 'account_aliases', return_value={}), \
+                patch.object(AwsAuth, 'choose_roles', return_value='2') as choose_roles:
+            [(role, _)] = aws_auth.choose_aws_role(make_assertion(self.ROLE_ARNS), [self.ROLE_ARNS[1]])
+        self.assertEqual(role.role_arn, self.ROLE_ARNS[1])
+        self.assertEqual(len(choose_roles.call_args[0][0]), 2)
+        self.assertEqual(choose_roles.call_args[0][1:], ('2', [1]))
+
+
+class RoleCatalogCacheTests(TempHomeTestCase):
+
+    APP_LINK = 'https://example.okta.com/home/amazon_aws/0oa/272'
+    ROLES = [RoleTuple('arn:aws:iam::000000000000:saml-provider/okta', 'arn:aws:iam::000000000000:role/Admin'),
+             RoleTuple('arn:aws:iam::000000000000:saml-provider/okta', 'arn:aws:iam::000000000001:role/ReadOnly')]
+
+    def setUp(self):
+        super().setUp()
+        self.logger = logging.getLogger('okta-awscli')
+        RoleCatalogCache('default').save(self.APP_LINK, self.ROLES, {'000000000000': 'prod', '000000000009': 'other'})
+
+    def test_roles_saved_per_app_link(self):
+        cached = RoleCatalogCache('default').load(self.APP_LINK)
+        self.assertEqual(cached.catalog.roles, self.ROLES)
+        self.assertEqual(cached.catalog.aliases, {'000000000000': 'prod'})
+        self.assertIsNone(RoleCatalogCache('default').load('https://example.okta.com/other'))
+        self.assertEqual(RoleCatalogCache('other').load_all(), [])
+
+    def test_roles_listed_without_okta(self):
+        with patch('builtins.print') as printed:
+            self.assertEqual(print_roles('default', 'prod/*', None, self.logger), 0)
+        self.assertEqual([c[0][0].split() for c in printed.call_args_list],
+                         [['prod/Admin', 'arn:aws:iam::000000000000:role/Admin']])
+        self.assertEqual(print_roles('other', None, None, self.logger), 1)
+
+    def test_role_chosen_before_login(self):
+        aws_auth = AwsAuth('profile', 'profile', False, self.logger)
+        aws_auth.role = '*/ReadOnly'
+        okta = MagicMock(app_link=self.APP_LINK)
+        okta.has_cached_assertion.return_value = False
+        self.assertEqual(choose_cached_role(aws_auth, okta, 'default', self.logger), self.ROLES[1])
+        okta.get_assertion.assert_not_called()
+
+
+class StartupTests(unittest.TestCase):
+
+    # Cumulative import time budget of the CLI module, override for slow machines
+    IMPORT_BUDGET_MS = int(os.environ.get('OKTA_AWSCLI_IMPORT_BUDGET_MS', 150))
+    HEAVY_MODULES = ('boto3', 'botocore', 'bs4', 'requests')
+
+    @staticmethod
+    def import_times(module):
+        """ Cumulative import time in ms of every module loaded by importing module """
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stderr
+        times = {}
+        for line in output.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative) / 1000.0
+        return times
+
+    def test_heavy_dependencies_not_imported(self):
+        times = self.import_times('oktaawscli.okta_awscli')
+        self.assertIn('oktaawscli.okta_awscli', times)
+        self.assertEqual([m for m in self.HEAVY_MODULES if m in times], [])
+
+    def test_import_within_budget(self):
+        best = min(self.import_times('oktaawscli.okta_awscli')['oktaawscli.okta_awscli'] for _ in range(3))
+        self.assertLess(best, self.IMPORT_BUDGET_MS)
+
+
+STS_RESPONSE = """<AssumeRoleWithSAMLResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleWithSAMLResult>
+    <Credentials>
+      <AccessKeyId>ASIAEXAMPLE</AccessKeyId>
+      <SecretAccessKey>secret</SecretAccessKey>
+      <SessionToken>token</SessionToken>
+      <Expiration>2999-01-01T00:00:00Z</Expiration>
+    </Credentials>
+  </AssumeRoleWithSAMLResult>
+</AssumeRoleWithSAMLResponse>"""
+
+STS_ERROR = """<ErrorResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <Error><Type>Sender</Type><Code>ValidationError</Code><Message>Invalid DurationSeconds</Message></Error>
+</ErrorResponse>"""
+
+
+class FakeStsHandler(BaseHTTPRequestHandler):
+    """ Answers AssumeRoleWithSAML, failing for roles named 'invalid' """
+    requests = []
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        FakeStsHandler.requests.append(form)
+        status, body = (400, STS_ERROR) if form['RoleArn'][0].endswith('invalid') else (200, STS_RESPONSE)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class StsClientTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FakeStsHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.client = StsClient('http://127.0.0.1:%d/' % cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_assume_role_with_saml(self):
+        response = self.client.assume_role_with_saml(RoleArn='arn:aws:iam::000000000000:role/admin',
+                                                     PrincipalArn='arn:aws:iam::000000000000:saml-provider/okta',
+                                                     SAMLAssertion='assertion', DurationSeconds=900)
+        self.assertEqual(response['Credentials']['AccessKeyId'], 'ASIAEXAMPLE')
+        self.assertEqual(response['Credentials']['Expiration'], datetime(2999, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(FakeStsHandler.requests[-1]['Action'], ['AssumeRoleWithSAML'])
+        self.assertEqual(FakeStsHandler.requests[-1]['DurationSeconds'], ['900'])
+
+    def test_error_mapped(self):
+        with self.assertRaises(StsError) as ctx:
+            self.client.assume_role_with_saml(RoleArn='arn:aws:iam::000000000000:role/invalid',
+                                              PrincipalArn='arn:aws:iam::000000000000:saml-provider/okta',
+                                              SAMLAssertion='assertion')
+        self.assertEqual(ctx.exception.response['Error']['Code'], 'ValidationError')
+        self.assertEqual(AwsAuth.sts_error_message(ctx.exception), 'Invalid DurationSeconds')
+
+    def test_partition_endpoints(self):
+        self.assertEqual(StsClient.endpoint_for('aws'), 'https://sts.amazonaws.com')
+        self.assertEqual(StsClient.endpoint_for('aws', 'eu-west-1'), 'https://sts.eu-west-1.amazonaws.com')
+        self.assertEqual(StsClient.endpoint_for('aws-us-gov', 'eu-west-1'), 'https://sts.us-gov-west-1.amazonaws.com')
+        self.assertEqual(StsClient.endpoint_for('aws-cn'), 'https://sts.cn-north-1.amazonaws.com.cn')
+
+    def test_settings_fall_back_to_default_profile(self):
+        config = OKTA_CONFIG + ('sts-backend = boto3\nsts-region = eu-west-1\nsts-endpoint = http://127.0.0.1:1\n'
+                                'signin-url = http://127.0.0.1:2/saml\nrefresh-skew = 600\nalias-cache-ttl = 60\n'
+                                '[dev]\nsts-region = us-east-2\n')
+        aws_auth = AwsAuth(None, 'dev', False, logging.getLogger('okta-awscli'),
+                           config_store=ConfigStore(file_handle=io.StringIO(config)))
+        self.assertEqual((aws_auth.sts_backend, aws_auth.sts_region, aws_auth.sts_endpoint, aws_auth.signin_url),
+                         ('boto3', 'us-east-2', 'http://127.0.0.1:1', 'http://127.0.0.1:2/saml'))
+        self.assertEqual((aws_auth.refresh_skew, aws_auth.alias_cache_ttl), (600, 60))
+
+
+class CredentialProcessTests(TempHomeTestCase):
+
+    ROLE_ARN = 'arn:aws:iam::000000000000:role/admin'
+
+    def setUp(self):
+        super().setUp()
+        self.logger = logging.getLogger('okta-awscli')
+        self.okta_auth_config = OktaAuthConfig(self.logger, io.StringIO(OKTA_CONFIG))
+        self.aws_auth = AwsAuth(None, 'default', False, self.logger)
+        self.sts_token = {'AccessKeyId': 'id', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                          'Expiration': datetime(2999, 1, 1, tzinfo=timezone.utc)}
+
+    def run_credential_process(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            status = print_credential_process(self.aws_auth, 'default', self.ROLE_ARN, self.logger, None,
+                                              self.okta_auth_config)
+        return status, json.loads(stdout.getvalue())
+
+    @patch('oktaawscli.okta_awscli.refresh_role_credentials')
+    def test_refreshes_once_then_serves_from_cache(self, refresh):
+        refresh.return_value = self.sts_token
+        for _ in range(2):
+            status, document = self.run_credential_process()
+            self.assertEqual(status, 0)
+            self.assertEqual(document, {'Version': 1, 'AccessKeyId': 'id', 'SecretAccessKey': 'secret',
+                                        'SessionToken': 'token', 'Expiration': '2999-01-01T00:00:00Z'})
+        self.assertEqual(refresh.call_count, 1)
+
+    @patch('oktaawscli.okta_awscli.refresh_role_credentials')
+    def test_credentials_near_expiry_refreshed(self, refresh):
+        refresh.return_value = dict(self.sts_token, Expiration=datetime.fromtimestamp(time.time() + 60, timezone.utc))
+        self.run_credential_process()
+        self.run_credential_process()
+        self.assertEqual(refresh.call_count, 2)
+
+
+class ReversingCipher:
+    """ Stand-in for a Fernet """
+
+    def encrypt(self, data):
+        return base64.b64encode(data[::-1])
+
+    def decrypt(self, token):
+        return base64.b64decode(token)[::-1]
+
+
+class CredentialCacheTests(TempHomeTestCase):
+
+    KEY = CredentialCache.key_for('example.okta.com', 'user', 'arn:aws:iam::000000000000:role/admin', None)
+    STS_TOKEN = {'AccessKeyId': 'id', 'SecretAccessKey': 'secret', 'SessionToken': 'token'}
+
+    def setUp(self):
+        super().setUp()
+        self.expires_at = int(time.time()) + 3600
+
+    def test_encrypted_at_rest(self):
+        CredentialCache(cipher=ReversingCipher()).put(self.KEY, self.STS_TOKEN, self.expires_at)
+        with open(CredentialCache.path_for(self.KEY)) as cache_file:
+            self.assertNotIn('secret', cache_file.read())
+        self.assertEqual(CredentialCache(cipher=ReversingCipher()).get(self.KEY)['SecretAccessKey'], 'secret')
+        self.assertIsNone(CredentialCache().get(self.KEY))
+        self.assertIsNone(CredentialCache().get(self.KEY[:3] + (43200,)))
+
+    @unittest.skipUnless(importlib.util.find_spec('cryptography'), 'needs cryptography')
+    def test_key_from_environment(self):
+        with patch.dict(os.environ, {KEY_ENV: 'one'}):
+            CredentialCache(cipher=cache_cipher()).put(self.KEY, self.STS_TOKEN, self.expires_at)
+            self.assertEqual(CredentialCache(cipher=cache_cipher()).get(self.KEY)['AccessKeyId'], 'id')
+        with patch.dict(os.environ, {KEY_ENV: 'two'}):
+            self.assertIsNone(CredentialCache(cipher=cache_cipher()).get(self.KEY))
+
+    def test_console_served_from_cache(self):
+        logger = logging.getLogger('okta-awscli')
+        okta_auth_config = OktaAuthConfig(logger, io.StringIO(OKTA_CONFIG))
+        aws_auth = AwsAuth(None, 'default', False, logger)
+        aws_auth.role = self.KEY[2]
+        with patch('builtins.print') as printed:
+            self.assertFalse(print_cached_exports(aws_auth, 'default', False, okta_auth_config))
+            with patch('oktaawscli.okta_awscli.cache_cipher', return_value=ReversingCipher()):
+                CredentialCache(cipher=ReversingCipher()).put(self.KEY, self.STS_TOKEN, self.expires_at)
+                self.assertTrue(print_cached_exports(aws_auth, 'default', False, okta_auth_config))
+        self.assertIn('export AWS_SECRET_ACCESS_KEY=secret', printed.call_args[0][0])
+
+    def test_console_cached_in_plain_text_only_with_flag(self):
+        logger = logging.getLogger('okta-awscli')
+        okta_auth_config = OktaAuthConfig(logger, io.StringIO(OKTA_CONFIG))
+        aws_auth = AwsAuth(None, 'default', False, logger)
+        sts_token = dict(self.STS_TOKEN, Expiration='2999-01-01T00:00:00Z')
+        key = credential_key(okta_auth_config, 'default', self.KEY[2])
+        with patch('oktaawscli.okta_awscli.cache_cipher', return_value=None):
+            cache_console_credentials(aws_auth, okta_auth_config, 'default', self.KEY[2], sts_token, False, logger)
+            self.assertFalse(os.path.exists(CredentialCache.path_for(key)))
+            with self.assertLogs(logger, logging.WARNING):
+                cache_console_credentials(aws_auth, okta_auth_config, 'default', self.KEY[2], sts_token, True, logger)
+        self.assertEqual(CredentialCache().get(key)['SecretAccessKey'], 'secret')
+
+
+class FastPathTests(TempHomeTestCase):
+
+    # Cumulative import time budget of okta-awscli-env, override for slow machines
+    IMPORT_BUDGET_MS = int(os.environ.get('OKTA_AWSCLI_ENV_IMPORT_BUDGET_MS', 50))
+    ROLE_ARN = 'arn:aws:iam::000000000000:role/admin'
+    STS_TOKEN = {'AccessKeyId': 'id', 'SecretAccessKey': 'secret', 'SessionToken': 'token'}
+
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.tmp_dir.name, '.okta-aws'), 'w') as config_file:
+            config_file.write(OKTA_CONFIG + 'role = %s\n' % self.ROLE_ARN)
+        self.expires_at = int(time.time()) + 3600
+
+    def run_fastpath(self, *argv):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout, patch('sys.stderr', new_callable=io.StringIO):
+            status = fastpath.main(list(argv))
+        return (status, stdout.getvalue())
+
+    def test_refresh_needed_without_cached_credentials(self):
+        self.assertEqual(self.run_fastpath(), (fastpath.EXIT_REFRESH_NEEDED, ''))
+        CredentialCache().put(CredentialCache.key_for('example.okta.com', 'user', self.ROLE_ARN, None),
+                              self.STS_TOKEN, int(time.time()) + 60)
+        self.assertEqual(self.run_fastpath()[0], fastpath.EXIT_REFRESH_NEEDED)
+
+    def test_empty_config_neither_prompts_nor_writes(self):
+        config_path = os.path.join(self.tmp_dir.name, '.okta-aws')
+        open(config_path, 'w').close()
+        with patch('builtins.input', side_effect=AssertionError('prompted')):
+            self.assertEqual(self.run_fastpath(), (fastpath.EXIT_REFRESH_NEEDED, ''))
+        self.assertEqual(os.path.getsize(config_path), 0)
+
+    def test_prints_cached_credentials(self):
+        CredentialCache().put(CredentialCache.key_for('example.okta.com', 'user', self.ROLE_ARN, None),
+                              self.STS_TOKEN, self.expires_at)
+        (status, output) = self.run_fastpath()
+        self.assertEqual(status, 0)
+        self.assertIn('export AWS_SECRET_ACCESS_KEY=secret', output)
+        (status, output) = self.run_fastpath('--json')
+        self.assertEqual(json.loads(output)['Version'], 1)
+        self.assertEqual(json.loads(output)['SessionToken'], 'token')
+        self.assertEqual(self.run_fastpath('--role', self.ROLE_ARN + '2')[0], fastpath.EXIT_REFRESH_NEEDED)
+
+    def test_profile_credentials(self):
+        CredentialsStore(os.path.join(self.tmp_dir.name, '.aws', 'credentials')).update({'dev': {
+            'aws_access_key_id': 'id', 'aws_secret_access_key': 'secret', 'aws_session_token': 'token',
+            'okta_expiration_time': str(self.expires_at)}})
+        (status, output) = self.run_fastpath('--profile', 'dev', '--json')
+        self.assertEqual(status, 0)
+        self.assertEqual(json.loads(output)['AccessKeyId'], 'id')
+        self.assertEqual(self.run_fastpath('--profile', 'prod')[0], fastpath.EXIT_REFRESH_NEEDED)
+
+    def test_imports_no_cli_dependencies(self):
+        times = StartupTests.import_times('oktaawscli.fastpath')
+        self.assertIn('oktaawscli.fastpath', times)
+        self.assertEqual([m for m in StartupTests.HEAVY_MODULES + ('click', 'logging') if m in times], [])
+
+    def test_import_within_budget(self):
+        best = min(StartupTests.import_times('oktaawscli.fastpath')['oktaawscli.fastpath'] for _ in range(3))
+        self.assertLess(best, self.IMPORT_BUDGET_MS)
+
+    def run_process(self, *argv):
+        """ Runs okta-awscli-env with stdin at end of file, so a prompt would fail it """
+        return subprocess.run([sys.executable, '-m', 'oktaawscli.fastpath'] + list(argv), stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30,
+                              env=dict(os.environ, HOME=self.tmp_dir.name),
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    def test_miss_exits_without_output(self):
+        process = self.run_process('--okta-profile', 'other')
+        self.assertEqual((process.returncode, process.stdout), (fastpath.EXIT_REFRESH_NEEDED, b''))
+        self.assertIn(b'run okta-awscli', process.stderr)
+
+    def test_missing_or_empty_config_exits_without_prompting(self):
+        config_path = os.path.join(self.tmp_dir.name, '.okta-aws')
+        os.remove(config_path)
+        process = self.run_process()
+        self.assertEqual((process.returncode, process.stdout), (fastpath.EXIT_REFRESH_NEEDED, b''))
+        self.assertFalse(os.path.exists(config_path))
+        open(config_path, 'w').close()
+        process = self.run_process()
+        self.assertEqual((process.returncode, process.stdout), (fastpath.EXIT_REFRESH_NEEDED, b''))
+        self.assertEqual(os.path.getsize(config_path), 0)
+
+
+class BulkLoginTests(TempHomeTestCase):
+
+    ROLE_ARNS = ['arn:aws:iam::000000000000:role/admin', 'arn:aws:iam::000000000001:role/admin',
+                 'arn:aws:iam::000000000002:role/admin']
+    CONFIG = OKTA_CONFIG + """
+[one]
+username = user
+password = secret
+role = %s
+aws-profile = first
+
+[two]
+username = user
+password = secret
+role = %s
+
+[other-app]
+username = user
+password = secret
+app-link = https://example.okta.com/home/amazon_aws/0ob/272
+role = %s
+""" % tuple(ROLE_ARNS)
+
+    def setUp(self):
+        super().setUp()
+        self.logger = logging.getLogger('okta-awscli')
+        self.okta_auth_config = OktaAuthConfig(self.logger, io.StringIO(self.CONFIG))
+
+    @staticmethod
+    def fake_sts_token(role_arn, principal_arn, assertion, duration=None, logger=None):
+        return {'AccessKeyId': role_arn, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                'Expiration': datetime(2999, 1, 1, tzinfo=timezone.utc)}
+
+    @patch.object(AwsAuth, '_sts_client_for')
+    def test_one_login_per_user_and_one_assertion_per_app(self, _):
+        assertion = make_assertion(self.ROLE_ARNS)
+        with patch.object(OktaAuth, 'open_session', autospec=True) as open_session, \
+                patch.object(OktaAuth, 'get_assertion', return_value=(None, assertion)) as get_assertion, \
+                patch.object(AwsAuth, 'get_sts_token', side_effect=self.fake_sts_token):
+            status = login_profiles(['one', 'two', 'other-app'], False, self.logger, None, self.okta_auth_config)
+
+        self.assertEqual(status, 0)
+        open_session.assert_called_once()
+        self.assertEqual(get_assertion.call_count, 2)
+        credentials = CredentialsStore(os.path.join(self.tmp_dir.name, '.aws', 'credentials')).read()
+        self.assertEqual(credentials.sections(), ['first', 'two', 'other-app'])
+        self.assertEqual(credentials.get('other-app', 'aws_access_key_id'), self.ROLE_ARNS[2])
+
+    def test_profiles_without_role_fail(self):
+        self.assertEqual(login_profiles(['default'], False, self.logger, None, self.okta_auth_config), 1)
+
+    def test_prompted_password_only_reused_for_same_user(self):
+        config = '[a]\nbase-url = one.okta.com\nusername = alice\n[b]\nbase-url = two.okta.com\nusername = bob\n' \
+                 '[c]\nbase-url = one.okta.com\nusername = alice\n'
+        okta_auth_config = OktaAuthConfig(self.logger, io.StringIO(config))
+        with patch('oktaawscli.okta_auth_config.getpass', side_effect=['alice-pw', 'bob-pw']) as prompt:
+            passwords = [okta_auth_config.password_for(profile) for profile in ('a', 'b', 'c')]
+        self.assertEqual(passwords, ['alice-pw', 'bob-pw', 'alice-pw'])
+        self.assertEqual(prompt.call_count, 2)
+
+
+class CredentialAgentTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def refresher(self, name, lifetime):
+        def refresh():
+            self.calls.append(name)
+            return {'AccessKeyId': name, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                    'Expiration': datetime.fromtimestamp(time.time() + lifetime, timezone.utc)}
+        return refresh
+
+    def test_refreshes_ahead_of_expiration(self):
+        agent = CredentialAgent({'short': self.refresher('short', 3), 'long': self.refresher('long', 3600)},
+                                logging.getLogger('okta-awscli'), refresh_skew=2, jitter=0)
+        agent.start()
+        try:
+            self.assertEqual(agent.get('long')['AccessKeyId'], 'long')
+            time.sleep(1.5)
+            self.assertGreaterEqual(self.calls.count('short'), 2)
+            self.assertEqual(self.calls.count('long'), 1)
+        finally:
+            agent.stop()
+
+    def test_serves_http_and_unix_socket(self):
+        agent = CredentialAgent({'dev': self.refresher('dev', 3600)}, logging.getLogger('okta-awscli'))
+        agent.start()
+        socket_path = os.path.join(self.tmp_dir.name, 'agent.sock')
+        servers = [serve_http(agent, 0, 'secret-token'), serve_unix(agent, socket_path)]
+        try:
+            url = 'http://127.0.0.1:%d/dev' % servers[0].server_address[1]
+            request = urllib.request.Request(url, headers={'Authorization': 'secret-token'})
+            document = json.loads(urllib.request.urlopen(request).read().decode('utf-8'))
+            self.assertEqual((document['AccessKeyId'], document['Token']), ('dev', 'token'))
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url)
+
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(socket_path)
+                client.sendall(b'dev\n')
+                document = json.loads(client.makefile().readline())
+            self.assertEqual((document['Version'], document['SessionToken']), (1, 'token'))
+        finally:
+            agent.stop()
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+
+class FakeClock:
+    """ Clock whose sleep advances time instantly """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class PollerTests(TempHomeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+
+    def poller(self, **kwargs):
+        return Poller(sleep=self.clock.sleep, clock=self.clock.time, jitter=0, **kwargs)
+
+    def test_fast_then_exponential_backoff(self):
+        poller = self.poller(deadline=300)
+        answers = iter([False] * 9 + [True])
+        self.assertTrue(poller.poll(lambda: next(answers), bool))
+        self.assertEqual(poller.polls, 10)
+        # 4 fast polls of 0.5s, then 0.75, 1.125, ... capped at 5s
+        self.assertAlmostEqual(poller.waited, 2.0 + sum(min(5.0, 0.5 * 1.5 ** n) for n in range(1, 6)))
+
+    def test_deadline(self):
+        poller = self.poller(deadline=30)
+        with self.assertRaises(PollTimeout):
+            poller.poll(lambda: False, bool)
+        self.assertLessEqual(self.clock.now, 30)
+        self.assertLess(poller.polls, 15)
+
+    def test_rate_limit_headers_honored(self):
+        poller = self.poller()
+        limited = MagicMock(status_code=429, headers={'Retry-After': '7'})
+        self.assertEqual(poller.next_delay(limited), 7)
+        self.clock.now = 1000.0
+        reset = MagicMock(status_code=429, headers={'X-Rate-Limit-Reset': '1012'})
+        self.assertEqual(poller.next_delay(reset), 12)
+
+    def test_push_verification_polls_session(self):
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'), io.StringIO(OKTA_CONFIG))
+        okta = OktaAuth('default', False, logging.getLogger('okta-awscli'), None, okta_auth_config)
+        waiting = {'status': 'MFA_CHALLENGE', 'factorResult': 'WAITING',
+                   '_links': {'next': {'href': 'https://example.okta.com/api/v1/authn/factors/f/verify'}}}
+        okta.session = MagicMock()
+        okta.session.post.side_effect = [MagicMock(status_code=200, json=MagicMock(return_value=waiting))] * 4 + [
+            MagicMock(status_code=200, json=MagicMock(return_value={'status': 'SUCCESS', 'sessionToken': 'token'}))]
+        factor = {'factorType': 'push', '_links': {'verify': {'href': 'https://example.okta.com/verify'}}}
+        with patch('oktaawscli.poller.time.sleep'), patch('builtins.print'):
+            self.assertEqual(okta.verify_single_factor(factor, 'state'), 'token')
+        self.assertEqual(okta.session.post.call_count, 5)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, '.okta-aws-cache', 'sessions')))
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """ HTTP/1.1 server answering GET /flaky with 503 once, everything else with 200 """
+    protocol_version = 'HTTP/1.1'
+    paths = []
+
+    def do_GET(self):
+        KeepAliveHandler.paths.append(self.path)
+        status = 503 if self.path == '/flaky' and KeepAliveHandler.paths.count('/flaky') == 1 else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTests(unittest.TestCase):
+
+    def setUp(self):
+        KeepAliveHandler.paths = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.transport = Transport(backoff_factor=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sessions_share_connections(self):
+        for _ in range(3):
+            self.assertEqual(self.transport.new_session().get(self.url + '/').status_code, 200)
+        self.assertEqual(self.transport.stats.snapshot()['127.0.0.1'], {'requests': 3, 'opened': 1, 'reused': 2})
+
+    def test_default_timeout(self):
+        with patch('requests.adapters.HTTPAdapter.send', side_effect=RuntimeError) as send:
+            with self.assertRaises(RuntimeError):
+                self.transport.new_session().get(self.url + '/')
+        self.assertEqual(send.call_args[1]['timeout'], Transport.DEFAULT_TIMEOUT)
+
+    def test_idempotent_request_retried(self):
+        self.assertEqual(self.transport.new_session().get(self.url + '/flaky').status_code, 200)
+        self.assertEqual(KeepAliveHandler.paths, ['/flaky', '/flaky'])
+
+    def test_configured_timeout_and_retries(self):
+        okta_auth_config = OktaAuthConfig(logging.getLogger('okta-awscli'),
+                                          io.StringIO(OKTA_CONFIG + 'read-timeout = 5\nhttp-retries = 0\n'))
+        with patch.object(transport_module, '_default_transport', None), \
+                patch.object(transport_module, '_default_transport_args', {}):
+            transport_module.configure_default_transport(okta_auth_config.connect_timeout_for('default'),
+                                                         okta_auth_config.read_timeout_for('default'),
+                                                         okta_auth_config.http_retries_for('default'))
+            session = transport_module.default_transport().new_session()
+        with patch('requests.adapters.HTTPAdapter.send', side_effect=RuntimeError) as send:
+            with self.assertRaises(RuntimeError):
+                session.get(self.url + '/')
+        self.assertEqual(send.call_args[1]['timeout'], (10, 5))
+        self.assertEqual(session.get(self.url + '/flaky').status_code, 503)
+
+
+class EndToEndTests(unittest.TestCase):
+    """ okta-awscli processes logging in against the local stand-ins of the benchmark """
+
+    def setUp(self):
+        self.services = FakeServices().start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.home = self.tmp_dir.name
+
+    def tearDown(self):
+        self.services.stop()
+        self.tmp_dir.cleanup()
+
+    def credentials(self):
+        with open(os.path.join(self.home, '.aws', 'credentials')) as credentials_file:
+            return credentials_file.read()
+
+    def test_single_role(self):
+        bench_e2e.write_config(self.home, self.services.base_url, 2, 'single', False)
+        self.assertEqual(bench_e2e.run_once(self.home, 'single')[2], 0)
+        self.assertEqual(self.services.take_counts(), {'okta': 3, 'sts': 1})
+        self.assertIn('aws_access_key_id = ASIA000000000001', self.credentials())
+        listed = subprocess.run([sys.executable, '-m', 'oktaawscli.okta_awscli', '--list-roles'], check=True,
+                                stdout=subprocess.PIPE, env=dict(os.environ, HOME=self.home)).stdout.decode()
+        self.assertEqual(listed.split(), ['000000000000/Admin', 'arn:aws:iam::000000000000:role/team-0/Admin',
+                                          '000000000001/Admin', 'arn:aws:iam::000000000001:role/team-1/Admin'])
+
+    def test_concurrent_runs_share_one_login(self):
+        bench_e2e.write_config(self.home, self.services.base_url, 1, 'single', False)
+        runs = [subprocess.Popen([sys.executable, '-m', 'oktaawscli.okta_awscli', '--profile', 'bench'],
+                                 env=dict(os.environ, HOME=self.home), stdin=subprocess.DEVNULL) for _ in range(4)]
+        self.assertEqual([run.wait() for run in runs], [0, 0, 0, 0])
+        self.assertEqual(self.services.take_counts(), {'okta': 3, 'sts': 1})
+
+    def test_sequential_forced_runs_each_refresh(self):
+        bench_e2e.write_config(self.home, self.services.base_url, 1, 'single', False)
+        self.assertEqual([bench_e2e.run_once(self.home, 'single')[2] for _ in range(2)], [0, 0])
+        self.assertEqual(self.services.take_counts()['sts'], 2)
+
+    def test_selected_roles_with_aliases(self):
+        bench_e2e.write_config(self.home, self.services.base_url, 3, 'alias', False)
+        self.assertEqual(bench_e2e.run_once(self.home, 'alias')[2], 0)
+        self.assertEqual(self.services.take_counts(), {'okta': 3, 'sts': 3, 'signin': 1})
+        self.assertIn('[alias-000000000002-Admin]', self.credentials())
+
+
+class TimingsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = Recorder()
+        self.recorder.enable()
+        self.patch = patch.object(timings, 'recorder', self.recorder)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_human_wait_kept_apart(self):
+        with timings.span('okta.get_session'):
+            time.sleep(0.01)
+        with timings.span('okta.mfa', timings.HUMAN):
+            time.sleep(0.05)
+        summary = self.recorder.summary()
+        self.assertEqual(summary[1].split()[:3], ['okta.mfa', 'human', '1'])
+        waited = float(summary[-1].split(': ')[1].split()[0])
+        self.assertGreaterEqual(waited, 50)
+
+    def test_disabled_recorder_records_nothing(self):
+        self.recorder.enabled = False
+        with timings.span('okta.get_session'):
+            pass
+        self.assertEqual(self.recorder.spans, [])
+
+    def test_http_requests_recorded(self):
+        KeepAliveHandler.paths = []
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            Transport(backoff_factor=0).new_session().get('http://127.0.0.1:%d/flaky' % server.server_port)
+        finally:
+            server.shutdown()
+            server.server_close()
+        [span] = self.recorder.spans
+        self.assertEqual((span.name, span.category), ('HTTP GET 127.0.0.1', 'http'))
+        self.assertEqual(span.args, {'path': '/flaky', 'status': 200, 'bytes': '2', 'retries': 1})
+
+    def test_chrome_trace(self):
+        with timings.span('sts.assume_role', role='arn:aws:iam::000000000000:role/admin'):
+            pass
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'trace.json')
+            self.recorder.write_trace(path)
+            with open(path) as trace_file:
+                [event] = json.load(trace_file)
+        self.assertEqual((event['name'], event['ph']), ('sts.assume_role', 'X'))
+        self.assertEqual(event['args'], {'role': 'arn:aws:iam::000000000000:role/admin'})
+
+
 if __name__ == '__main__':
     unittest.main()
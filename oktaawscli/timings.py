@@ -0,0 +1,110 @@
+""" Timing spans of the phases and HTTP requests of a run, for --timings and --trace-file """
+import functools
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+Span = namedtuple("Span", ["name", "category", "start", "duration", "thread", "args"])
+
+# Spans of this category measure time spent waiting for the user, e.g. for an MFA approval
+HUMAN = 'human'
+
+
+class Recorder:
+    """ Collects spans while enabled. Disabled, recording costs a flag check. """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.time()
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.time()
+
+    def record(self, name, category, start, duration, **args):
+        """ Records a span that started at the start epoch time and took duration seconds """
+        if not self.enabled:
+            return
+        span = Span(name, category, start, duration, threading.current_thread().name, args)
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, category='phase', **args):
+        """ Records the block as a span. args can be updated inside the block. """
+        if not self.enabled:
+            yield args
+            return
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.record(name, category, start, time.time() - start, **args)
+
+    def summary(self):
+        """ Lines of a table with the count, total and maximum duration of each span name,
+        followed by the time waited for the user and the time spent by the machine """
+        with self._lock:
+            spans = list(self.spans)
+        rows = {}
+        for span in spans:
+            row = rows.setdefault((span.category, span.name), [0, 0.0, 0.0])
+            row[0] += 1
+            row[1] += span.duration
+            row[2] = max(row[2], span.duration)
+
+        lines = ["%-40s %-6s %6s %10s %10s" % ('span', 'kind', 'count', 'total ms', 'max ms')]
+        for ((category, name), (count, total, longest)) in sorted(rows.items(), key=lambda r: -r[1][1]):
+            lines.append("%-40s %-6s %6d %10.1f %10.1f" % (name[:40], category, count, total * 1000, longest * 1000))
+        elapsed = time.time() - self.origin
+        human = sum(span.duration for span in spans if span.category == HUMAN)
+        lines.append("elapsed %.1f ms: %.1f ms waiting for you, %.1f ms machine" %
+                     (elapsed * 1000, human * 1000, (elapsed - human) * 1000))
+        return lines
+
+    def write_trace(self, path):
+        """ Writes the spans in the Chrome trace event format (chrome://tracing,
+        Perfetto), one event per line """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        threads = {}
+        events = []
+        for span in spans:
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int((span.start - self.origin) * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': threads.setdefault(span.thread, len(threads) + 1),
+                'args': span.args,
+            })
+        with open(path, 'w') as trace_file:
+            trace_file.write('[\n')
+            trace_file.write(',\n'.join(json.dumps(event, sort_keys=True, default=str) for event in events))
+            trace_file.write('\n]\n')
+
+
+recorder = Recorder()
+
+
+def span(name, category='phase', **args):
+    """ Context manager recording a span on the process recorder """
+    return recorder.span(name, category, **args)
+
+
+def timed(name, category='phase'):
+    """ Decorator recording every call of a function as a span """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with recorder.span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,138 @@
+""" Pooled HTTP transport shared by every Okta and AWS call """
+import threading
+import time
+from urllib.parse import urlparse
+
+from oktaawscli import timings
+
+
+class TransportStats:
+    """ Counts requests and opened connections (TCP/TLS handshakes) per host """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.connections = {}
+
+    def record_request(self, host):
+        with self._lock:
+            self.requests[host] = self.requests.get(host, 0) + 1
+
+    def record_connect(self, host):
+        with self._lock:
+            self.connections[host] = self.connections.get(host, 0) + 1
+
+    def snapshot(self):
+        """ {host: {'requests': n, 'opened': n, 'reused': n}} """
+        with self._lock:
+            hosts = set(self.requests) | set(self.connections)
+            result = {}
+            for host in sorted(hosts):
+                requests = self.requests.get(host, 0)
+                opened = self.connections.get(host, 0)
+                result[host] = {'requests': requests, 'opened': opened, 'reused': max(0, requests - opened)}
+            return result
+
+    def summary(self):
+        """ One line per host, for logging """
+        return ["%s: %d requests, %d connections opened, %d reused" %
+                (host, counts['requests'], counts['opened'], counts['reused'])
+                for (host, counts) in self.snapshot().items()]
+
+
+class Transport:
+    """ One connection pool per host with keep-alive, default timeouts and
+    retries with backoff for idempotent requests. Sessions created by
+    new_session() have their own cookies but share the pooled connections. """
+
+    DEFAULT_TIMEOUT = (10, 60)
+    DEFAULT_RETRIES = 3
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout=None, retries=None, backoff_factor=0.3, pool_maxsize=10):
+        self.stats = TransportStats()
+        self.adapter = self.__new_adapter(timeout or self.DEFAULT_TIMEOUT,
+                                          self.DEFAULT_RETRIES if retries is None else retries,
+                                          backoff_factor, pool_maxsize)
+
+    def new_session(self):
+        """ A requests session using the shared connection pools """
+        import requests
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def __new_adapter(self, timeout, retries, backoff_factor, pool_maxsize):
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+        from urllib3.util.retry import Retry
+
+        stats = self.stats
+
+        def counting(connection_class):
+            def connect(conn):
+                stats.record_connect(conn.host)
+                return connection_class.connect(conn)
+            return type(connection_class.__name__, (connection_class,), {'connect': connect})
+
+        pool_classes = {
+            'http': type('HTTPConnectionPool', (HTTPConnectionPool,), {'ConnectionCls': counting(HTTPConnection)}),
+            'https': type('HTTPSConnectionPool', (HTTPSConnectionPool,), {'ConnectionCls': counting(HTTPSConnection)}),
+        }
+
+        retry_args = dict(total=retries, backoff_factor=backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                          raise_on_status=False)
+        if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+            retry = Retry(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, **retry_args)
+        else:
+            # urllib3 < 1.26
+            retry = Retry(method_whitelist=Retry.DEFAULT_METHOD_WHITELIST, **retry_args)  # pylint: disable=E1101,E1123
+
+        class PooledAdapter(HTTPAdapter):
+            """ HTTPAdapter applying the default timeout, counting requests and recording their spans """
+
+            def init_poolmanager(self, *args, **kwargs):
+                HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = pool_classes
+
+            def send(self, request, **kwargs):
+                # pylint: disable=W0221
+                if kwargs.get('timeout') is None:
+                    kwargs['timeout'] = timeout
+                url = urlparse(request.url)
+                stats.record_request(url.hostname)
+                start = time.time()
+                response = HTTPAdapter.send(self, request, **kwargs)
+                retries = getattr(response.raw, 'retries', None)
+                timings.recorder.record('HTTP %s %s' % (request.method, url.hostname), 'http', start,
+                                        time.time() - start, path=url.path, status=response.status_code,
+                                        bytes=response.headers.get('Content-Length'),
+                                        retries=len(retries.history) if retries else 0)
+                return response
+
+        return PooledAdapter(pool_connections=10, pool_maxsize=pool_maxsize, max_retries=retry)
+
+
+_default_transport = None
+_default_transport_args = {}
+_default_transport_lock = threading.Lock()
+
+
+def configure_default_transport(connect_timeout=None, read_timeout=None, retries=None):
+    """ Sets the timeouts (seconds) and retries of the process wide Transport,
+    None keeping the default. Takes effect when it is first used. """
+    with _default_transport_lock:
+        _default_transport_args['timeout'] = (connect_timeout or Transport.DEFAULT_TIMEOUT[0],
+                                              read_timeout or Transport.DEFAULT_TIMEOUT[1])
+        _default_transport_args['retries'] = retries
+
+
+def default_transport():
+    """ The process wide Transport """
+    global _default_transport  # pylint: disable=W0603
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport(**_default_transport_args)
+        return _default_transport
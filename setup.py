@@ -15,16 +15,17 @@ setup(
     entry_points={
         'console_scripts': [
             'okta-awscli=oktaawscli.okta_awscli:main',
+            'okta-awscli-env=oktaawscli.fastpath:main',
         ],
     },
     install_requires=[
         'requests',
-        'click',
-        'bs4',
-        'boto3',
+        'click>=8',
         'ConfigParser',
         ],
     extras_require={
-        'U2F': ['python-u2flib-host']
+        'U2F': ['python-u2flib-host'],
+        'boto3': ['boto3'],
+        'encryption': ['cryptography', 'keyring'],
     },
 )